@@ -22,19 +22,24 @@
 Generic and per-site behavior scripts
 """
 
-import time
+import json, time, threading
 from urllib.parse import urlsplit
 import os.path
 import pkg_resources
 from base64 import b64decode
 from collections import OrderedDict
+from functools import lru_cache
 
-from html5lib.serializer import HTMLSerializer
-from pychrome.exceptions import TimeoutException
+from pychrome.exceptions import TimeoutException, CallMethodException
 
 from .util import randomString, getFormattedViewportMetrics, removeFragment
 from . import html
-from .html import StripAttributeFilter, StripTagFilter, ChromeTreeWalker
+from .html import ChromeSerializer
+
+@lru_cache (maxsize=None)
+def loadScript (path, encoding='utf-8'):
+    """ Read script from package data, once per process """
+    return pkg_resources.resource_string (__name__, os.path.join ('data', path)).decode (encoding)
 
 class Script:
     """ A JavaScript resource """
@@ -44,7 +49,7 @@ class Script:
     def __init__ (self, path=None, encoding='utf-8'):
         self.path = path
         if path:
-            self.data = pkg_resources.resource_string (__name__, os.path.join ('data', path)).decode (encoding)
+            self.data = loadScript (path, encoding)
 
     def __repr__ (self):
         return '<Script {}>'.format (self.path)
@@ -58,16 +63,48 @@ class Script:
         s.data = data
         return s
 
+    def call (self, *args):
+        """ Call the function defined by this script with JSON arguments """
+        s = Script.fromStr ('({}) ({})'.format (self.data.strip (),
+                ', '.join (map (json.dumps, args))))
+        s.path = self.path
+        return s
+
+class InjectScript:
+    """ Request to run script in every new document, before it loads """
+
+    __slots__ = ('script', )
+
+    def __init__ (self, script):
+        self.script = script
+
+class EvaluateScript:
+    """
+    Request to evaluate script in the page. Its value is sent back to the
+    generator, None if it failed.
+    """
+
+    __slots__ = ('script', )
+
+    def __init__ (self, script):
+        self.script = script
+
 class Behavior:
-    __slots__ = ('loader', 'logger')
+    __slots__ = ('loader', 'logger', 'finished')
 
     # unique behavior name
     name = None
+    # seconds this behavior may spend on a page, None for no limit. See
+    # BehaviorRuntime.
+    budget = 10
 
     def __init__ (self, loader, logger):
         assert self.name is not None
         self.loader = loader
         self.logger = logger.bind (context=type (self).__name__)
+        # None if the behavior cannot tell whether it is done, otherwise
+        # False until it is. See SinglePageController.
+        self.finished = None
 
     def __contains__ (self, url):
         """
@@ -78,6 +115,13 @@ class Behavior:
     def __repr__ (self):
         return '<Behavior {}>'.format (self.name)
 
+    @classmethod
+    def withOptions (cls, **options):
+        """ Create behavior with class attributes replaced by options """
+        for k in options:
+            assert hasattr (cls, k), k
+        return type (cls.__name__, (cls, ), dict (options, __slots__=()))
+
     def onload (self):
         """ Before loading the page """
         yield from ()
@@ -101,75 +145,343 @@ class HostnameFilter:
         return hostname[:2] == self.hostname
 
 class JsOnload (Behavior):
-    """ Execute JavaScript on page load """
+    """
+    Execute JavaScript on page load. The script is removed again when
+    loading is stopped.
+    """
 
-    __slots__ = ('script', 'scriptHandle')
+    __slots__ = ('script', )
 
     scriptPath = None
 
     def __init__ (self, loader, logger):
         super ().__init__ (loader, logger)
         self.script = Script (self.scriptPath)
-        self.scriptHandle = None
 
     def onload (self):
         yield self.script
-        self.scriptHandle = self.loader.tab.Page.addScriptToEvaluateOnNewDocument (source=str (self.script))['identifier']
+        yield InjectScript (self.script)
 
-    def onstop (self):
-        self.loader.tab.Page.removeScriptToEvaluateOnNewDocument (identifier=self.scriptHandle)
-        yield from ()
+class BehaviorProfile:
+    """ Resources used by a single method of behavior name """
+
+    __slots__ = ('name', 'method', 'time', 'calls', 'bytes', 'cancelled')
+
+    def __init__ (self, name, method):
+        self.name = name
+        self.method = method
+        # wall time in seconds, excluding processing of the items yielded
+        self.time = 0
+        # DevTools protocol calls
+        self.calls = 0
+        # size of the items yielded
+        self.bytes = 0
+        self.cancelled = False
+
+    def __repr__ (self):
+        return '<BehaviorProfile {} {} {:.3f}s>'.format (self.name,
+                self.method, self.time)
+
+    def toDict (self):
+        return dict (time=self.time, calls=self.calls, bytes=self.bytes,
+                cancelled=int (self.cancelled))
+
+def itemSize (item):
+    """ Approximate size of an item yielded by a behavior, in bytes """
+    if isinstance (item, ExtractLinksEvent):
+        return sum (map (len, item.links)) + sum (map (len, item.resources))
+    for attr in ('data', 'document'):
+        value = getattr (item, attr, None)
+        if isinstance (value, bytes):
+            return len (value)
+        elif isinstance (value, str):
+            return len (value.encode ('utf-8'))
+    return 0
+
+class BehaviorRuntime:
+    """
+    Run methods of multiple behaviors, batching their page interactions
+
+    Scripts injected on load are combined into a single bundle, which is
+    removed on stop. Evaluations requested by different behaviors within the
+    same method are sent to the browser together, so each behavior runs up to
+    its next request before the batch is evaluated.
+
+    Every behavior may spend budget seconds on a page. Its DevTools calls time
+    out when the budget is exhausted and it is cancelled between items. The
+    resources used are reported as BehaviorProfile after each method.
+    """
+
+    __slots__ = ('loader', 'logger', 'behavior', 'scriptHandle', 'spent',
+            'cancelled', 'profile', 'current', 'started', 'thread')
+
+    def __init__ (self, loader, logger, behavior):
+        self.loader = loader
+        self.logger = logger.bind (context=type (self).__name__)
+        self.behavior = behavior
+        self.scriptHandle = None
+        # seconds spent by each behavior on this page
+        self.spent = dict.fromkeys (behavior, 0)
+        self.cancelled = set ()
+        # profiles of the method currently running
+        self.profile = {}
+        # behavior currently running and when it was resumed
+        self.current = None
+        self.started = None
+        self.thread = None
+
+    def run (self, method):
+        """
+        Run method of every behavior and yield their items, followed by their
+        profiles. Stops early if the browser crashed.
+        """
+        tab = self.loader.tab
+        # calls to a crashed tab may never return
+        crashed = self.loader.crashed
+        if crashed.is_set ():
+            return
+        if method == 'onload':
+            # page is (re)loaded, budgets start over
+            self.spent = dict.fromkeys (self.behavior, 0)
+            self.cancelled = set ()
+        elif method == 'onstop' and self.scriptHandle is not None:
+            tab.Page.removeScriptToEvaluateOnNewDocument (identifier=self.scriptHandle)
+            self.scriptHandle = None
+
+        self.profile = OrderedDict (map (lambda b: (b, BehaviorProfile (b.name, method)),
+                filter (lambda b: b not in self.cancelled, self.behavior)))
+        self.thread = threading.get_ident ()
+        restore = self._instrument (tab)
+        try:
+            inject = []
+            evaluate = []
+            for b in self.profile.keys ():
+                if crashed.is_set ():
+                    break
+                yield from self._advance (b, getattr (b, method) (), None,
+                        inject, evaluate)
+            while evaluate and not crashed.is_set ():
+                batch = evaluate
+                evaluate = []
+                results = self._evaluateBatch (batch)
+                for (b, gen, e), result in zip (batch, results):
+                    yield from self._advance (b, gen, result, inject, evaluate)
+
+            if inject and not crashed.is_set ():
+                self.scriptHandle = tab.Page.addScriptToEvaluateOnNewDocument (
+                        source=self._bundle (inject))['identifier']
+        finally:
+            restore ()
+        yield from self.profile.values ()
+
+    def _remaining (self, b):
+        """ Seconds behavior b may still run, None if unlimited """
+        if b.budget is None:
+            return None
+        spent = self.spent[b]
+        if self.current is b and self.started is not None:
+            spent += time.monotonic () - self.started
+        return b.budget - spent
+
+    def _instrument (self, tab):
+        """
+        Count and limit DevTools calls made by the current behavior in this
+        thread. Returns a function undoing it.
+        """
+        callMethod = getattr (tab, 'call_method', None)
+        if callMethod is None:
+            return lambda: None
+
+        def call (_method, *args, **kwargs):
+            b = self.current
+            if b is not None and threading.get_ident () == self.thread:
+                self.profile[b].calls += 1
+                remaining = self._remaining (b)
+                if remaining is not None and '_timeout' not in kwargs:
+                    if remaining <= 0:
+                        raise TimeoutException ('Behavior {} is over budget'.format (b.name))
+                    kwargs['_timeout'] = remaining
+            return callMethod (_method, *args, **kwargs)
+
+        tab.call_method = call
+        def restore ():
+            del tab.call_method
+        return restore
+
+    def _cancel (self, b, gen):
+        gen.close ()
+        self.cancelled.add (b)
+        self.profile[b].cancelled = True
+        self.logger.warning ('behavior over budget, cancelled',
+                uuid='9fc9e0a4-a222-417f-ad74-308a4173c1a8', behavior=b.name,
+                method=self.profile[b].method, budget=b.budget)
+
+    def _advance (self, b, gen, value, inject, evaluate):
+        """
+        Resume generator gen of behavior b with value, yielding its items
+        until it requests an evaluation, is exhausted or over budget
+        """
+        profile = self.profile[b]
+        while True:
+            remaining = self._remaining (b)
+            if remaining is not None and remaining <= 0:
+                self._cancel (b, gen)
+                return
+            self.current = b
+            self.started = time.monotonic ()
+            try:
+                item = gen.send (value)
+            except StopIteration:
+                return
+            except TimeoutException:
+                remaining = self._remaining (b)
+                if remaining is None or remaining > 0:
+                    raise
+                self._cancel (b, gen)
+                return
+            finally:
+                elapsed = time.monotonic () - self.started
+                self.spent[b] += elapsed
+                profile.time += elapsed
+                self.current = None
+                self.started = None
+            value = None
+
+            if isinstance (item, EvaluateScript):
+                evaluate.append ((b, gen, item))
+                return
+            elif isinstance (item, InjectScript):
+                inject.append (item.script)
+            else:
+                profile.bytes += itemSize (item)
+                yield item
+
+    def _evaluateBatch (self, batch):
+        """
+        Evaluate requests of batch, charging every behavior involved with the
+        call. It may take as long as the most generous budget allows.
+        """
+        remaining = [self._remaining (b) for b, gen, e in batch]
+        kwargs = {}
+        if None not in remaining:
+            kwargs['_timeout'] = max (max (remaining), 0)
+        start = time.monotonic ()
+        try:
+            results = self._evaluate ([e.script for b, gen, e in batch], **kwargs)
+        except TimeoutException:
+            # behaviors over budget are cancelled when resumed
+            results = [None]*len (batch)
+        elapsed = time.monotonic () - start
+        for b, gen, e in batch:
+            self.spent[b] += elapsed
+            self.profile[b].time += elapsed
+            self.profile[b].calls += 1
+        return results
+
+    @staticmethod
+    def _bundle (scripts):
+        """ Combine scripts, an exception in one does not affect the others """
+        return '\n'.join (map (lambda s: 'try {{\n{}\n}} catch (e) {{ console.error (e); }}'.format (s), scripts))
+
+    def _evaluate (self, scripts, **kwargs):
+        """ Evaluate scripts with a single call, returning their values """
+        expression = '[{}]'.format (',\n'.join (map (lambda s:
+                '(function () {{ try {{ return {{value: (\n{}\n)}}; }} catch (e) {{ return {{error: String (e)}}; }} }}) ()'.format (str (s).strip ().rstrip (';')),
+                scripts)))
+        result = self.loader.tab.Runtime.evaluate (expression=expression,
+                returnByValue=True, **kwargs)
+        values = result['result'].get ('value')
+        if values is None:
+            # the batch itself failed, i.e. a syntax error
+            self.logger.error ('script evaluation failed',
+                    uuid='363cdb52-0f5e-46a2-a022-f3484198333f',
+                    exception=result.get ('exceptionDetails'))
+            return [None]*len (scripts)
+        ret = []
+        for s, v in zip (scripts, values):
+            if 'error' in v:
+                self.logger.error ('script evaluation failed',
+                        uuid='e15feab9-1cb5-43a1-abdc-942aef199365',
+                        script=s.path, error=v['error'])
+            ret.append (v.get ('value'))
+        return ret
 
 ### Generic scripts ###
 
 class Scroll (JsOnload):
-    __slots__ = ('stopVarname')
+    """
+    Scroll the page and its scrollable elements until the page stops growing
+    """
+
+    __slots__ = ('stopVarname', 'doneBinding')
 
     name = 'scroll'
     scriptPath = 'scroll.js'
 
     def __init__ (self, loader, logger):
         super ().__init__ (loader, logger)
-        stopVarname = '__' + __package__ + '_stop__'
-        newStopVarname = randomString ()
-        self.script.data = self.script.data.replace (stopVarname, newStopVarname)
-        self.stopVarname = newStopVarname
+        self.stopVarname = randomString ()
+        self.doneBinding = randomString ()
+        self.script = self.script.call (self.stopVarname, self.doneBinding)
+
+    def onload (self):
+        self.finished = False
+        self.loader.addBinding (self.doneBinding, self._done)
+        yield from super ().onload ()
+
+    def _done (self, payload):
+        self.logger.debug ('scrolling done', uuid='21a58376-9c0e-472d-a5ea-04c2a2d40db9')
+        self.finished = True
 
     def onstop (self):
-        super ().onstop ()
+        yield from super ().onstop ()
         # removing the script does not stop it if running
         script = Script.fromStr ('{} = true; window.scrollTo (0, 0);'.format (self.stopVarname))
         yield script
         self.loader.tab.Runtime.evaluate (expression=str (script), returnByValue=True)
 
+cssPpi = 96
+
 class EmulateScreenMetrics (Behavior):
+    """
+    Emulate different screen sizes, causing the site to fetch assets (img
+    srcset and css, for example) for different screen resolutions.
+
+    Each size is kept until the requests it triggered are finished, but at
+    most maxWait seconds. Requests pending before do not count.
+    """
+
     name = 'emulateScreenMetrics'
 
+    sizes = [
+            {'width': 1920, 'height': 1080, 'deviceScaleFactor': 1.5, 'mobile': False},
+            {'width': 1920, 'height': 1080, 'deviceScaleFactor': 2, 'mobile': False},
+            # very dense display
+            {'width': 1920, 'height': 1080, 'deviceScaleFactor': 4, 'mobile': False},
+            # just a few samples:
+            # 1st gen iPhone (portrait mode)
+            {'width': 320, 'height': 480, 'deviceScaleFactor': 163/cssPpi, 'mobile': True},
+            # 6th gen iPhone (portrait mode)
+            {'width': 750, 'height': 1334, 'deviceScaleFactor': 326/cssPpi, 'mobile': True},
+            ]
+    # restored afterwards
+    reset = {'width': 1920, 'height': 1080, 'deviceScaleFactor': 1, 'mobile': False}
+    # time for the browser to re-eval the page and start requests
+    settle = 0.2
+    maxWait = 1
+
     def onstop (self):
-        """
-        Emulate different screen sizes, causing the site to fetch assets (img
-        srcset and css, for example) for different screen resolutions.
-        """
-        cssPpi = 96
-        sizes = [
-                {'width': 1920, 'height': 1080, 'deviceScaleFactor': 1.5, 'mobile': False},
-                {'width': 1920, 'height': 1080, 'deviceScaleFactor': 2, 'mobile': False},
-                # very dense display
-                {'width': 1920, 'height': 1080, 'deviceScaleFactor': 4, 'mobile': False},
-                # just a few samples:
-                # 1st gen iPhone (portrait mode)
-                {'width': 320, 'height': 480, 'deviceScaleFactor': 163/cssPpi, 'mobile': True},
-                # 6th gen iPhone (portrait mode)
-                {'width': 750, 'height': 1334, 'deviceScaleFactor': 326/cssPpi, 'mobile': True},
-                # and reset
-                {'width': 1920, 'height': 1080, 'deviceScaleFactor': 1, 'mobile': False},
-                ]
         l = self.loader
         tab = l.tab
-        for s in sizes:
+        for s in self.sizes + [self.reset]:
+            # only wait for requests triggered by this size
+            before = set (l.requests.keys ())
             tab.Emulation.setDeviceMetricsOverride (**s)
-            # give the browser time to re-eval page and start requests
-            time.sleep (1)
+            if not l.waitIdle (settle=self.settle, timeout=self.maxWait,
+                    ignore=before):
+                self.logger.debug ('not idle after resize',
+                        uuid='c8fdab61-377d-4cd3-82a0-8bbe966e221b', size=s,
+                        pending=len (l.requests.keys () - before))
         # XXX: this seems to be broken, it does not clear the override
         #tab.Emulation.clearDeviceMetricsOverride ()
         yield from ()
@@ -182,12 +494,26 @@ class DomSnapshotEvent:
         self.document = document
         self.viewport = viewport
 
+class CanvasSnapshotEvent:
+    __slots__ = ('url', 'mimeType', 'data', 'document')
+
+    def __init__ (self, url, mimeType, data, document=None):
+        self.url = url
+        self.mimeType = mimeType
+        self.data = data
+        # url of the DOM snapshot containing this image
+        self.document = document
+
 class DomSnapshot (Behavior):
     """
     Get a DOM snapshot of tab and write it to WARC.
 
-    We could use DOMSnapshot.getSnapshot here, but the API is not stable
-    yet. Also computed styles are not really necessary here.
+    Canvas elements are replaced by images, which are written to separate
+    records after the snapshot referring to them.
+
+    DOMSnapshot.captureSnapshot returns flat arrays and a shared string table,
+    which is smaller and faster to parse than the tree of DOM.getDocument.
+    The latter is used if captureSnapshot is disabled or not supported.
 
     XXX: Currently writes a response, when it should use “resource”. pywb
     can’t handle that though.
@@ -196,6 +522,9 @@ class DomSnapshot (Behavior):
     __slots__ = ('script')
 
     name = 'domSnapshot'
+    # serializing giant pages takes a while
+    budget = 30
+    captureSnapshot = True
 
     def __init__ (self, loader, logger):
         super ().__init__ (loader, logger)
@@ -204,14 +533,51 @@ class DomSnapshot (Behavior):
     def onfinish (self):
         tab = self.loader.tab
 
-        yield self.script
-        tab.Runtime.evaluate (expression=str (self.script), returnByValue=True)
+        # canvases are stored as separate records on the page’s origin, so
+        # replay can find them
+        script = self.script.call ('/.crocoite/canvas/{}/'.format (randomString ()))
+        yield script
+        result = yield EvaluateScript (script)
+        canvas = []
+        for url, data in result or []:
+            header, data = data.split (',', 1)
+            canvas.append ((url, header[len ('data:'):].split (';')[0],
+                    b64decode (data)))
 
         viewport = getFormattedViewportMetrics (tab)
-        dom = tab.DOM.getDocument (depth=-1, pierce=True)
+        # remove script, to make the page static and noscript, because at the
+        # time we took the snapshot scripts were enabled
+        serializer = ChromeSerializer (['script', 'noscript'], html.eventAttributes)
+
+        snapshot = None
+        if self.captureSnapshot:
+            try:
+                snapshot = tab.DOMSnapshot.captureSnapshot (computedStyles=[])
+            except CallMethodException as e:
+                self.logger.warning ('captureSnapshot failed, using getDocument',
+                        uuid='9cc826df-6773-446b-a8db-a32dd2420838', error=str (e))
+        if snapshot is not None:
+            strings = snapshot['strings']
+            def render (index):
+                doc = snapshot['documents'][index]
+                return strings[doc['documentURL']], strings[doc['baseURL']], \
+                        serializer.renderSnapshot (snapshot, index)
+            root = 0
+        else:
+            def render (doc):
+                return doc['documentURL'], doc['baseURL'], serializer.render (doc)
+            root = tab.DOM.getDocument (depth=-1, pierce=True)['root']
+
         haveUrls = set ()
-        for doc in ChromeTreeWalker (dom['root']).split ():
-            rawUrl = doc['documentURL']
+        documentUrl = None
+        # documents of frames are found while serializing their parent,
+        # serialize them in document order afterwards
+        docs = [root]
+        while docs:
+            rawUrl, baseUrl, data = render (docs.pop ())
+            docs.extend (reversed (serializer.subdocuments))
+            if documentUrl is None:
+                documentUrl = removeFragment (rawUrl)
             if rawUrl in haveUrls:
                 # ignore duplicate URLs. they are usually caused by
                 # javascript-injected iframes (advertising) with no(?) src
@@ -219,31 +585,49 @@ class DomSnapshot (Behavior):
                 continue
             url = urlsplit (rawUrl)
             if url.scheme in ('http', 'https'):
-                self.logger.debug ('saving DOM snapshot for url {}, base {}'.format (doc['documentURL'], doc['baseURL']))
+                self.logger.debug ('saving DOM snapshot for url {}, base {}'.format (rawUrl, baseUrl))
                 haveUrls.add (rawUrl)
-                walker = ChromeTreeWalker (doc)
-                # remove script, to make the page static and noscript, because at the
-                # time we took the snapshot scripts were enabled
-                disallowedTags = ['script', 'noscript']
-                disallowedAttributes = html.eventAttributes
-                stream = StripAttributeFilter (StripTagFilter (walker, disallowedTags), disallowedAttributes)
-                serializer = HTMLSerializer ()
-                yield DomSnapshotEvent (removeFragment (doc['documentURL']), serializer.render (stream, 'utf-8'), viewport)
+                yield DomSnapshotEvent (removeFragment (rawUrl), data, viewport)
+
+        for url, mimeType, data in canvas:
+            yield CanvasSnapshotEvent (url, mimeType, data, documentUrl)
 
 class ScreenshotEvent:
-    __slots__ = ('yoff', 'data', 'url')
+    __slots__ = ('yoff', 'data', 'url', 'mimeType', 'scale', 'height', 'repeat')
 
-    def __init__ (self, url, yoff, data):
+    def __init__ (self, url, yoff, data, mimeType='image/png', scale=1,
+            height=None, repeat=1):
         self.url = url
         self.yoff = yoff
         self.data = data
+        self.mimeType = mimeType
+        self.scale = scale
+        # tile height in CSS pixels
+        self.height = height
+        # the tile is repeated this many times, stacked vertically
+        self.repeat = repeat
 
 class Screenshot (Behavior):
     """
     Create screenshot from tab and write it to WARC
+
+    The page is captured in tiles, a tile identical to the previous one (blank
+    footers, for instance) is not stored again, but counted as repeat of it.
     """
 
     name = 'screenshot'
+    budget = 30
+
+    # png, jpeg or webp
+    format = 'png'
+    # 0-100, jpeg and webp only
+    quality = None
+    # device pixels per CSS pixel
+    scale = 1
+    # scale down pages wider than this (device pixels)
+    maxWidth = None
+    # stop capturing after this many CSS pixels
+    maxHeight = None
 
     def onfinish (self):
         tab = self.loader.tab
@@ -260,30 +644,82 @@ class Screenshot (Behavior):
         maxDim = 16*1024
         metrics = tab.Page.getLayoutMetrics ()
         contentSize = metrics['contentSize']
+        scale = self.scale
+        if self.maxWidth and contentSize['width'] > 0:
+            scale = min (scale, self.maxWidth/contentSize['width'])
+        # texture size is in device pixels, everything else in CSS pixels
+        maxDim = int (maxDim/scale)
         width = min (contentSize['width'], maxDim)
+        totalHeight = contentSize['height']
+        if self.maxHeight:
+            totalHeight = min (totalHeight, self.maxHeight)
+        args = {'format': self.format}
+        if self.quality is not None and self.format != 'png':
+            args['quality'] = self.quality
+        mimeType = 'image/' + self.format
+        # held back until we know how often it is repeated
+        previous = None
         # we’re ignoring horizontal scroll intentionally. Most horizontal
         # layouts use JavaScript scrolling and don’t extend the viewport.
-        for yoff in range (0, contentSize['height'], maxDim):
-            height = min (contentSize['height'] - yoff, maxDim)
-            clip = {'x': 0, 'y': yoff, 'width': width, 'height': height, 'scale': 1}
-            data = b64decode (tab.Page.captureScreenshot (format='png', clip=clip)['data'])
-            yield ScreenshotEvent (url, yoff, data)
+        for yoff in range (0, totalHeight, maxDim):
+            height = min (totalHeight - yoff, maxDim)
+            clip = {'x': 0, 'y': yoff, 'width': width, 'height': height, 'scale': scale}
+            data = b64decode (tab.Page.captureScreenshot (clip=clip, **args)['data'])
+            if previous is not None and data == previous.data:
+                self.logger.debug ('skipping duplicate screenshot tile',
+                        uuid='1d8f187c-8b0c-4714-a22b-ec5d4b7bbed2', yoff=yoff)
+                previous.repeat += 1
+                continue
+            if previous is not None:
+                yield previous
+            previous = ScreenshotEvent (url, yoff, data, mimeType, scale, height)
+        if previous is not None:
+            yield previous
 
 class Click (JsOnload):
-    """ Generic link clicking """
+    """
+    Generic link clicking, finished when no frame has anything to click.
+    Cannot tell if no frame has site-specific selectors.
+    """
+
+    __slots__ = ('doneBinding', 'frames')
 
     name = 'click'
     scriptPath = 'click.js'
 
+    def __init__ (self, loader, logger):
+        super ().__init__ (loader, logger)
+        self.doneBinding = randomString ()
+        self.script = self.script.call (self.doneBinding)
+        # frame id -> done?
+        self.frames = {}
+
+    def onload (self):
+        # cannot tell until a frame with something to click reports
+        self.finished = None
+        self.frames = {}
+        self.loader.addBinding (self.doneBinding, self._report)
+        yield from super ().onload ()
+
+    def _report (self, payload):
+        frame, state = payload.split (':', 1)
+        self.frames[frame] = state == 'done'
+        self.finished = all (self.frames.values ())
+        self.logger.debug ('click state', uuid='dc5395c0-f414-4016-b455-2c110543c5a2',
+                frame=frame, state=state)
+
 class ExtractLinksEvent:
-    __slots__ = ('links')
+    __slots__ = ('links', 'resources')
 
-    def __init__ (self, links):
+    def __init__ (self, links, resources=None):
+        # crawl targets
         self.links = links
+        # page requisites, like srcset candidates. Not crawled.
+        self.resources = resources or []
 
 class ExtractLinks (Behavior):
     """
-    Extract links from a page using JavaScript
+    Extract links from a page and its same-origin frames using JavaScript
     
     We could retrieve a HTML snapshot and extract links here, but we’d have to
     manually resolve relative links.
@@ -298,10 +734,17 @@ class ExtractLinks (Behavior):
         self.script = Script ('extract-links.js')
 
     def onfinish (self):
-        tab = self.loader.tab
         yield self.script
-        result = tab.Runtime.evaluate (expression=str (self.script), returnByValue=True)
-        yield ExtractLinksEvent (list (set (result['result']['value'])))
+        result = yield EvaluateScript (self.script)
+        if result is not None:
+            yield ExtractLinksEvent (self.expand (result),
+                    self.expand (result, 'resources'))
+
+    @staticmethod
+    def expand (result, key='links'):
+        """ Expand compact, deduplicated result of extract-links.js """
+        origins = result['origins']
+        return [origins[i] + rest for i, rest in result.get (key, [])]
 
 class Crash (Behavior):
     """ Crash the browser. For testing only. Obviously. """
@@ -25,7 +25,7 @@ Chrome browser interactions.
 from urllib.parse import urlsplit
 from base64 import b64decode
 from collections import deque
-from threading import Event
+from threading import Event, Lock
 from http.server import BaseHTTPRequestHandler
 from .logger import Level
 
@@ -34,42 +34,55 @@ import pychrome
 class Item:
     """
     Simple wrapper containing Chrome request and response
+
+    Only fields required for writing WARC records are extracted from Chrome’s
+    events, the complete event dicts (chromeRequest, chromeResponse and
+    chromeFinished) are kept with keepRaw only.
     """
 
-    __slots__ = ('tab', 'chromeRequest', 'chromeResponse', 'chromeFinished',
-            'isRedirect', 'failed')
+    __slots__ = ('tab', 'id', 'request', 'response', 'initiator', 'wallTime',
+            'requestTimestamp', 'responseTimestamp', 'resourceType',
+            'encodedDataLength', 'isRedirect', 'failed', 'blocked', 'orphaned',
+            'rawResponse', '_requestHeaders', '_responseHeaders', 'keepRaw',
+            'chromeRequest', 'chromeResponse', 'chromeFinished')
+
+    # fields of Network.Request and Network.Response we actually use
+    requestFields = ('url', 'method', 'headers', 'postData', 'hasPostData')
+    responseFields = ('url', 'status', 'statusText', 'headers',
+            'requestHeaders', 'mimeType', 'remoteIPAddress', 'protocol',
+            'fromDiskCache', 'connectionReused')
 
-    def __init__ (self, tab):
+    def __init__ (self, tab, keepRaw=False):
         self.tab = tab
-        self.chromeRequest = {}
-        self.chromeResponse = {}
-        self.chromeFinished = {}
+        self.id = None
+        self.request = {}
+        self.response = {}
+        self.initiator = None
+        self.wallTime = None
+        self.requestTimestamp = None
+        self.responseTimestamp = None
+        self.resourceType = None
+        self.encodedDataLength = None
         self.isRedirect = False
         self.failed = False
+        # failed, because it matched the blocklist
+        self.blocked = False
+        # failed, because it never finished loading
+        self.orphaned = False
+        # (status, status text, headers, body) as intercepted by
+        # SiteLoader before the browser processed it, if enabled
+        self.rawResponse = None
+        # unfolded headers, computed on first access
+        self._requestHeaders = None
+        self._responseHeaders = None
+        self.keepRaw = keepRaw
+        self.chromeRequest = None
+        self.chromeResponse = None
+        self.chromeFinished = None
 
     def __repr__ (self):
         return '<Item {}>'.format (self.url)
 
-    @property
-    def request (self):
-        return self.chromeRequest.get ('request', {})
-
-    @property
-    def response (self):
-        return self.chromeResponse.get ('response', {})
-
-    @property
-    def initiator (self):
-        return self.chromeRequest['initiator']
-
-    @property
-    def id (self):
-        return self.chromeRequest['requestId']
-
-    @property
-    def encodedDataLength (self):
-        return self.chromeFinished['encodedDataLength']
-
     @property
     def url (self):
         return self.response.get ('url', self.request.get ('url'))
@@ -110,13 +123,18 @@ class Item:
 
     @property
     def requestHeaders (self):
-        # the response object may contain refined headers, which were
-        # *actually* sent over the wire
-        return self._unfoldHeaders (self.response.get ('requestHeaders', self.request['headers']))
+        if self._requestHeaders is None:
+            # the response object may contain refined headers, which were
+            # *actually* sent over the wire
+            self._requestHeaders = self._unfoldHeaders (self.response.get (
+                    'requestHeaders', self.request['headers']))
+        return self._requestHeaders
 
     @property
     def responseHeaders (self):
-        return self._unfoldHeaders (self.response['headers'])
+        if self._responseHeaders is None:
+            self._responseHeaders = self._unfoldHeaders (self.response['headers'])
+        return self._responseHeaders
 
     @property
     def statusText (self):
@@ -128,10 +146,6 @@ class Item:
             return text[0]
         return 'No status text available'
 
-    @property
-    def resourceType (self):
-        return self.chromeResponse.get ('type', self.chromeRequest.get ('type', None))
-
     @staticmethod
     def _unfoldHeaders (headers):
         """
@@ -144,46 +158,205 @@ class Item:
                 items.append ((k, v))
         return items
 
+    @staticmethod
+    def _extract (d, fields):
+        return dict ((k, d[k]) for k in fields if k in d)
+
     def setRequest (self, req):
-        self.chromeRequest = req
+        """ Network.requestWillBeSent """
+        self.id = req['requestId']
+        self.request = self._extract (req['request'], self.requestFields)
+        self.initiator = req.get ('initiator')
+        self.wallTime = req.get ('wallTime')
+        self.requestTimestamp = req.get ('timestamp')
+        self.resourceType = req.get ('type', self.resourceType)
+        self._requestHeaders = None
+        if self.keepRaw:
+            self.chromeRequest = req
 
     def setResponse (self, resp):
-        self.chromeResponse = resp
+        """ Network.responseReceived """
+        self.response = self._extract (resp['response'], self.responseFields)
+        self.responseTimestamp = resp.get ('timestamp')
+        self.resourceType = resp.get ('type', self.resourceType)
+        self._requestHeaders = None
+        self._responseHeaders = None
+        if self.keepRaw:
+            self.chromeResponse = resp
 
     def setFinished (self, finished):
-        self.chromeFinished = finished
+        """ Network.loadingFinished """
+        self.encodedDataLength = finished['encodedDataLength']
+        if self.keepRaw:
+            self.chromeFinished = finished
 
 class BrowserCrashed (Exception):
     pass
 
+def parseBlocklist (fd):
+    """
+    Read URL blocklist from file object fd and return patterns suitable for
+    Network.setBlockedURLs, which supports the * wildcard only.
+
+    Simple Adblock Plus/EasyList rules are understood: comments (!), anchors
+    (| and ||) and separators (^, approximated by *). Exceptions (@@), element
+    hiding rules and rules with options ($) cannot be expressed and are
+    skipped.
+    """
+    patterns = []
+    for l in fd:
+        l = l.strip ()
+        if not l or l.startswith (('!', '[', '@@')) or '#' in l or '$' in l:
+            continue
+        l = l.replace ('^', '*')
+        if l.startswith ('||'):
+            # domain anchor, matches the host and its subdomains
+            l = l[2:]
+            prefixes = ('*://', '*.')
+        elif l.startswith ('|'):
+            l = l[1:]
+            prefixes = ('', )
+        else:
+            prefixes = ('', ) if l.startswith ('*') else ('*', )
+        if l.endswith ('|'):
+            l = l[:-1]
+        elif not l.endswith ('*'):
+            l = l + '*'
+        for p in prefixes:
+            pattern = p + l
+            # never block everything
+            if pattern.strip ('*'):
+                patterns.append (pattern)
+    return patterns
+
 class SiteLoader:
     """
     Load site in Chrome and monitor network requests
 
     Chrome’s raw devtools events are preprocessed here (asynchronously, in a
-    different thread, spawned by pychrome) and put into a deque. There
-    are two reasons for this: First of all, it makes consumer exception
-    handling alot easier (no need to propagate them to the main thread). And
-    secondly, browser crashes must be handled before everything else, as they
-    result in a loss of communication with the browser itself (i.e. we can’t
-    fetch a resource’s body any more).
+    different thread, spawned by pychrome) and put into a deque. This makes
+    consumer exception handling alot easier (no need to propagate them to the
+    main thread).
+
+    Browser crashes are queued like any other event, so items completed
+    before the crash are still processed. The crashed tab can be replaced by
+    a new one using reload().
+
+    With isolate the tab is opened in its own browser context, which does not
+    share cookies or cache with any other tab. This allows loading multiple
+    sites into the same browser concurrently.
+
+    Requests matching one of the blocklist patterns (see parseBlocklist) are
+    never sent and reported as failed and blocked items.
+
+    With intercept responses are paused using the Fetch domain and their body
+    and headers are recorded before the browser touches them (Item.rawResponse).
+    Bodies are not transcoded to UTF-8 this way, but the browser still removes
+    the content encoding.
+
+    Requests, which do not finish within maxRequestAge seconds, and requests
+    still pending when the page is done (see expire()) are reported as failed
+    and orphaned items.
+
+    Consumers should take items from the queue using popleft(). If more than
+    maxQueue items are waiting, the network is throttled until the queue is
+    half empty again. This limits memory usage if the consumer cannot keep up.
 
     XXX: track popup windows/new tabs and close them
     """
 
-    __slots__ = ('requests', 'browser', 'url', 'logger', 'queue', 'notify', 'tab')
+    __slots__ = ('requests', 'browser', 'url', 'logger', 'queue', 'notify',
+            'tab', 'crashed', 'isolate', 'control', 'context', 'blocklist',
+            'intercept', 'maxBodySize', 'maxQueue', 'throttled', 'throttleLock',
+            'keepRaw', 'maxRequestAge', 'lastExpire', 'lastActivity',
+            'activity', 'bindings')
     allowedSchemes = {'http', 'https'}
+    # bytes/s while throttled
+    throttleThroughput = 32*1024
 
-    def __init__ (self, browser, url, logger):
+    def __init__ (self, browser, url, logger, isolate=False, blocklist=[],
+            intercept=False, maxBodySize=50*1024*1024, maxQueue=1000,
+            keepRaw=False, maxRequestAge=300):
         self.requests = {}
         self.browser = pychrome.Browser (url=browser)
         self.url = url
         self.logger = logger.bind (context=type (self).__name__, url=url)
         self.queue = deque ()
         self.notify = Event ()
+        # set as soon as the tab crashed, before the queue is processed
+        self.crashed = Event ()
+        self.isolate = isolate
+        # browser target connection and our browser context, if isolated
+        self.control = None
+        self.context = None
+        self.blocklist = blocklist
+        self.intercept = intercept
+        # do not intercept bodies larger than this
+        self.maxBodySize = maxBodySize
+        self.maxQueue = maxQueue
+        # keep Chrome’s complete event dicts in Item
+        self.keepRaw = keepRaw
+        self.maxRequestAge = maxRequestAge
+        # browser timestamp of last expire() run
+        self.lastExpire = None
+        # time.monotonic () of last request started or finished, see waitIdle
+        self.lastActivity = 0
+        self.activity = Event ()
+        self.bindings = {}
+        self.throttled = False
+        # _append and popleft run in different threads
+        self.throttleLock = Lock ()
 
     def __enter__ (self):
-        tab = self.tab = self.browser.new_tab()
+        self._openTab ()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self._closeTab ()
+        if self.control is not None:
+            self.control.stop ()
+            self.control = None
+        return False
+
+    def reload (self):
+        """ Replace crashed tab with a new one. Call start() afterwards. """
+        # these will never finish
+        for item in self.expire ():
+            self._append (item)
+        try:
+            self._closeTab ()
+        except Exception as e:
+            # the tab may not respond any more
+            self.logger.warning ('closing crashed tab failed',
+                    uuid='00155c3f-7c0b-4662-a299-185423e4f9be', error=str (e))
+        self.crashed.clear ()
+        self._openTab ()
+
+    def _newIsolatedTab (self):
+        """ Create a blank tab in a new browser context """
+        if self.control is None:
+            # browser contexts can only be managed by the browser target
+            version = self.browser.version ()
+            self.control = pychrome.Tab (id='browser', type='browser',
+                    webSocketDebuggerUrl=version['webSocketDebuggerUrl'])
+            self.control.start ()
+        target = self.control.Target
+        self.context = target.createBrowserContext ()['browserContextId']
+        targetId = target.createTarget (url='about:blank',
+                browserContextId=self.context)['targetId']
+        self.logger.debug ('browser context', uuid='8da40139-46f7-4dd3-b312-47b58dc86b9e',
+                browserContextId=self.context, targetId=targetId)
+        netloc = urlsplit (self.browser.dev_url).netloc
+        return pychrome.Tab (id=targetId, type='page',
+                webSocketDebuggerUrl='ws://{}/devtools/page/{}'.format (netloc, targetId))
+
+    def _openTab (self):
+        # new tabs are never throttled
+        self.throttled = False
+        if self.isolate:
+            tab = self.tab = self._newIsolatedTab ()
+        else:
+            tab = self.tab = self.browser.new_tab()
         # setup callbacks
         tab.Network.requestWillBeSent = self._requestWillBeSent
         tab.Network.responseReceived = self._responseReceived
@@ -192,6 +365,10 @@ class SiteLoader:
         tab.Log.entryAdded = self._entryAdded
         tab.Page.javascriptDialogOpening = self._javascriptDialogOpening
         tab.Inspector.targetCrashed = self._targetCrashed
+        tab.Fetch.requestPaused = self._requestPaused
+        tab.Runtime.bindingCalled = self._bindingCalled
+        # bindings do not survive the tab
+        self.bindings = {}
 
         # start the tab
         tab.start()
@@ -199,19 +376,29 @@ class SiteLoader:
         # enable events
         tab.Log.enable ()
         tab.Network.enable()
+        if self.blocklist:
+            tab.Network.setBlockedURLs (urls=list (self.blocklist))
         tab.Page.enable ()
         tab.Inspector.enable ()
-        tab.Network.clearBrowserCache ()
-        if tab.Network.canClearBrowserCookies ()['result']:
-            tab.Network.clearBrowserCookies ()
-
-        return self
-
-    def __exit__ (self, exc_type, exc_value, traceback):
-        self.tab.Page.stopLoading ()
+        if self.intercept:
+            tab.Fetch.enable (patterns=[{'requestStage': 'Response'}])
+        # a new browser context is empty and clearing would affect other
+        # contexts too
+        if not self.isolate:
+            tab.Network.clearBrowserCache ()
+            if tab.Network.canClearBrowserCookies ()['result']:
+                tab.Network.clearBrowserCookies ()
+
+    def _closeTab (self):
+        if not self.crashed.is_set ():
+            # a crashed tab does not answer any more
+            self.tab.Page.stopLoading ()
         self.tab.stop ()
         self.browser.close_tab(self.tab)
-        return False
+        if self.context is not None:
+            context = self.context
+            self.context = None
+            self.control.Target.disposeBrowserContext (browserContextId=context)
 
     def __len__ (self):
         return len (self.requests)
@@ -222,11 +409,94 @@ class SiteLoader:
     def start (self):
         self.tab.Page.navigate(url=self.url)
 
+    def addBinding (self, name, callback):
+        """
+        Add global JavaScript function name to all frames. Calling it runs
+        callback (payload) in pychrome’s thread and wakes up the controller.
+        """
+        if not self.bindings:
+            self.tab.Runtime.enable ()
+        self.bindings[name] = callback
+        self.tab.Runtime.addBinding (name=name)
+
+    def expire (self, now=None):
+        """
+        Remove requests older than maxRequestAge at browser timestamp now, or
+        all of them if now is None, and return them as orphaned items.
+        """
+        expired = []
+        # events may arrive concurrently, iterate over a copy
+        for reqId, item in list (self.requests.items ()):
+            if now is not None and (item.requestTimestamp is None or
+                    now - item.requestTimestamp < self.maxRequestAge):
+                continue
+            if self.requests.pop (reqId, None) is None:
+                # finished in the meantime
+                continue
+            item.failed = True
+            item.orphaned = True
+            expired.append (item)
+        if expired:
+            self.logger.warning ('orphaned requests',
+                    uuid='ceaabd2d-7300-4275-96a8-dbb7cdcd0e5f',
+                    count=len (expired), urls=[i.url for i in expired[:100]])
+        return expired
+
+    def popleft (self):
+        """ Remove and return oldest item, raises IndexError if empty """
+        item = self.queue.popleft ()
+        if self.throttled and len (self.queue) <= self.maxQueue//2:
+            self._throttle (False)
+        return item
+
+    def _throttle (self, enable):
+        """ Slow down network, so fewer new items arrive """
+        with self.throttleLock:
+            if enable == self.throttled or self.crashed.is_set ():
+                return
+            self.throttled = enable
+            throughput = self.throttleThroughput if enable else -1
+            self.logger.info ('throttle', uuid='b5d18553-3926-4075-af8f-84bc9d6f9bd7',
+                    enable=enable, queuelen=len (self.queue))
+            try:
+                self.tab.Network.emulateNetworkConditions (offline=False,
+                        latency=0, downloadThroughput=throughput,
+                        uploadThroughput=throughput)
+            except (pychrome.exceptions.CallMethodException,
+                    pychrome.exceptions.TimeoutException) as e:
+                self.logger.warning ('throttle failed',
+                        uuid='2288dde0-5ef3-4b97-99df-199ce8daa50b', error=str (e))
+
     # use event to signal presence of new items. This way the controller
     # can wait for them without polling.
     def _append (self, item):
         self.queue.append (item)
         self.notify.set ()
+        self._activity ()
+        if not self.throttled and len (self.queue) > self.maxQueue:
+            self._throttle (True)
+
+    def _activity (self):
+        self.lastActivity = time.monotonic ()
+        self.activity.set ()
+
+    def waitIdle (self, settle=0.2, timeout=1, ignore=frozenset ()):
+        """
+        Wait until no request, except those in ignore, is pending and none
+        started or finished for settle seconds, but at most timeout seconds.
+        Returns True if idle.
+        """
+        deadline = time.monotonic () + timeout
+        while True:
+            now = time.monotonic ()
+            idle = now - self.lastActivity
+            if not (self.requests.keys () - ignore) and idle >= settle:
+                return True
+            if now >= deadline:
+                return False
+            self.activity.clear ()
+            # wake up on activity or when settled
+            self.activity.wait (min (deadline - now, max (settle - idle, 0.05)))
 
     def _appendleft (self, item):
         self.queue.appendleft (item)
@@ -258,10 +528,20 @@ class SiteLoader:
             else:
                 logger.warning ('request exists', uuid='2c989142-ba00-4791-bb03-c2a14e91a56b')
 
-        item = Item (self.tab)
+        item = Item (self.tab, keepRaw=self.keepRaw)
         item.setRequest (kwargs)
         self.requests[reqId] = item
         logger.debug ('request', uuid='55c17564-1bd0-4499-8724-fa7aad65478f')
+        self._activity ()
+
+        # look for stale requests every now and then
+        now = kwargs['timestamp']
+        if self.lastExpire is None:
+            self.lastExpire = now
+        elif now - self.lastExpire > self.maxRequestAge/10:
+            self.lastExpire = now
+            for item in self.expire (now):
+                self._append (item)
 
     def _responseReceived (self, **kwargs):
         reqId = kwargs['requestId']
@@ -306,9 +586,52 @@ class SiteLoader:
                 errorText=kwargs['errorText'],
                 blockedReason=kwargs.get ('blockedReason'))
         item = self.requests.pop (reqId, None)
+        if item is None:
+            # not recorded (blacklisted scheme, for example) or expired
+            return
         item.failed = True
+        # set by setBlockedURLs
+        item.blocked = kwargs.get ('blockedReason') == 'inspector'
         self._append (item)
 
+    def _requestPaused (self, **kwargs):
+        """ Response intercepted by the Fetch domain """
+        fetchId = kwargs['requestId']
+        reqId = kwargs.get ('networkId')
+        status = kwargs.get ('responseStatusCode')
+        logger = self.logger.bind (reqId=reqId)
+        try:
+            item = self.requests.get (reqId)
+            # redirect bodies are never recorded
+            if item is not None and status is not None and \
+                    kwargs.get ('responseErrorReason') is None and \
+                    not 300 <= status < 400:
+                headers = [(h['name'], h['value']) for h in kwargs.get ('responseHeaders', [])]
+                length = [v for k, v in headers if k.lower () == 'content-length']
+                if length and int (length[0]) > self.maxBodySize:
+                    logger.debug ('not intercepting large body',
+                            uuid='907ef11b-5fe3-470f-bdbe-9549d60b5f3c',
+                            length=length[0])
+                else:
+                    body = self.tab.Fetch.getResponseBody (requestId=fetchId, _timeout=10)
+                    if body['base64Encoded']:
+                        body = b64decode (body['body'])
+                    else:
+                        body = body['body'].encode ('utf8')
+                    item.rawResponse = (status, kwargs.get ('responseStatusText'),
+                            headers, body)
+        except (pychrome.exceptions.CallMethodException,
+                pychrome.exceptions.TimeoutException, ValueError) as e:
+            logger.warning ('intercepting body failed',
+                    uuid='40d11517-198d-4897-ad65-e337b07140e0', error=str (e))
+        finally:
+            try:
+                self.tab.Fetch.continueRequest (requestId=fetchId)
+            except (pychrome.exceptions.CallMethodException,
+                    pychrome.exceptions.TimeoutException):
+                # the request is gone anyway (i.e. tab crashed)
+                pass
+
     def _entryAdded (self, **kwargs):
         """ Log entry added """
         entry = kwargs['entry']
@@ -334,28 +657,104 @@ class SiteLoader:
         else:
             self.logger.warning ('js dialog unknown', uuid='3ef7292e-8595-4e89-b834-0cc6bc40ee38', **kwargs)
 
+    def _bindingCalled (self, **kwargs):
+        callback = self.bindings.get (kwargs['name'])
+        if callback is not None:
+            callback (kwargs['payload'])
+            self.notify.set ()
+
     def _targetCrashed (self, **kwargs):
         self.logger.error ('browser crashed', uuid='6fe2b3be-ff01-4503-b30c-ad6aeea953ef')
-        # priority message
-        self._appendleft (BrowserCrashed ())
+        self.crashed.set ()
+        # items before the crash are complete, keep them
+        self._append (BrowserCrashed (self.url))
 
-import subprocess, os, time
+import subprocess, os, time, re, selectors
 from tempfile import mkdtemp
+from threading import Thread
 import shutil
 
+class BrowserStartFailed (Exception):
+    """ The browser died or did not announce its DevTools endpoint in time """
+    pass
+
 class ChromeService:
-    """ Start Google Chrome listening on a random port """
+    """
+    Start Google Chrome listening on a random port
 
-    __slots__ = ('binary', 'windowSize', 'p', 'userDataDir')
+    If profile is given the browser’s user data directory is a copy of it,
+    which skips the first-run initialization of a fresh profile. If profile
+    does not exist yet, it is created by starting the browser on about:blank
+    once, so no site’s cookies, cache or storage end up in it.
+    """
+
+    __slots__ = ('binary', 'windowSize', 'p', 'tempDir', 'userDataDir',
+            'profile', 'startTimeout', 'startupTime')
+
+    # bound to a running browser instance, must not be copied
+    volatileFiles = ('Singleton*', 'DevToolsActivePort')
+    # Chrome announces its endpoint on stderr like this
+    listeningRe = re.compile (rb'DevTools listening on (ws://\S+)')
 
-    def __init__ (self, binary='google-chrome-stable', windowSize=(1920, 1080)):
+    def __init__ (self, binary='google-chrome-stable', windowSize=(1920, 1080),
+            profile=None, startTimeout=20):
         self.binary = binary
         self.windowSize = windowSize
+        self.profile = profile
+        self.startTimeout = startTimeout
         self.p = None
+        # seconds from __enter__ until DevTools was ready
+        self.startupTime = None
 
     def __enter__ (self):
         assert self.p is None
-        self.userDataDir = mkdtemp ()
+        start = time.monotonic ()
+        deadline = start + self.startTimeout
+        self.startupTime = None
+        if self.profile is not None and not os.path.exists (self.profile):
+            self._createProfile (deadline)
+        self.tempDir, self.userDataDir = self._newUserDataDir (self.profile)
+        self._start ()
+        try:
+            port = self._waitListening (deadline)
+        except:
+            self.__exit__ ()
+            raise
+        self.startupTime = time.monotonic () - start
+
+        return 'http://localhost:{}'.format (port)
+
+    def _newUserDataDir (self, profile=None, parent=None):
+        """
+        Create user data directory in a new temporary directory below parent,
+        as a copy of profile if given. Returns both.
+        """
+        tempDir = mkdtemp (dir=parent)
+        userDataDir = os.path.join (tempDir, 'profile')
+        if profile is not None and os.path.isdir (profile):
+            shutil.copytree (profile, userDataDir, symlinks=True,
+                    ignore=shutil.ignore_patterns (*self.volatileFiles))
+        else:
+            os.mkdir (userDataDir)
+        return tempDir, userDataDir
+
+    def _createProfile (self, deadline):
+        """ Create profile template from a browser which loaded nothing """
+        self.tempDir, self.userDataDir = self._newUserDataDir ()
+        try:
+            self._start ()
+            try:
+                self._waitListening (deadline)
+            finally:
+                self.p.terminate ()
+                self.p.wait ()
+                self.p = None
+            self._saveProfile ()
+        finally:
+            shutil.rmtree (self.tempDir)
+
+    def _start (self):
+        """ Start browser with userDataDir """
         args = [self.binary,
                 '--window-size={},{}'.format (*self.windowSize),
                 '--user-data-dir={}'.format (self.userDataDir), # use temporory user dir
@@ -375,34 +774,63 @@ class ChromeService:
         # start new session, so ^C does not affect subprocess
         self.p = subprocess.Popen (args, start_new_session=True,
                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL)
-        port = None
-        # chrome writes its current active devtools port to a file. due to the
-        # sleep() this is rather ugly, but should work with all versions of the
-        # browser.
-        for i in range (100):
-            try:
-                with open (os.path.join (self.userDataDir, 'DevToolsActivePort'), 'r') as fd:
-                    port = int (fd.readline ().strip ())
+                stderr=subprocess.PIPE)
+
+    def _waitListening (self, deadline):
+        """
+        Wait for the DevTools endpoint announcement on stderr and return its
+        port. No polling involved.
+        """
+        fd = self.p.stderr.fileno ()
+        buf = b''
+        with selectors.DefaultSelector () as sel:
+            sel.register (fd, selectors.EVENT_READ)
+            while True:
+                timeout = deadline - time.monotonic ()
+                if timeout <= 0 or not sel.select (timeout):
+                    raise BrowserStartFailed ('Chrome did not start in time.')
+                data = os.read (fd, 4096)
+                if not data:
+                    raise BrowserStartFailed ('Chrome died on us.')
+                # keep incomplete last line only
+                buf = buf[buf.rfind (b'\n')+1:] + data
+                m = self.listeningRe.search (buf)
+                if m:
                     break
-            except FileNotFoundError:
-                time.sleep (0.2)
-        if port is None:
-            raise Exception ('Chrome died on us.')
+        # keep the pipe empty, so the browser never blocks writing to it
+        Thread (target=self._drain, args=(self.p.stderr, ), daemon=True).start ()
+        return urlsplit (m.group (1).decode ('utf-8')).port
 
-        return 'http://localhost:{}'.format (port)
+    @staticmethod
+    def _drain (fd):
+        with fd:
+            while fd.read1 (4096):
+                pass
+
+    def _saveProfile (self):
+        """ Save current profile as template, if there is none yet """
+        parent = os.path.dirname (os.path.abspath (self.profile))
+        tempDir, userDataDir = self._newUserDataDir (self.userDataDir, parent)
+        try:
+            # atomic, concurrent instances may do the same
+            os.rename (userDataDir, self.profile)
+        except OSError:
+            pass
+        shutil.rmtree (tempDir)
 
     def __exit__ (self, *exc):
         self.p.terminate ()
         self.p.wait ()
-        shutil.rmtree (self.userDataDir)
+        shutil.rmtree (self.tempDir)
         self.p = None
 
 class NullService:
-    __slots__ = ('url')
+    __slots__ = ('url', 'startupTime')
 
     def __init__ (self, url):
         self.url = url
+        # not started by us
+        self.startupTime = None
 
     def __enter__ (self):
         return self.url
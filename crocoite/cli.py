@@ -22,17 +22,41 @@
 Command line interface
 """
 
-import argparse, json, sys
+import argparse, json, sys, signal, re
 
 from . import behavior
 from .controller import SinglePageController, defaultSettings, \
         ControllerSettings, StatsHandler, LogHandler
-from .browser import NullService, ChromeService
+from .browser import NullService, ChromeService, BrowserCrashed, \
+        parseBlocklist
 from .warc import WarcHandler
+from .fetcher import Fetcher
+from contextlib import contextmanager
 from .logger import Logger, JsonPrintConsumer, DatetimeConsumer, WarcHandlerConsumer
 
-def single ():
-    parser = argparse.ArgumentParser(description='Save website to WARC using Google Chrome.')
+def deviceMetrics (s):
+    """ Parse WIDTHxHEIGHT[@SCALE][m] into device metrics for --device """
+    m = re.fullmatch (r'(\d+)x(\d+)(?:@(\d+(?:\.\d+)?))?(m)?', s)
+    if not m:
+        raise argparse.ArgumentTypeError ('invalid device {}'.format (s))
+    return {'width': int (m.group (1)), 'height': int (m.group (2)),
+            'deviceScaleFactor': float (m.group (3) or 1),
+            'mobile': m.group (4) is not None}
+
+def behaviorBudget (s):
+    """ Parse NAME=SECONDS for --behavior-budget, none means no limit """
+    name, sep, budget = s.partition ('=')
+    if not sep or name not in behavior.availableMap:
+        raise argparse.ArgumentTypeError ('invalid behavior budget {}'.format (s))
+    if budget == 'none':
+        return name, None
+    try:
+        return name, float (budget)
+    except ValueError:
+        raise argparse.ArgumentTypeError ('invalid behavior budget {}'.format (s))
+
+def addGrabArguments (parser):
+    """ Arguments shared by crocoite-grab and crocoite-batch """
     parser.add_argument('--browser', help='DevTools URL', metavar='URL')
     parser.add_argument('--timeout', default=10, type=int, help='Maximum time for archival', metavar='SEC')
     parser.add_argument('--idle-timeout', default=2, type=int, help='Maximum idle seconds (i.e. no requests)', dest='idleTimeout', metavar='SEC')
@@ -41,67 +65,341 @@ def single ():
             dest='enabledBehaviorNames',
             default=list (behavior.availableMap.keys ()),
             choices=list (behavior.availableMap.keys ()))
+    parser.add_argument('--behavior-budget', action='append', type=behaviorBudget,
+            dest='behaviorBudgets', default=[],
+            help='Cancel behavior script after SECONDS per page, none for no limit (can be repeated)',
+            metavar='NAME=SECONDS')
+    parser.add_argument('--crash-recovery', default=defaultSettings.crashRecovery,
+            dest='crashRecovery', choices=ControllerSettings.crashRecoveryModes,
+            help='Keep partial results or reload page after browser crash')
+    parser.add_argument('--blocklist', help='Do not load URLs matching patterns from FILE (EasyList syntax)',
+            metavar='FILE')
+    parser.add_argument('--intercept', action='store_true',
+            help='Record response bodies before the browser transcodes them')
+    parser.add_argument('--fetch-large', action='store_true', dest='fetchLarge',
+            help='Download bodies larger than --max-body-size without the browser')
+    parser.add_argument('--fetch-concurrency', default=2, type=int,
+            dest='fetchConcurrency', help='Concurrent downloads for --fetch-large',
+            metavar='NUM')
+    parser.add_argument('--fetch-max-body-size', default=1024**3, type=int,
+            dest='fetchMaxBodySize', help='Max body size for --fetch-large',
+            metavar='BYTES')
+    parser.add_argument('--profile', help='Start browser with a copy of this profile, created on first use',
+            metavar='DIR')
+    parser.add_argument('--device', action='append', type=deviceMetrics,
+            dest='devices', help='Emulate this screen instead of the default ones, m for mobile (can be repeated)',
+            metavar='WIDTHxHEIGHT[@SCALE][m]')
+    parser.add_argument('--screenshot-format', dest='screenshotFormat',
+            choices=['png', 'jpeg', 'webp'], help='Screenshot image format')
+    parser.add_argument('--screenshot-quality', type=int, dest='screenshotQuality',
+            help='Screenshot compression quality (jpeg and webp only)', metavar='0-100')
+    parser.add_argument('--screenshot-scale', type=float, dest='screenshotScale',
+            help='Screenshot device pixels per CSS pixel', metavar='SCALE')
+    parser.add_argument('--screenshot-max-width', type=int, dest='screenshotMaxWidth',
+            help='Scale down wider screenshots', metavar='PX')
+    parser.add_argument('--screenshot-max-height', type=int, dest='screenshotMaxHeight',
+            help='Capture at most PX of the page’s height', metavar='PX')
+
+def parseGrabArguments (args):
+    """ Returns service, settings and behavior from addGrabArguments’ args """
+    service = ChromeService (profile=args.profile)
+    if args.browser:
+        service = NullService (args.browser)
+    blocklist = []
+    if args.blocklist:
+        with open (args.blocklist, 'r') as fd:
+            blocklist = parseBlocklist (fd)
+    settings = ControllerSettings (maxBodySize=args.maxBodySize,
+            idleTimeout=args.idleTimeout, timeout=args.timeout,
+            crashRecovery=args.crashRecovery, blocklist=blocklist,
+            intercept=args.intercept)
+    b = list (map (lambda x: behavior.availableMap[x], args.enabledBehaviorNames))
+    options = {}
+    if args.devices:
+        options[behavior.EmulateScreenMetrics] = {'sizes': args.devices}
+    options[behavior.Screenshot] = {k: v for k, v in [
+            ('format', args.screenshotFormat),
+            ('quality', args.screenshotQuality),
+            ('scale', args.screenshotScale),
+            ('maxWidth', args.screenshotMaxWidth),
+            ('maxHeight', args.screenshotMaxHeight)] if v is not None}
+    for name, budget in args.behaviorBudgets:
+        options.setdefault (behavior.availableMap[name], {})['budget'] = budget
+    b = [x.withOptions (**options[x]) if options.get (x) else x for x in b]
+    return service, settings, b
+
+def openFetcher (args, logger):
+    """ Context manager for the off-browser fetcher, if enabled """
+    if args.fetchLarge:
+        return Fetcher (logger, concurrency=args.fetchConcurrency,
+                maxBodySize=args.fetchMaxBodySize)
+    return noFetcher ()
+
+@contextmanager
+def noFetcher ():
+    """ contextlib.nullcontext, which requires Python 3.7 """
+    yield None
+
+def single ():
+    parser = argparse.ArgumentParser(description='Save website to WARC using Google Chrome.')
+    addGrabArguments (parser)
     parser.add_argument('url', help='Website URL', metavar='URL')
     parser.add_argument('output', help='WARC filename', metavar='FILE')
 
     args = parser.parse_args ()
 
+    # stop gracefully on SIGTERM (sent by crocoite-recursive on timeout), so
+    # the browser is shut down and the WARC is finished
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (1))
+
     logger = Logger (consumer=[DatetimeConsumer (), JsonPrintConsumer ()])
 
-    service = ChromeService ()
-    if args.browser:
-        service = NullService (args.browser)
-    settings = ControllerSettings (maxBodySize=args.maxBodySize,
-            idleTimeout=args.idleTimeout, timeout=args.timeout)
-    with open (args.output, 'wb') as fd, WarcHandler (fd, logger) as warcHandler:
+    service, settings, b = parseGrabArguments (args)
+    with openFetcher (args, logger) as fetcher, \
+            open (args.output, 'wb') as fd, \
+            WarcHandler (fd, logger, maxBodySize=settings.maxBodySize,
+                    fetcher=fetcher) as warcHandler:
         logger.connect (WarcHandlerConsumer (warcHandler))
         handler = [StatsHandler (), LogHandler (logger), warcHandler]
-        b = list (map (lambda x: behavior.availableMap[x], args.enabledBehaviorNames))
         controller = SinglePageController (args.url, fd, settings=settings,
                 service=service, handler=handler, behavior=b, logger=logger)
-        controller.run ()
-        r = handler[0].stats
+        ret = 0
+        try:
+            if not controller.run ():
+                # partial capture after crash, WARC is usable nonetheless
+                ret = 1
+        except BrowserCrashed:
+            # already logged and counted by StatsHandler
+            ret = 1
+        r = dict (handler[0].stats)
+        r['browserStartup'] = service.startupTime
         logger.info ('stats', context='cli', uuid='24d92d16-770e-4088-b769-4020e127a7ff', **r)
 
-    return True
+    return ret
+
+import os, tempfile
+from datetime import datetime
+from urllib.parse import urlparse
+from .controller import BatchController
+
+def batch ():
+    """
+    Save many websites, read from stdin, to individual WARCs using a single
+    browser instance
+    """
+    parser = argparse.ArgumentParser(description='Save websites read from stdin to WARC using Google Chrome.')
+    addGrabArguments (parser)
+    parser.add_argument('-j', '--concurrency',
+            help='Number of pages loaded at the same time',
+            metavar='NUM', default=4, type=int)
+    parser.add_argument('--prefix', help='Output filename prefix, supports templates {host} and {date}',
+            metavar='FILENAME', default='{host}-{date}-')
+    parser.add_argument('output', help='Output directory', metavar='DIR')
+
+    args = parser.parse_args ()
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (1))
+
+    logger = Logger (consumer=[DatetimeConsumer (), JsonPrintConsumer ()])
+    service, settings, b = parseGrabArguments (args)
+
+    os.makedirs (args.output, exist_ok=True)
+
+    @contextmanager
+    def openPage (url, fetcher):
+        prefix = args.prefix.format (host=urlparse (url).hostname,
+                date=datetime.utcnow ().isoformat ())
+        with tempfile.NamedTemporaryFile (dir=args.output, prefix=prefix,
+                suffix='.warc.gz', delete=False) as fd, \
+                WarcHandler (fd, logger, maxBodySize=settings.maxBodySize,
+                        fetcher=fetcher) as warcHandler:
+            # every page has its own log
+            pageLogger = Logger (consumer=[DatetimeConsumer (),
+                    JsonPrintConsumer (), WarcHandlerConsumer (warcHandler)],
+                    bindings=dict (url=url, destfile=fd.name))
+            stats = StatsHandler ()
+            handler = [stats, LogHandler (pageLogger), warcHandler]
+            try:
+                yield pageLogger, handler
+            finally:
+                pageLogger.info ('stats', context='cli',
+                        uuid='24d92d16-770e-4088-b769-4020e127a7ff', **stats.stats)
+
+    urls = filter (lambda x: x and not x.startswith ('#'),
+            map (str.strip, sys.stdin))
+    # shared by all pages
+    with openFetcher (args, logger) as fetcher:
+        controller = BatchController (urls, lambda url: openPage (url, fetcher),
+                logger, service=service, behavior=b, settings=settings,
+                concurrency=args.concurrency)
+        ret = controller.run ()
+    return 0 if ret else 1
 
-import asyncio, os
-from .controller import RecursiveController, DepthLimit, PrefixLimit
+import asyncio
+from .controller import RecursiveController, DepthLimit, PrefixLimit, \
+        ScopeLimit, CombinedPolicy, AdaptiveConcurrency, RetryQueue
 
-def parsePolicy (recursive, url):
-    if recursive is None:
-        return DepthLimit (0)
+def parsePolicy (recursive, url, scope=None):
+    """
+    Create policy from --policy and, optionally, the rule file --scope, which
+    further limits the base policy. --policy scope follows all links in scope.
+    """
+    if scope is not None:
+        with open (scope, 'r') as fd:
+            scope = ScopeLimit.fromFile (fd)
+
+    if recursive == 'scope':
+        if scope is None:
+            raise ValueError ('Policy scope requires a rule file')
+        return scope
+    elif recursive is None:
+        policy = DepthLimit (0)
     elif recursive.isdigit ():
-        return DepthLimit (int (recursive))
+        policy = DepthLimit (int (recursive))
     elif recursive == 'prefix':
-        return PrefixLimit (url)
+        policy = PrefixLimit (url)
     else:
         raise ValueError ('Unsupported')
 
+    if scope is not None:
+        policy = CombinedPolicy (policy, scope)
+    return policy
+
+def parseShard (s):
+    """ Parse shard specification I/N """
+    shard, sep, shards = s.partition ('/')
+    if not sep or not shard.isdigit () or not shards.isdigit () or \
+            int (shard) >= int (shards):
+        raise argparse.ArgumentTypeError ('Expected I/N with 0 <= I < N')
+    return int (shard), int (shards)
+
 def recursive ():
     logger = Logger (consumer=[DatetimeConsumer (), JsonPrintConsumer ()])
 
     parser = argparse.ArgumentParser(description='Recursively run crocoite-grab.')
     parser.add_argument('--policy', help='Recursion policy', metavar='POLICY')
+    parser.add_argument('--scope', help='Limit recursion to allow/deny rules in FILE', metavar='FILE')
     parser.add_argument('--tempdir', help='Directory for temporary files', metavar='DIR')
     parser.add_argument('--prefix', help='Output filename prefix, supports templates {host} and {date}', metavar='FILENAME', default='{host}-{date}-')
     parser.add_argument('--concurrency', '-j', help='Run at most N jobs', metavar='N', default=1, type=int)
+    parser.add_argument('--autoscale', help='Adjust number of jobs between --min-concurrency and --concurrency based on memory and CPU usage', action='store_true')
+    parser.add_argument('--min-concurrency', help='Run at least N jobs when autoscaling', metavar='N', default=1, type=int, dest='minConcurrency')
+    parser.add_argument('--retries', help='Fetch each URL at most N times', metavar='N', default=3, type=int)
+    parser.add_argument('--retry-backoff', help='Wait SEC before the first retry, doubled for every further attempt', metavar='SEC', default=30, type=int, dest='retryBackoff')
+    parser.add_argument('--fetch-timeout', help='Kill fetch command after SEC', metavar='SEC', type=int, dest='fetchTimeout')
+    parser.add_argument('--shard', help='Only fetch hosts of shard I (counting from 0) of N', metavar='I/N', type=parseShard)
+    parser.add_argument('--spool', help='Directory shared by all shards', metavar='DIR')
+    parser.add_argument('--crawl-id', help='Name of this crawl, the same for all shards and unique per --spool', metavar='ID', dest='crawlId')
     parser.add_argument('url', help='Seed URL', metavar='URL')
     parser.add_argument('output', help='Output directory', metavar='DIR')
     parser.add_argument('command', help='Fetch command, supports templates {url} and {dest}', metavar='CMD', nargs='*', default=['crocoite-grab', '{url}', '{dest}'])
 
     args = parser.parse_args ()
     try:
-        policy = parsePolicy (args.policy, args.url)
-    except ValueError:
-        parser.error ('Invalid argument for --policy')
+        policy = parsePolicy (args.policy, args.url, args.scope)
+    except ValueError as e:
+        parser.error ('Invalid argument for --policy or --scope: {}'.format (e))
+    except OSError as e:
+        parser.error ('Cannot read scope file: {}'.format (e))
+
+    if args.shard and not (args.spool and args.crawlId):
+        parser.error ('--shard requires --spool and --crawl-id')
+    if args.shard and args.policy and args.policy.isdigit () and int (args.policy) > 0:
+        # every instance would count depth on its own
+        parser.error ('--shard does not support depth policies')
+
+    autoscale = None
+    if args.autoscale:
+        try:
+            autoscale = AdaptiveConcurrency (minimum=args.minConcurrency,
+                    maximum=args.concurrency)
+        except ValueError:
+            parser.error ('Invalid --min-concurrency or --concurrency')
+
+    retry = RetryQueue (maxAttempts=args.retries, backoff=args.retryBackoff)
+
+    os.makedirs (args.output, exist_ok=True)
+
+    if args.shard:
+        from .distributed import ShardedController
+        shard, shards = args.shard
+        controller = ShardedController (url=args.url, output=args.output,
+                command=args.command, logger=logger, policy=policy,
+                tempdir=args.tempdir, prefix=args.prefix,
+                concurrency=args.concurrency, autoscale=autoscale,
+                retry=retry, fetchTimeout=args.fetchTimeout,
+                shard=shard, shards=shards, spool=args.spool,
+                crawl=args.crawlId)
+    else:
+        controller = RecursiveController (url=args.url, output=args.output,
+                command=args.command, logger=logger, policy=policy,
+                tempdir=args.tempdir, prefix=args.prefix,
+                concurrency=args.concurrency, autoscale=autoscale,
+                retry=retry, fetchTimeout=args.fetchTimeout)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(controller.run ())
+    loop.close()
+
+def parseAddress (s):
+    """ Parse host:port """
+    host, sep, port = s.rpartition (':')
+    if not sep or not port.isdigit ():
+        raise argparse.ArgumentTypeError ('Expected HOST:PORT')
+    return host or 'localhost', int (port)
+
+def coordinator ():
+    from .distributed import Coordinator
+
+    logger = Logger (consumer=[DatetimeConsumer (), JsonPrintConsumer ()])
+
+    parser = argparse.ArgumentParser(description='Hand out URLs to crocoite-worker.')
+    parser.add_argument('--policy', help='Recursion policy', metavar='POLICY')
+    parser.add_argument('--scope', help='Limit recursion to allow/deny rules in FILE', metavar='FILE')
+    parser.add_argument('--bind', help='Listen address', metavar='HOST:PORT', default=('localhost', 8765), type=parseAddress)
+    parser.add_argument('--lease-timeout', help='Revoke lease if worker is silent for SEC', metavar='SEC', default=5*60, type=int, dest='leaseTimeout')
+    parser.add_argument('--retries', help='Fetch each URL at most N times', metavar='N', default=3, type=int)
+    parser.add_argument('--retry-backoff', help='Wait SEC before the first retry, doubled for every further attempt', metavar='SEC', default=30, type=int, dest='retryBackoff')
+    parser.add_argument('url', help='Seed URL', metavar='URL')
+
+    args = parser.parse_args ()
+    try:
+        policy = parsePolicy (args.policy, args.url, args.scope)
+    except ValueError as e:
+        parser.error ('Invalid argument for --policy or --scope: {}'.format (e))
+    except OSError as e:
+        parser.error ('Cannot read scope file: {}'.format (e))
+
+    host, port = args.bind
+    controller = Coordinator (url=args.url, logger=logger, policy=policy,
+            host=host, port=port, leaseTimeout=args.leaseTimeout,
+            retry=RetryQueue (maxAttempts=args.retries, backoff=args.retryBackoff))
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(controller.run ())
+    loop.close()
+
+def worker ():
+    from .distributed import Worker
+
+    logger = Logger (consumer=[DatetimeConsumer (), JsonPrintConsumer ()])
+
+    parser = argparse.ArgumentParser(description='Run crocoite-grab for URLs leased from crocoite-coordinator.')
+    parser.add_argument('--tempdir', help='Directory for temporary files', metavar='DIR')
+    parser.add_argument('--prefix', help='Output filename prefix, supports templates {host} and {date}', metavar='FILENAME', default='{host}-{date}-')
+    parser.add_argument('--concurrency', '-j', help='Run at most N jobs', metavar='N', default=1, type=int)
+    parser.add_argument('--fetch-timeout', help='Kill fetch command after SEC', metavar='SEC', type=int, dest='fetchTimeout')
+    parser.add_argument('coordinator', help='Coordinator address', metavar='HOST:PORT', type=parseAddress)
+    parser.add_argument('output', help='Output directory', metavar='DIR')
+    parser.add_argument('command', help='Fetch command, supports templates {url} and {dest}', metavar='CMD', nargs='*', default=['crocoite-grab', '{url}', '{dest}'])
+
+    args = parser.parse_args ()
 
     os.makedirs (args.output, exist_ok=True)
 
-    controller = RecursiveController (url=args.url, output=args.output,
-            command=args.command, logger=logger, policy=policy,
-            tempdir=args.tempdir, prefix=args.prefix,
-            concurrency=args.concurrency)
+    controller = Worker (coordinator=args.coordinator, output=args.output,
+            command=args.command, logger=logger, tempdir=args.tempdir,
+            prefix=args.prefix, concurrency=args.concurrency,
+            fetchTimeout=args.fetchTimeout)
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(controller.run ())
@@ -131,6 +429,7 @@ def irc ():
             tempdir=s.get ('tempdir'),
             destdir=s.get ('destdir'),
             processLimit=s.getint ('process_limit'),
+            maxConcurrency=s.getint ('max_concurrency', fallback=4),
             logger=logger)
     bot.loop.create_task(bot.connect())
     bot.loop.run_forever()
@@ -23,16 +23,33 @@ Controller classes, handling actions required for archival
 """
 
 class ControllerSettings:
-    __slots__ = ('maxBodySize', 'idleTimeout', 'timeout')
-
-    def __init__ (self, maxBodySize=50*1024*1024, idleTimeout=2, timeout=10):
+    __slots__ = ('maxBodySize', 'idleTimeout', 'timeout', 'crashRecovery',
+            'maxReloads', 'blocklist', 'intercept')
+
+    # what to do if the browser crashes: re-raise BrowserCrashed, keep what
+    # we have or load the page again in a new tab
+    crashRecoveryModes = ('abort', 'partial', 'reload')
+
+    def __init__ (self, maxBodySize=50*1024*1024, idleTimeout=2, timeout=10,
+            crashRecovery='partial', maxReloads=1, blocklist=[],
+            intercept=False):
+        if crashRecovery not in self.crashRecoveryModes:
+            raise ValueError ('Unsupported crash recovery {}'.format (crashRecovery))
         self.maxBodySize = maxBodySize
         self.idleTimeout = idleTimeout
         self.timeout = timeout
+        self.crashRecovery = crashRecovery
+        self.maxReloads = maxReloads
+        # url patterns, see browser.parseBlocklist
+        self.blocklist = blocklist
+        # record bodies using the Fetch domain, see SiteLoader
+        self.intercept = intercept
 
     def toDict (self):
         return dict (maxBodySize=self.maxBodySize,
-                idleTimeout=self.idleTimeout, timeout=self.timeout)
+                idleTimeout=self.idleTimeout, timeout=self.timeout,
+                crashRecovery=self.crashRecovery, maxReloads=self.maxReloads,
+                blocklist=list (self.blocklist), intercept=self.intercept)
 
 defaultSettings = ControllerSettings ()
 
@@ -49,6 +66,14 @@ class EventHandler:
         raise NotImplementedError ()
 
 from .browser import BrowserCrashed
+from .behavior import BehaviorProfile
+
+def addBehaviorStats (dest, src):
+    """ Add per-behavior statistics src to dest """
+    for name, stats in src.items ():
+        d = dest.setdefault (name, {})
+        for k, v in stats.items ():
+            d[k] = d.get (k, 0) + v
 
 class StatsHandler (EventHandler):
     __slots__ = ('stats')
@@ -56,18 +81,26 @@ class StatsHandler (EventHandler):
     acceptException = True
 
     def __init__ (self):
-        self.stats = {'requests': 0, 'finished': 0, 'failed': 0, 'bytesRcv': 0, 'crashed': 0}
+        # behavior name -> BehaviorProfile.toDict (), summed up
+        self.stats = {'requests': 0, 'finished': 0, 'failed': 0, 'bytesRcv': 0,
+                'crashed': 0, 'blocked': 0, 'orphaned': 0, 'behavior': {}}
 
     def push (self, item):
         if isinstance (item, Item):
             self.stats['requests'] += 1
-            if item.failed:
+            if item.blocked:
+                self.stats['blocked'] += 1
+            elif item.orphaned:
+                self.stats['orphaned'] += 1
+            elif item.failed:
                 self.stats['failed'] += 1
             else:
                 self.stats['finished'] += 1
                 self.stats['bytesRcv'] += item.encodedDataLength
         elif isinstance (item, BrowserCrashed):
             self.stats['crashed'] += 1
+        elif isinstance (item, BehaviorProfile):
+            addBehaviorStats (self.stats['behavior'], {item.name: item.toDict ()})
 
 from .behavior import ExtractLinksEvent
 from itertools import islice
@@ -82,15 +115,27 @@ class LogHandler (EventHandler):
 
     def push (self, item):
         if isinstance (item, ExtractLinksEvent):
-            # limit number of links per message, so json blob won’t get too big
-            it = iter (item.links)
-            limit = 100
-            while True:
-                limitlinks = list (islice (it, 0, limit))
-                if not limitlinks:
-                    break
-                self.logger.info ('extracted links', context=type (item).__name__,
-                        uuid='8ee5e9c9-1130-4c5c-88ff-718508546e0c', links=limitlinks)
+            # RecursiveController follows links only, resources are logged
+            # separately
+            self._logLinks (item, 'extracted links', 'links', item.links,
+                    '8ee5e9c9-1130-4c5c-88ff-718508546e0c')
+            self._logLinks (item, 'extracted resources', 'resources',
+                    item.resources, '6bb6549d-e20b-4ea6-9e1a-36c86067730a')
+        elif isinstance (item, BehaviorProfile):
+            self.logger.info ('behavior profile', context=type (item).__name__,
+                    uuid='de4ce4ca-149f-4b5d-b089-8f4fc169a67a', behavior=item.name,
+                    method=item.method, **item.toDict ())
+
+    def _logLinks (self, item, message, key, links, uuid):
+        # limit number of links per message, so json blob won’t get too big
+        it = iter (links)
+        limit = 100
+        while True:
+            limitlinks = list (islice (it, 0, limit))
+            if not limitlinks:
+                break
+            self.logger.info (message, context=type (item).__name__,
+                    uuid=uuid, **{key: limitlinks})
 
 import time, platform
 
@@ -112,11 +157,12 @@ class SinglePageController:
     (stats, warc writer).
     """
 
-    __slots__ = ('url', 'output', 'service', 'behavior', 'settings', 'logger', 'handler')
+    __slots__ = ('url', 'output', 'service', 'behavior', 'settings', 'logger',
+            'handler', 'isolate')
 
     def __init__ (self, url, output, logger, \
             service=ChromeService (), behavior=cbehavior.available, \
-            settings=defaultSettings, handler=[]):
+            settings=defaultSettings, handler=[], isolate=False):
         self.url = url
         self.output = output
         self.service = service
@@ -124,24 +170,43 @@ class SinglePageController:
         self.settings = settings
         self.logger = logger.bind (context=type (self).__name__, url=url)
         self.handler = handler
+        # use a separate browser context, see SiteLoader
+        self.isolate = isolate
 
     def processItem (self, item):
         if isinstance (item, Exception):
             for h in self.handler:
                 if h.acceptException:
                     h.push (item)
-            raise item
+            if not isinstance (item, BrowserCrashed) or \
+                    self.settings.crashRecovery == 'abort':
+                raise item
+            return
 
         for h in self.handler:
             h.push (item)
 
     def run (self):
+        """
+        Returns True if the page was captured completely, False if the
+        browser crashed and we kept partial results only.
+        """
         logger = self.logger
+        def behaviorFinished ():
+            """
+            Behavior able to tell are done and all requests finished, no need
+            to wait for the idle timeout
+            """
+            finished = [b.finished for b in enabledBehavior if b.finished is not None]
+            return finished and all (finished) and len (l) == 0
+
         def processQueue ():
+            """ Returns False if the browser crashed """
             # XXX: this is very ugly code and does not work well. figure out a
             # better way to impose timeouts and still process all items in the
             # queue
             queue = l.queue
+            crashed = False
             logger.debug ('process queue',
                     uuid='dafbf76b-a37e-44db-a021-efb5593b81f8',
                     queuelen=len (queue))
@@ -155,6 +220,11 @@ class SinglePageController:
                 # skip waiting if there is work to do. processes all items in
                 # queue, regardless of timeouts, i.e. you need to make sure the
                 # queue will actually be empty at some point.
+                if len (queue) == 0 and behaviorFinished ():
+                    logger.debug ('behavior finished',
+                            uuid='07718ad6-c94b-4c0e-a59d-2ced434b2306',
+                            elapsed=elapsed)
+                    break
                 if len (queue) == 0:
                     if not l.notify.wait (maxTimeout):
                         assert len (queue) == 0, "event must be sent"
@@ -170,17 +240,48 @@ class SinglePageController:
                 # loads a lot of items.
                 for i in range (1000):
                     try:
-                        item = queue.popleft ()
+                        item = l.popleft ()
                         logger.debug ('queue pop',
                                 uuid='adc96bfa-026d-4092-b732-4a022a1a92ca',
                                 item=item, queuelen=len (queue))
                     except IndexError:
                         break
                     self.processItem (item)
-                if maxTimeout == 0:
+                    if isinstance (item, BrowserCrashed):
+                        # no more events will arrive from this tab
+                        crashed = True
+                if maxTimeout == 0 or crashed:
                     break
+            return not crashed
+
+        def runBehavior (method, process=True):
+            """ Returns False if the browser crashed """
+            for item in runtime.run (method):
+                if process:
+                    self.processItem (item)
+            return not l.crashed.is_set ()
+
+        def capture (reload):
+            # scripts are in the WARC already if we are reloading
+            if not runBehavior ('onload', process=not reload):
+                return False
+            l.start ()
 
-        with self.service as browser, SiteLoader (browser, self.url, logger=logger) as l:
+            for method in ('onstop', 'onfinish'):
+                # if we stopped due to timeout, wait for remaining assets
+                if not processQueue () or not runBehavior (method):
+                    return False
+            return processQueue ()
+
+        def processOrphans ():
+            """ Account for requests that will never finish """
+            for item in l.expire ():
+                self.processItem (item)
+
+        with self.service as browser, SiteLoader (browser, self.url, logger=logger,
+                isolate=self.isolate, blocklist=self.settings.blocklist,
+                intercept=self.settings.intercept,
+                maxBodySize=self.settings.maxBodySize) as l:
             start = time.time ()
 
             version = l.tab.Browser.getVersion ()
@@ -202,32 +303,95 @@ class SinglePageController:
                     }
             self.processItem (ControllerStart (payload))
 
-            # not all behavior scripts are allowed for every URL, filter them
+            # not all behavior scripts are allowed for every URL, filter them.
+            # I decided against using the queue for their items to limit
+            # memory usage (screenshot behavior would put all images into
+            # queue before we could process them)
             enabledBehavior = list (filter (lambda x: self.url in x,
                     map (lambda x: x (l, logger), self.behavior)))
+            runtime = cbehavior.BehaviorRuntime (l, logger, enabledBehavior)
+
+            reloads = 0
+            while not capture (reloads > 0):
+                # everything received before the crash has been written
+                # at this point
+                if self.settings.crashRecovery != 'reload' or \
+                        reloads >= self.settings.maxReloads:
+                    logger.warning ('keeping partial results',
+                            uuid='0e18d63a-32e2-446b-9f36-3ba65ecebd10',
+                            reloads=reloads)
+                    processOrphans ()
+                    return False
+                reloads += 1
+                logger.info ('reloading after crash',
+                        uuid='9e2e170a-36d7-452e-83eb-2eba511e3c7b',
+                        reloads=reloads)
+                l.reload ()
+                # the new tab deserves the full time budget
+                start = time.time ()
+            processOrphans ()
+            return True
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Semaphore
+from .browser import NullService
+
+class BatchController:
+    """
+    Archive many single pages concurrently, sharing one browser instance.
 
-            for b in enabledBehavior:
-                # I decided against using the queue here to limit memory
-                # usage (screenshot behavior would put all images into
-                # queue before we could process them)
-                for item in b.onload ():
-                    self.processItem (item)
-            l.start ()
-
-            processQueue ()
-
-            for b in enabledBehavior:
-                for item in b.onstop ():
-                    self.processItem (item)
+    Every page is loaded into its own browser context, so cookies and cache do
+    not leak between them. urls may be any iterable (a file, for instance) and
+    is consumed lazily. For each url open (url) must return a context manager
+    yielding the page’s logger and list of handlers.
+    """
 
-            # if we stopped due to timeout, wait for remaining assets
-            processQueue ()
+    __slots__ = ('urls', 'open', 'logger', 'service', 'behavior', 'settings',
+            'concurrency', 'results')
 
-            for b in enabledBehavior:
-                for item in b.onfinish ():
-                    self.processItem (item)
+    def __init__ (self, urls, open, logger, service=ChromeService (),
+            behavior=cbehavior.available, settings=defaultSettings,
+            concurrency=4):
+        self.urls = urls
+        self.open = open
+        self.logger = logger.bind (context=type (self).__name__)
+        self.service = service
+        self.behavior = behavior
+        self.settings = settings
+        self.concurrency = concurrency
+        # url → True (complete), False (partial) or None (failed)
+        self.results = {}
+
+    def capture (self, browser, url):
+        logger = self.logger.bind (url=url)
+        logger.info ('capture', uuid='218cf989-54ed-49e8-bf3f-9ae232c6fe57')
+        result = None
+        try:
+            with self.open (url) as (pageLogger, handler):
+                controller = SinglePageController (url, None, pageLogger,
+                        service=NullService (browser), behavior=self.behavior,
+                        settings=self.settings, handler=handler, isolate=True)
+                result = controller.run ()
+        except Exception as e:
+            # do not take down the other pages
+            logger.error ('capture failed', uuid='5843c734-483c-4495-ad46-1fec9a135391',
+                    exception=repr (e))
+        self.results[url] = result
+        return result
 
-            processQueue ()
+    def run (self):
+        """ Returns True if all pages were captured completely """
+        slots = Semaphore (self.concurrency)
+        with self.service as browser, \
+                ThreadPoolExecutor (max_workers=self.concurrency) as executor:
+            self.logger.info ('browser started', uuid='0d50768a-0145-4c19-89ec-93658da6de67',
+                    startupTime=self.service.startupTime)
+            for url in self.urls:
+                # do not read ahead, urls may be infinite
+                slots.acquire ()
+                future = executor.submit (self.capture, browser, url)
+                future.add_done_callback (lambda f: slots.release ())
+        return all (self.results.values ())
 
 class RecursionPolicy:
     """ Abstract recursion policy """
@@ -278,26 +442,339 @@ class PrefixLimit (RecursionPolicy):
     def __call__ (self, urls):
         return set (filter (lambda u: u.startswith (self.prefix), urls))
 
+class CombinedPolicy (RecursionPolicy):
+    """
+    Apply multiple policies in order, i.e. an url must be accepted by all of
+    them
+
+    Policies with state (DepthLimit) should come first, so they see every
+    batch of urls.
+    """
+
+    __slots__ = ('policies')
+
+    def __init__ (self, *policies):
+        self.policies = policies
+
+    def __call__ (self, urls):
+        for p in self.policies:
+            urls = p (urls)
+            if not urls:
+                break
+        return set (urls)
+
+    def __repr__ (self):
+        return '<CombinedPolicy {}>'.format (', '.join (map (repr, self.policies)))
+
+class _Trie:
+    """
+    Minimal trie over arbitrary sequences of hashable keys. Only answers the
+    question “is any inserted sequence a prefix of the query?”.
+    """
+
+    __slots__ = ('root')
+
+    # marks the end of an inserted sequence. The empty tuple never occurs as
+    # label or character.
+    END = ()
+
+    def __init__ (self):
+        self.root = {}
+
+    def __bool__ (self):
+        return bool (self.root)
+
+    def add (self, seq):
+        node = self.root
+        for k in seq:
+            node = node.setdefault (k, {})
+        node[self.END] = True
+
+    def hasPrefixOf (self, seq):
+        node = self.root
+        end = self.END
+        if end in node:
+            return True
+        for k in seq:
+            node = node.get (k)
+            if node is None:
+                return False
+            if end in node:
+                return True
+        return False
+
+import re
+from urllib.parse import urlsplit
+
+class ScopeLimit (RecursionPolicy):
+    """
+    Limit recursion by a set of allow/deny rules
+
+    Each rule is one of
+
+    prefix <url>
+        url starts with <url>
+    host <hostname>
+        url’s hostname is <hostname> or a subdomain of it
+    regex <expression>
+        Python regular expression matches anywhere in the url (use ^ to
+        anchor)
+
+    prefixed by + (allow) or - (deny). Deny rules always win. If there are
+    no allow rules at all, every url not denied is accepted.
+
+    Rules are compiled into a host trie (reversed labels), a prefix trie
+    (characters) and a single alternation regex for each action, so checking
+    an url does not depend on the number of rules. Expressions with groups
+    (backreferences, named groups) or global flags cannot be joined and are
+    checked individually.
+    """
+
+    __slots__ = ('rules', 'hosts', 'prefixes', 'regex')
+
+    kinds = ('prefix', 'host', 'regex')
+    # flags of an expression without inline global flags
+    _defaultFlags = re.compile ('').flags
+
+    def __init__ (self, rules):
+        """ rules is an iterable of (allow, kind, value) tuples """
+        self.rules = list (rules)
+        # index 0 is deny, 1 allow
+        self.hosts = (_Trie (), _Trie ())
+        self.prefixes = (_Trie (), _Trie ())
+        # joinable expressions, compiled expressions
+        regex = (([], []), ([], []))
+        for allow, kind, value in self.rules:
+            allow = int (bool (allow))
+            if kind == 'prefix':
+                self.prefixes[allow].add (value)
+            elif kind == 'host':
+                self.hosts[allow].add (self._hostLabels (value))
+            elif kind == 'regex':
+                # compile individually first, so errors point to the culprit
+                try:
+                    compiled = re.compile (value)
+                except re.error as e:
+                    raise ValueError ('Invalid regex {}: {}'.format (value, e))
+                joinable, separate = regex[allow]
+                if compiled.groups == 0 and compiled.flags == self._defaultFlags:
+                    joinable.append ('(?:{})'.format (value))
+                else:
+                    separate.append (compiled)
+            else:
+                raise ValueError ('Unsupported rule {}'.format (kind))
+        self.regex = tuple (map (self._joinRegex, regex))
+
+    def __repr__ (self):
+        return '<ScopeLimit {} rules>'.format (len (self.rules))
+
+    @staticmethod
+    def _joinRegex (regex):
+        joinable, separate = regex
+        if joinable:
+            return [re.compile ('|'.join (joinable))] + separate
+        return separate
+
+    @staticmethod
+    def _hostLabels (hostname):
+        return hostname.strip ('.').lower ().split ('.')[::-1]
+
+    @classmethod
+    def fromFile (cls, fd):
+        """
+        Read rules from file object, one per line. Empty lines and lines
+        starting with # are ignored.
+        """
+        rules = []
+        for lineno, line in enumerate (fd, start=1):
+            line = line.strip ()
+            if not line or line.startswith ('#'):
+                continue
+            try:
+                kind, value = line.split (maxsplit=1)
+            except ValueError:
+                raise ValueError ('Invalid rule in line {}: {}'.format (lineno, line))
+            action, kind = kind[0], kind[1:]
+            if action not in '+-' or kind not in cls.kinds:
+                raise ValueError ('Invalid rule in line {}: {}'.format (lineno, line))
+            rules.append ((action == '+', kind, value))
+        return cls (rules)
+
+    def _match (self, allow, url, hostLabels):
+        regex = self.regex[allow]
+        return self.hosts[allow].hasPrefixOf (hostLabels) or \
+                self.prefixes[allow].hasPrefixOf (url) or \
+                any (r.search (url) is not None for r in regex)
+
+    def __call__ (self, urls):
+        haveAllow = self.hosts[1] or self.prefixes[1] or self.regex[1]
+        # links extracted from a single page usually share a handful of
+        # hosts, avoid splitting and reversing them again and again
+        hostCache = {}
+        ret = set ()
+        for u in urls:
+            hostname = urlsplit (u).hostname or ''
+            labels = hostCache.get (hostname)
+            if labels is None:
+                labels = hostCache[hostname] = self._hostLabels (hostname)
+            if self._match (0, u, labels):
+                continue
+            if not haveAllow or self._match (1, u, labels):
+                ret.add (u)
+        return ret
+
 import tempfile, asyncio, json, os
 from datetime import datetime
 from urllib.parse import urlparse
 from .behavior import ExtractLinksEvent
 from .util import removeFragment
 
+from .util import getMemoryInfo, getProcessTreeRss
+
+class AdaptiveConcurrency:
+    """
+    Scale the number of concurrent fetches between minimum and maximum
+    based on memory and CPU pressure
+
+    Starts with minimum and adds one fetch at a time, as long as there is
+    enough free memory for another worker (judging by the current workers’
+    resident set size) and the load per CPU is below maxLoad. Removes one
+    if either is exceeded.
+    """
+
+    __slots__ = ('minimum', 'maximum', 'interval', 'minFreeMemory',
+            'maxLoad', 'current', 'lastUpdate')
+
+    def __init__ (self, minimum=1, maximum=4, interval=5, minFreeMemory=0.1,
+            maxLoad=1.0):
+        if minimum < 1 or maximum < minimum:
+            raise ValueError ('Invalid bounds')
+        self.minimum = minimum
+        self.maximum = maximum
+        # seconds between adjustments
+        self.interval = interval
+        # fraction of total memory that must stay available
+        self.minFreeMemory = minFreeMemory
+        # 1 min load average per CPU
+        self.maxLoad = maxLoad
+        self.current = minimum
+        self.lastUpdate = None
+
+    def __repr__ (self):
+        return '<AdaptiveConcurrency {}≤{}≤{}>'.format (self.minimum,
+                self.current, self.maximum)
+
+    def adjust (self, running, memAvailable, memTotal, load, rss):
+        """
+        Compute new limit from current measurements. Values may be None, if
+        they cannot be measured.
+        """
+        overloaded = load is not None and load > self.maxLoad
+        if memAvailable is not None:
+            reserve = memTotal*self.minFreeMemory
+            overloaded = overloaded or memAvailable < reserve
+            # assume a new worker needs as much as the average one
+            perWorker = rss/running if rss and running else 0
+            roomLeft = memAvailable - perWorker > reserve
+        else:
+            roomLeft = True
+        # load average is slow to react, leave some headroom
+        idle = load is None or load < self.maxLoad*0.8
+
+        if overloaded:
+            self.current = max (self.current-1, self.minimum)
+        elif roomLeft and idle and running >= self.current:
+            # only grow if we are actually using the capacity we have
+            self.current = min (self.current+1, self.maximum)
+        return self.current
+
+    def __call__ (self, pids):
+        """ Get concurrency limit, given the pids of running fetches """
+        now = time.monotonic ()
+        if self.lastUpdate is not None and now - self.lastUpdate < self.interval:
+            return self.current
+        self.lastUpdate = now
+
+        mem = getMemoryInfo ()
+        memAvailable, memTotal = mem if mem else (None, None)
+        try:
+            load = os.getloadavg ()[0]/(os.cpu_count () or 1)
+        except OSError:
+            load = None
+        return self.adjust (len (pids), memAvailable, memTotal, load,
+                getProcessTreeRss (pids))
+
+import heapq
+
+class RetryQueue:
+    """
+    Delay failed fetches with exponential backoff, up to maxAttempts per URL
+    """
+
+    __slots__ = ('maxAttempts', 'backoff', 'maxBackoff', 'attempts', 'delayed')
+
+    def __init__ (self, maxAttempts=3, backoff=30, maxBackoff=30*60):
+        self.maxAttempts = maxAttempts
+        # seconds before first retry, doubles with every attempt
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        # url -> number of failed attempts
+        self.attempts = {}
+        # heap of (due time, url)
+        self.delayed = []
+
+    def __len__ (self):
+        return len (self.delayed)
+
+    def failed (self, url, now=None):
+        """
+        Record failed attempt. Returns the delay until url is due again or
+        None if we gave up.
+        """
+        if now is None:
+            now = time.monotonic ()
+        attempts = self.attempts[url] = self.attempts.get (url, 0) + 1
+        if attempts >= self.maxAttempts:
+            return None
+        delay = min (self.backoff * 2**(attempts-1), self.maxBackoff)
+        heapq.heappush (self.delayed, (now+delay, url))
+        return delay
+
+    def ready (self, now=None):
+        """ Pop all urls due for another attempt """
+        if now is None:
+            now = time.monotonic ()
+        ret = []
+        while self.delayed and self.delayed[0][0] <= now:
+            ret.append (heapq.heappop (self.delayed)[1])
+        return ret
+
+    def nextDue (self, now=None):
+        """ Seconds until the next url is due or None """
+        if not self.delayed:
+            return None
+        if now is None:
+            now = time.monotonic ()
+        return max (self.delayed[0][0] - now, 0)
+
 class RecursiveController:
     """
     Simple recursive controller
 
-    Visits links acording to policy
+    Visits links acording to policy. Failed fetches (crashed browser,
+    non-zero exit status or fetchTimeout exceeded) are retried according to
+    retry.
     """
 
     __slots__ = ('url', 'output', 'command', 'logger', 'policy', 'have',
-            'pending', 'stats', 'prefix', 'tempdir', 'running', 'concurrency')
+            'pending', 'stats', 'prefix', 'tempdir', 'running', 'concurrency',
+            'autoscale', 'processes', 'retry', 'fetchTimeout')
 
     SCHEME_WHITELIST = {'http', 'https'}
 
     def __init__ (self, url, output, command, logger, prefix='{host}-{date}-',
-            tempdir=None, policy=DepthLimit (0), concurrency=1):
+            tempdir=None, policy=DepthLimit (0), concurrency=1, autoscale=None,
+            retry=None, fetchTimeout=None):
         self.url = url
         self.output = output
         self.command = command
@@ -307,16 +784,26 @@ class RecursiveController:
         self.tempdir = tempdir
         # tasks currently running
         self.running = set ()
+        # pids of fetch commands running
+        self.processes = set ()
+        # AdaptiveConcurrency instance or None
+        self.autoscale = autoscale
         # max number of tasks running
-        self.concurrency = concurrency
+        self.concurrency = concurrency if autoscale is None else autoscale.current
+        self.retry = retry if retry is not None else RetryQueue ()
+        # kill fetch command after this many seconds
+        self.fetchTimeout = fetchTimeout
         # keep in sync with StatsHandler
-        self.stats = {'requests': 0, 'finished': 0, 'failed': 0, 'bytesRcv': 0, 'crashed': 0, 'ignored': 0}
+        self.stats = {'requests': 0, 'finished': 0, 'failed': 0, 'bytesRcv': 0,
+                'crashed': 0, 'blocked': 0, 'orphaned': 0, 'ignored': 0,
+                'timedOut': 0, 'retried': 0, 'abandoned': 0, 'behavior': {}}
 
     async def fetch (self, url):
         """
         Fetch a single URL using an external command
 
-        command is usually crocoite-grab
+        command is usually crocoite-grab. Returns None on success or the reason
+        for failure: crashed, timeout or exit.
         """
 
         def formatCommand (e):
@@ -340,41 +827,126 @@ class RecursiveController:
         logger.info ('fetch', uuid='1680f384-744c-4b8a-815b-7346e632e8db', command=command)
         process = await asyncio.create_subprocess_exec (*command, stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.DEVNULL, stdin=asyncio.subprocess.DEVNULL)
-        while True:
-            data = await process.stdout.readline ()
-            if not data:
-                break
-            data = json.loads (data)
-            uuid = data.get ('uuid')
-            if uuid == '8ee5e9c9-1130-4c5c-88ff-718508546e0c':
-                links = set (self.policy (map (removeFragment, data.get ('links', []))))
-                links.difference_update (self.have)
-                self.pending.update (links)
-            elif uuid == '24d92d16-770e-4088-b769-4020e127a7ff':
-                for k in self.stats.keys ():
-                    self.stats[k] += data.get (k, 0)
-                logger.info ('stats', uuid='24d92d16-770e-4088-b769-4020e127a7ff', **self.stats)
-        code = await process.wait()
-        # atomically move once finished
+        self.processes.add (process.pid)
+        deadline = None if self.fetchTimeout is None else time.monotonic () + self.fetchTimeout
+        reason = None
+        crashed = False
+        try:
+            while True:
+                try:
+                    timeout = None if deadline is None else max (deadline - time.monotonic (), 0)
+                    data = await asyncio.wait_for (process.stdout.readline (), timeout)
+                except asyncio.TimeoutError:
+                    logger.error ('fetch timeout',
+                            uuid='340e0314-b5e5-48b2-9f17-31e3bcf95c59',
+                            timeout=self.fetchTimeout)
+                    self.stats['timedOut'] += 1
+                    reason = 'timeout'
+                    # give it a chance to shut down the browser
+                    process.terminate ()
+                    try:
+                        await asyncio.wait_for (process.wait (), 10)
+                    except asyncio.TimeoutError:
+                        process.kill ()
+                    break
+                if not data:
+                    break
+                data = json.loads (data)
+                uuid = data.get ('uuid')
+                if uuid == '8ee5e9c9-1130-4c5c-88ff-718508546e0c':
+                    self.addLinks (map (removeFragment, data.get ('links', [])))
+                elif uuid == '24d92d16-770e-4088-b769-4020e127a7ff':
+                    crashed = data.get ('crashed', 0) > 0
+                    self.addStats (data)
+                    logger.info ('stats', uuid='24d92d16-770e-4088-b769-4020e127a7ff', **self.stats)
+            code = await process.wait()
+        finally:
+            self.processes.discard (process.pid)
+        # the grab may have recovered from a crash, so its exit status decides
+        if code != 0 and reason is None:
+            reason = 'crashed' if crashed else 'exit'
+        # atomically move once finished. Keep partial results of failed
+        # fetches too, they may contain resources not available any more.
         os.rename (dest.name, destpath)
+        return reason
+
+    async def fetchRetry (self, url):
+        """ Fetch url, schedule retry if it fails """
+        reason = await self.fetch (url)
+        if reason is not None:
+            self.failed (url, reason)
+
+    def failed (self, url, reason):
+        delay = self.retry.failed (url)
+        if delay is None:
+            self.stats['abandoned'] += 1
+            self.logger.error ('fetch failed, giving up',
+                    uuid='71e64046-c0a4-48b5-a90d-ab80313e22cf', url=url,
+                    reason=reason, attempts=self.retry.attempts[url])
+        else:
+            self.stats['retried'] += 1
+            self.logger.warning ('fetch failed, retrying',
+                    uuid='1c95d692-0b8e-4e17-b55e-422757c6dd10', url=url,
+                    reason=reason, attempts=self.retry.attempts[url], delay=delay)
+
+    def requeue (self):
+        """ Move retries that are due back to pending """
+        self.pending.update (self.retry.ready ())
+
+    def addLinks (self, links):
+        """ Links extracted by the fetch command """
+        links = set (self.policy (links))
+        links.difference_update (self.have)
+        self.pending.update (links)
+
+    def addStats (self, stats):
+        """ Final statistics reported by the fetch command """
+        for k in self.stats.keys ():
+            if k == 'behavior':
+                addBehaviorStats (self.stats[k], stats.get (k, {}))
+            else:
+                self.stats[k] += stats.get (k, 0)
+
+    def updateConcurrency (self):
+        if self.autoscale is None:
+            return
+        concurrency = self.autoscale (self.processes)
+        if concurrency != self.concurrency:
+            self.logger.info ('concurrency changed',
+                    uuid='d5a066b7-c864-4ee0-a417-fde5ae57c333',
+                    old=self.concurrency, new=concurrency)
+            self.concurrency = concurrency
 
     async def run (self):
         self.have = set ()
         self.pending = set ([self.url])
 
-        while self.pending:
-            self.logger.info ('recursing',
-                    uuid='5b8498e4-868d-413c-a67e-004516b8452c',
-                    pending=len (self.pending), have=len (self.have),
-                    running=len (self.running))
-
-            # since pending is a set this picks a random item, which is fine
-            u = self.pending.pop ()
-            self.have.add (u)
-            t = asyncio.ensure_future (self.fetch (u))
-            self.running.add (t)
-            if len (self.running) >= self.concurrency or not self.pending:
+        while self.pending or self.running or self.retry:
+            self.requeue ()
+            if self.pending and len (self.running) < self.concurrency:
+                self.logger.info ('recursing',
+                        uuid='5b8498e4-868d-413c-a67e-004516b8452c',
+                        pending=len (self.pending), have=len (self.have),
+                        running=len (self.running))
+
+                # since pending is a set this picks a random item, which is fine
+                u = self.pending.pop ()
+                self.have.add (u)
+                self.running.add (asyncio.ensure_future (self.fetchRetry (u)))
+                continue
+
+            # wake up for the next retry and re-check the limit periodically
+            # when scaling automatically
+            timeouts = [self.retry.nextDue ()]
+            if self.autoscale is not None:
+                timeouts.append (self.autoscale.interval)
+            timeouts = list (filter (lambda x: x is not None, timeouts))
+            timeout = min (timeouts) if timeouts else None
+            if self.running:
+                # running fetches may add new pending items, wait for them
                 done, pending = await asyncio.wait (self.running,
-                        return_when=asyncio.FIRST_COMPLETED)
+                        timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
                 self.running.difference_update (done)
-
+                self.updateConcurrency ()
+            else:
+                await asyncio.sleep (timeout)
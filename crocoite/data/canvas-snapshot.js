@@ -1,18 +1,40 @@
-/*	Replace canvas with image snapshot
+/*	Replace canvas with image snapshot. Returns [url, data URL] of each
+ *	snapshot, the image itself points to url, which is path prefix followed by
+ *	a counter, resolved against the page’s location. Replay can only look up
+ *	http(s) URLs, so other pages keep the inline data URL.
  */
-(function(){
-	var canvas = document.querySelectorAll ("canvas"); 
-	for (var i = 0; i < canvas.length; i++) { 
+(function(prefix){
+	var ret = [];
+	var resolvable = document.location.protocol == 'http:' ||
+			document.location.protocol == 'https:';
+	var canvas = document.querySelectorAll ("canvas");
+	for (var i = 0; i < canvas.length; i++) {
 		var c = canvas[i];
-		var data = c.toDataURL ();
-		var parent = c.parentNode;
+		var data;
+		try {
+			data = c.toDataURL ();
+		} catch (e) {
+			/* tainted by cross-origin data */
+			continue;
+		}
+		if (data == 'data:,') {
+			/* empty canvas */
+			continue;
+		}
 		var img = document.createElement ('img');
 		/* copy all attributes */
-		for (var i = 0; i < c.attributes.length; i++) {
-			var attr = c.attributes.item(i);
+		for (var j = 0; j < c.attributes.length; j++) {
+			var attr = c.attributes.item(j);
 			img.setAttribute (attr.nodeName, attr.nodeValue);
 		}
-		img.src = data;
-		parent.replaceChild (img, c);
+		if (resolvable) {
+			var url = new URL (prefix + ret.length + '.png', document.location.href).href;
+			img.src = url;
+			ret.push ([url, data]);
+		} else {
+			img.src = data;
+		}
+		c.parentNode.replaceChild (img, c);
 	}
-}());
+	return ret;
+})
@@ -2,15 +2,24 @@
  *
  *  We can’t just click every clickable object, since there may be side-effects
  *  like navigating to a different location. Thus whitelist known elements.
+ *
+ *  New elements are found by observing DOM mutations. Every frame reports
+ *  “frame:busy” or “frame:done” (nothing left to click) through the global
+ *  function named doneBinding.
  */
 
-(function(){
+(function(doneBinding){
 const selectorFlag = Object.freeze ({
 	none: 0,
 	multi: 1, /* click item multiple times */
 });
 const defaultClickThrottle = 50; /* in ms */
+/* click elements with selectorFlag.multi again after */
 const discoverInterval = 1000; /* 1 second */
+/* delay matching selectors after DOM changes, to batch them */
+const scanDelay = 100; /* in ms */
+/* report done if nothing was clickable for */
+const quietPeriod = 2000; /* in ms */
 const sites = Object.freeze ([
 	{
 		hostname: /^www\.facebook\.com$/i,
@@ -83,6 +92,22 @@ for (let s of sites) {
 	}
 }
 
+/* frames report separately */
+const frame = Math.random ().toString (36).substr (2);
+let reported = null;
+function report (state) {
+	if (state !== reported && typeof window[doneBinding] === 'function') {
+		reported = state;
+		window[doneBinding] (frame + ':' + state);
+	}
+}
+
+/* nothing to click here, stay silent so the behavior cannot be considered
+ * done before any page-specific frame had a chance to report */
+if (selector.length == 0) {
+	return;
+}
+
 function makeClickEvent () {
 	return new MouseEvent('click', {
 				view: window,
@@ -107,10 +132,22 @@ function click () {
 			clickTimeout = window.setTimeout (click, nextTimeout);
 		} else {
 			clickTimeout = null;
+			maybeDone ();
 		}
 	}
 }
 
+function enqueue (item) {
+	queue.push (item);
+	window.clearTimeout (doneTimeout);
+	doneTimeout = null;
+	report ('busy');
+	if (clickTimeout === null) {
+		/* start clicking immediately */
+		clickTimeout = window.setTimeout (click, 0);
+	}
+}
+
 /*	Element is visible if itself and all of its parents are
  */
 function isVisible (o) {
@@ -135,25 +172,105 @@ function isClickable (o) {
 /* some sites don’t remove/replace the element immediately, so keep track of
  * which ones we already clicked */
 let have = new Set ();
-function discover () {
-	for (let s of selector) {
-		let obj = document.querySelectorAll (s.s);
-		for (let o of obj) {
-			if (!have.has (o) && isClickable (o)) {
-				queue.push ({o: o, selector: s});
-				if (!(s.flags & selectorFlag.multi)) {
-					have.add (o);
+/* elements clicked multiple times, along with their selector */
+let multi = new Map ();
+let multiTimer = null;
+function consider (o, s) {
+	if (s.flags & selectorFlag.multi) {
+		if (!multi.has (o)) {
+			multi.set (o, s);
+			if (isClickable (o)) {
+				enqueue ({o: o, selector: s});
+			}
+		}
+		if (multiTimer === null) {
+			multiTimer = window.setInterval (clickMulti, discoverInterval);
+		}
+	} else if (!have.has (o) && isClickable (o)) {
+		have.add (o);
+		enqueue ({o: o, selector: s});
+	}
+}
+
+/* multi elements stay in the document, click them periodically until they
+ * disappear or become unclickable */
+function clickMulti () {
+	for (let [o, s] of multi) {
+		if (!o.isConnected) {
+			multi.delete (o);
+		} else if (isClickable (o) && !queue.some (x => x.o === o)) {
+			enqueue ({o: o, selector: s});
+		}
+	}
+	if (multi.size == 0) {
+		window.clearInterval (multiTimer);
+		multiTimer = null;
+	}
+	maybeDone ();
+}
+
+/* subtrees added or changed since the last scan */
+let changed = new Set ([document]);
+let scanTimeout = null;
+function scan () {
+	scanTimeout = null;
+	const roots = changed;
+	changed = new Set ();
+	for (let root of roots) {
+		if (!root.isConnected) {
+			continue;
+		}
+		for (let s of selector) {
+			if (root.matches && root.matches (s.s)) {
+				consider (root, s);
+			}
+			for (let o of root.querySelectorAll (s.s)) {
+				consider (o, s);
+			}
+		}
+	}
+	maybeDone ();
+}
+
+function onMutation (mutations) {
+	for (let m of mutations) {
+		if (m.type == 'attributes') {
+			changed.add (m.target);
+		} else {
+			for (let n of m.addedNodes) {
+				if (n.nodeType == Node.ELEMENT_NODE) {
+					changed.add (n);
 				}
 			}
 		}
 	}
-	if (queue.length > 0 && clickTimeout === null) {
-		/* start clicking immediately */
-		clickTimeout = window.setTimeout (click, 0);
+	/* match batches of mutations at once */
+	if (changed.size > 0 && scanTimeout === null) {
+		scanTimeout = window.setTimeout (scan, scanDelay);
 	}
-	return true;
 }
 
-/* XXX: can we use a mutation observer instead? */
-window.setInterval (discover, discoverInterval);
-}());
+/* done if there was nothing to click for a while */
+let doneTimeout = null;
+function maybeDone () {
+	if (doneTimeout !== null) {
+		return;
+	}
+	doneTimeout = window.setTimeout (function () {
+		doneTimeout = null;
+		let clickable = false;
+		for (let o of multi.keys ()) {
+			clickable = clickable || (o.isConnected && isClickable (o));
+		}
+		if (queue.length == 0 && clickTimeout === null &&
+				scanTimeout === null && !clickable) {
+			report ('done');
+		}
+	}, quietPeriod);
+}
+
+new MutationObserver (onMutation).observe (document, {childList: true,
+		subtree: true, attributes: true,
+		attributeFilter: ['class', 'style', 'disabled', 'hidden']});
+scanTimeout = window.setTimeout (scan, 0);
+})
@@ -1,20 +1,47 @@
-/*	Extract links from a page
+/*	Extract links from a page and its same-origin frames
+ *
+ *	Returns deduplicated links, compacted by splitting off their origin:
+ *	{origins: ['http://example.com', …], links: [[originIndex, rest], …],
+ *	resources: […]}. Links are crawl targets, resources (srcset candidates)
+ *	are only needed for replay.
  */
 
 (function () {
-/* --- copy&paste from click.js --- */
-/*	Element is visible if itself and all of its parents are
+/* visibility of already checked elements */
+const visible = new Map ();
+
+/*	Element is visible if itself and all of its parents are. Frames’
+ *	documents inherit the visibility of their frame element.
  */
 function isVisible (o) {
-	if (o === null || !(o instanceof Element)) {
-		return true;
+	/* walk up to the first known ancestor, then fill in the cache going down */
+	let path = [];
+	let ret = true;
+	while (o !== null) {
+		if (visible.has (o)) {
+			ret = visible.get (o);
+			break;
+		}
+		if (o.nodeType === Node.DOCUMENT_NODE) {
+			const frame = o.defaultView ? o.defaultView.frameElement : null;
+			if (frame === null) {
+				break;
+			}
+			path.push (o);
+			o = frame;
+			continue;
+		}
+		path.push (o);
+		o = o.parentNode;
 	}
-	let style = window.getComputedStyle (o);
-	if ('parentNode' in o) {
-		return style.display !== 'none' && isVisible (o.parentNode);
-	} else {
-		return style.display !== 'none';
+	for (let i = path.length-1; i >= 0; i--) {
+		const p = path[i];
+		if (ret && p.nodeType === Node.ELEMENT_NODE) {
+			ret = p.ownerDocument.defaultView.getComputedStyle (p).display !== 'none';
+		}
+		visible.set (p, ret);
 	}
+	return ret;
 }
 
 /*	Elements are considered clickable if they are a) visible and b) not
@@ -23,14 +50,87 @@ function isVisible (o) {
 function isClickable (o) {
 	return !o.hasAttribute ('disabled') && isVisible (o);
 }
-/* --- end copy&paste */
 
-let x = document.body.querySelectorAll('a[href]');
-let ret = [];
-for (let i=0; i < x.length; i++) {
-	if (isClickable (x[i])) {
-		ret.push (x[i].href);
+const origins = [];
+const originIndex = new Map ();
+const links = [];
+const resources = [];
+/* seen urls for each result list */
+const seen = new Map ([[links, new Set ()], [resources, new Set ()]]);
+
+function add (url, list=links) {
+	const s = seen.get (list);
+	if (s.has (url)) {
+		return;
+	}
+	s.add (url);
+	let origin = '';
+	try {
+		origin = new URL (url).origin;
+	} catch (e) {
+		/* invalid URL, keep it as is */
+	}
+	if (origin === 'null' || !url.startsWith (origin)) {
+		origin = '';
+	}
+	let i = originIndex.get (origin);
+	if (i === undefined) {
+		i = origins.length;
+		origins.push (origin);
+		originIndex.set (origin, i);
+	}
+	list.push ([i, url.substring (origin.length)]);
+}
+
+/*	Candidate URLs of a srcset attribute, resolved against the document
+ */
+function addSrcset (o) {
+	for (let candidate of o.getAttribute ('srcset').split (',')) {
+		const url = candidate.trim ().split (/\s+/)[0];
+		if (url) {
+			try {
+				add (new URL (url, o.baseURI).href, resources);
+			} catch (e) {
+				/* ignore invalid URLs */
+			}
+		}
+	}
+}
+
+function extract (doc) {
+	for (let o of doc.querySelectorAll ('a[href]')) {
+		if (isClickable (o)) {
+			add (o.href);
+		}
+	}
+	/* <area> itself is never rendered, use its <map> instead */
+	for (let o of doc.querySelectorAll ('area[href]')) {
+		if (!o.hasAttribute ('disabled') && isVisible (o.parentNode)) {
+			add (o.href);
+		}
+	}
+	for (let o of doc.querySelectorAll ('link[rel~="next" i][href]')) {
+		add (o.href);
+	}
+	/* alternative image sources are needed for replay, even if hidden */
+	for (let o of doc.querySelectorAll ('img[srcset], source[srcset]')) {
+		addSrcset (o);
+	}
+
+	for (let i = 0; i < doc.defaultView.frames.length; i++) {
+		let frameDoc = null;
+		try {
+			frameDoc = doc.defaultView.frames[i].document;
+		} catch (e) {
+			/* cross-origin */
+			continue;
+		}
+		if (frameDoc && isVisible (frameDoc)) {
+			extract (frameDoc);
+		}
 	}
 }
-return ret; /* immediately return results, for use with Runtime.evaluate() */
+
+extract (document);
+return {origins: origins, links: links, resources: resources}; /* immediately return results, for use with Runtime.evaluate() */
 })();
@@ -1,23 +1,114 @@
-/*	Continuously scrolls the page
+/*	Continuously scrolls the page and its scrollable elements, until the page
+ *	stops growing. Then reports back through the global function named
+ *	doneBinding. Setting the global variable named stopVarname stops scrolling.
  */
-var __crocoite_stop__ = false;
-(function(){
-function scroll (event) {
-	if (__crocoite_stop__) {
-		return false;
+(function(stopVarname, doneBinding){
+window[stopVarname] = false;
+/* scroll interval in ms */
+var interval = 200;
+/* done after the page did not grow for this many intervals at its bottom */
+var maxStable = 10;
+/* scrollable elements, updated when nodes are added */
+var scrollable = new Set ();
+var observer = null;
+var timer = null;
+var stable = 0;
+var lastHeight = 0;
+
+function pageElement () {
+	return document.scrollingElement || document.documentElement;
+}
+
+/* the page itself is scrolled through window */
+function isScrollable (e) {
+	return e.clientHeight < e.scrollHeight && e !== pageElement ();
+}
+
+function atBottom (e) {
+	return e.scrollTop + e.clientHeight >= e.scrollHeight - 1;
+}
+
+function discover (root) {
+	if (isScrollable (root)) {
+		scrollable.add (root);
+	}
+	var all = root.querySelectorAll ('*');
+	for (var i = 0; i < all.length; i++) {
+		if (isScrollable (all[i])) {
+			scrollable.add (all[i]);
+		}
+	}
+}
+
+function onMutation (mutations) {
+	/* containers already checked in this batch */
+	var checked = new Set ();
+	for (var i = 0; i < mutations.length; i++) {
+		var added = mutations[i].addedNodes;
+		for (var j = 0; j < added.length; j++) {
+			if (added[j].nodeType == Node.ELEMENT_NODE) {
+				discover (added[j]);
+			}
+		}
+		/* existing containers become scrollable when children are appended,
+		 * i.e. a feed inside a div */
+		var e = mutations[i].target;
+		while (e && e.nodeType == Node.ELEMENT_NODE && !checked.has (e)) {
+			checked.add (e);
+			if (isScrollable (e)) {
+				scrollable.add (e);
+			}
+			if (e === document.body) {
+				break;
+			}
+			e = e.parentNode;
+		}
+	}
+}
+
+function stop () {
+	window.clearInterval (timer);
+	observer.disconnect ();
+}
+
+function scroll () {
+	if (window[stopVarname]) {
+		stop ();
+		return;
+	}
+	var page = pageElement ();
+	window.scrollBy (0, window.innerHeight/2);
+	var bottom = atBottom (page);
+	scrollable.forEach (function (e) {
+		if (!e.isConnected) {
+			scrollable.delete (e);
+		} else if (!atBottom (e)) {
+			e.scrollBy (0, e.clientHeight/2);
+			bottom = false;
+		}
+	});
+
+	var height = page.scrollHeight;
+	if (bottom && height == lastHeight) {
+		stable++;
 	} else {
-		window.scrollBy (0, window.innerHeight/2);
-		document.querySelectorAll ('*').forEach (
-			function (d) {
-				if (d.clientHeight < d.scrollHeight) {
-					d.scrollBy (0, d.clientHeight/2);
-				}
-			});
-		return true;
+		stable = 0;
+	}
+	lastHeight = height;
+	/* only the top frame decides when the page is done */
+	if (stable >= maxStable && window === window.top) {
+		stop ();
+		if (typeof window[doneBinding] === 'function') {
+			window[doneBinding] ('');
+		}
 	}
 }
+
 function onload (event) {
-    window.setInterval (scroll, 200);
+	discover (document.documentElement);
+	observer = new MutationObserver (onMutation);
+	observer.observe (document.documentElement, {childList: true, subtree: true});
+	timer = window.setInterval (scroll, interval);
 }
 document.addEventListener("DOMContentLoaded", onload);
-}());
+})
@@ -0,0 +1,492 @@
+# Copyright (c) 2017–2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Distributed recursive crawls
+
+A coordinator owns the frontier (pending) and the set of URLs seen (have).
+Any number of workers connect to it via TCP and lease URLs, which they fetch
+using the same external command as RecursiveController. Leases expire if a
+worker does not send heartbeats, and the URL is handed out again.
+
+The protocol is line-based JSON. Every message is an object with a key cmd.
+Only lease requests are answered, so replies on a single connection arrive in
+the same order requests were sent.
+"""
+
+import asyncio, json, time, uuid
+from collections import deque
+
+from .controller import RecursiveController, DepthLimit, RetryQueue, \
+        addBehaviorStats
+
+class Lease:
+    __slots__ = ('id', 'url', 'deadline')
+
+    def __init__ (self, url, deadline):
+        self.id = str (uuid.uuid4 ())
+        self.url = url
+        self.deadline = deadline
+
+    def __repr__ (self):
+        return '<Lease {} {}>'.format (self.id, self.url)
+
+class Coordinator:
+    """
+    Hand out URLs to workers according to policy
+    """
+
+    __slots__ = ('url', 'policy', 'logger', 'host', 'port', 'leaseTimeout',
+            'have', 'pending', 'leases', 'stats', 'done', 'server', 'clients',
+            'retry')
+
+    def __init__ (self, url, logger, policy=DepthLimit (0), host='localhost',
+            port=0, leaseTimeout=5*60, retry=None):
+        self.url = url
+        self.logger = logger.bind (context=type(self).__name__, seedurl=url)
+        self.policy = policy
+        self.host = host
+        self.port = port
+        # seconds a worker may stay silent before its lease is revoked
+        self.leaseTimeout = leaseTimeout
+        self.have = set ()
+        self.pending = set ([url])
+        # lease id -> Lease
+        self.leases = {}
+        # failed fetches reported by workers
+        self.retry = retry if retry is not None else RetryQueue ()
+        # keep in sync with RecursiveController
+        self.stats = {'requests': 0, 'finished': 0, 'failed': 0, 'bytesRcv': 0,
+                'crashed': 0, 'blocked': 0, 'orphaned': 0, 'ignored': 0,
+                'timedOut': 0, 'retried': 0, 'abandoned': 0, 'expired': 0,
+                'behavior': {}}
+        self.done = None
+        self.server = None
+        self.clients = set ()
+
+    @property
+    def finished (self):
+        return not self.pending and not self.leases and not self.retry
+
+    async def start (self):
+        """ Start listening, returns the actual (host, port) """
+        self.done = asyncio.Event ()
+        self.server = await asyncio.start_server (self.handle, self.host, self.port)
+        self.host, self.port = self.server.sockets[0].getsockname ()[:2]
+        self.logger.info ('listening', uuid='bc4ca8be-1346-4056-820a-b7793dbe1ea6',
+                host=self.host, port=self.port)
+        return self.host, self.port
+
+    async def run (self):
+        if self.server is None:
+            await self.start ()
+        interval = min (1, self.leaseTimeout/2)
+        while not self.finished:
+            try:
+                await asyncio.wait_for (self.done.wait (), interval)
+            except asyncio.TimeoutError:
+                self.expire ()
+                self.pending.update (self.retry.ready ())
+        self.server.close ()
+        # workers interpret a closed connection as “no more work”
+        for writer in list (self.clients):
+            writer.close ()
+        await self.server.wait_closed ()
+        self.logger.info ('finished', uuid='46f304f3-f0c5-40ad-9767-392d70941c17',
+                have=len (self.have), **self.stats)
+
+    def expire (self, now=None):
+        """ Return URLs of leases past their deadline to the frontier """
+        if now is None:
+            now = time.monotonic ()
+        for l in list (self.leases.values ()):
+            if l.deadline < now:
+                self.logger.warning ('lease expired',
+                        uuid='78fd812d-1adc-4b7a-a974-aad7f96f75a0', url=l.url,
+                        lease=l.id)
+                self.stats['expired'] += 1
+                self.release (l.id, requeue=True)
+
+    def release (self, leaseId, requeue=False):
+        l = self.leases.pop (leaseId, None)
+        if l is not None and requeue:
+            self.pending.add (l.url)
+        if self.finished and self.done is not None:
+            self.done.set ()
+        return l
+
+    def lease (self, owned):
+        """ Lease a new URL, returns the reply sent to the worker """
+        self.pending.update (self.retry.ready ())
+        if self.pending:
+            self.logger.info ('recursing',
+                    uuid='5b8498e4-868d-413c-a67e-004516b8452c',
+                    pending=len (self.pending), have=len (self.have),
+                    running=len (self.leases))
+            # since pending is a set this picks a random item, which is fine
+            u = self.pending.pop ()
+            self.have.add (u)
+            l = Lease (u, time.monotonic () + self.leaseTimeout)
+            self.leases[l.id] = l
+            owned.add (l.id)
+            return {'lease': l.id, 'url': u, 'timeout': self.leaseTimeout}
+        elif self.leases or self.retry:
+            # running fetches may still discover new links
+            return {'wait': 1}
+        else:
+            return {'done': True}
+
+    def heartbeat (self, leaseId):
+        l = self.leases.get (leaseId)
+        if l is None:
+            self.logger.warning ('heartbeat for unknown lease',
+                    uuid='2a7665d8-25ee-4618-8b1f-dfe8ec1a801a', lease=leaseId)
+            return
+        l.deadline = time.monotonic () + self.leaseTimeout
+
+    def complete (self, leaseId, owned, reason=None):
+        """ Lease finished, possibly failed for reason """
+        owned.discard (leaseId)
+        l = self.leases.get (leaseId)
+        if l is not None and reason is not None:
+            delay = self.retry.failed (l.url)
+            if delay is None:
+                self.stats['abandoned'] += 1
+                self.logger.error ('fetch failed, giving up',
+                        uuid='71e64046-c0a4-48b5-a90d-ab80313e22cf', url=l.url,
+                        reason=reason, attempts=self.retry.attempts[l.url])
+            else:
+                self.stats['retried'] += 1
+                self.logger.warning ('fetch failed, retrying',
+                        uuid='1c95d692-0b8e-4e17-b55e-422757c6dd10', url=l.url,
+                        reason=reason, attempts=self.retry.attempts[l.url],
+                        delay=delay)
+        self.release (leaseId)
+
+    def addLinks (self, links):
+        links = set (self.policy (links))
+        links.difference_update (self.have)
+        self.pending.update (links)
+
+    def addStats (self, stats):
+        for k in self.stats.keys ():
+            if k == 'behavior':
+                addBehaviorStats (self.stats[k], stats.get (k, {}))
+            else:
+                self.stats[k] += stats.get (k, 0)
+
+    def dispatch (self, msg, owned):
+        cmd = msg['cmd']
+        if cmd == 'lease':
+            return self.lease (owned)
+        elif cmd == 'heartbeat':
+            self.heartbeat (msg['lease'])
+        elif cmd == 'complete':
+            self.complete (msg['lease'], owned, msg.get ('failed'))
+        elif cmd == 'links':
+            self.addLinks (msg['links'])
+        elif cmd == 'stats':
+            self.addStats (msg['stats'])
+        else:
+            raise ValueError ('Unknown command {}'.format (cmd))
+
+    async def handle (self, reader, writer):
+        """ Serve a single worker connection """
+        peer = writer.get_extra_info ('peername')
+        logger = self.logger.bind (peer=peer)
+        logger.info ('worker connected', uuid='f29cf817-35b3-4438-a34d-d3fda27598d8')
+        self.clients.add (writer)
+        # leases held by this worker
+        owned = set ()
+        try:
+            while True:
+                data = await reader.readline ()
+                if not data:
+                    break
+                try:
+                    reply = self.dispatch (json.loads (data.decode ('utf-8')), owned)
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.error ('invalid message',
+                            uuid='dd65c971-e193-4a28-a15e-9e7987c060ed',
+                            message=data, error=str (e))
+                    break
+                if reply is not None:
+                    writer.write (json.dumps (reply).encode ('utf-8') + b'\n')
+                    await writer.drain ()
+        except ConnectionError:
+            pass
+        finally:
+            # no need to wait for expiry if the worker is gone
+            for leaseId in owned:
+                self.release (leaseId, requeue=True)
+            self.clients.discard (writer)
+            writer.close ()
+            logger.info ('worker disconnected',
+                    uuid='e0f63299-2759-43b1-a1e3-45b1345a44e9',
+                    requeued=len (owned))
+
+class Worker (RecursiveController):
+    """
+    Fetch URLs leased from a Coordinator
+
+    Runs up to concurrency fetches at once over a single connection.
+    """
+
+    __slots__ = ('coordinator', 'reader', 'writer', 'replies', 'closed')
+
+    def __init__ (self, coordinator, output, command, logger,
+            prefix='{host}-{date}-', tempdir=None, concurrency=1,
+            fetchTimeout=None):
+        super ().__init__ (url=None, output=output, command=command,
+                logger=logger, prefix=prefix, tempdir=tempdir,
+                concurrency=concurrency, fetchTimeout=fetchTimeout)
+        self.logger = logger.bind (context=type(self).__name__)
+        # (host, port) tuple
+        self.coordinator = coordinator
+        self.reader = None
+        self.writer = None
+        # futures waiting for a reply, in request order
+        self.replies = deque ()
+        self.closed = False
+
+    def send (self, msg):
+        if not self.closed:
+            self.writer.write (json.dumps (msg).encode ('utf-8') + b'\n')
+
+    async def request (self, msg):
+        """ Send message and wait for reply. Returns None if disconnected. """
+        if self.closed:
+            return None
+        fut = asyncio.get_event_loop ().create_future ()
+        self.replies.append (fut)
+        self.send (msg)
+        return await fut
+
+    async def _readReplies (self):
+        try:
+            while True:
+                data = await self.reader.readline ()
+                if not data:
+                    break
+                self.replies.popleft ().set_result (json.loads (data.decode ('utf-8')))
+        except ConnectionError:
+            pass
+        finally:
+            self.closed = True
+            while self.replies:
+                self.replies.popleft ().set_result (None)
+
+    async def _heartbeat (self, lease, interval):
+        while True:
+            await asyncio.sleep (interval)
+            self.send ({'cmd': 'heartbeat', 'lease': lease})
+
+    async def _slot (self):
+        while True:
+            reply = await self.request ({'cmd': 'lease'})
+            if reply is None or reply.get ('done'):
+                break
+            wait = reply.get ('wait')
+            if wait is not None:
+                await asyncio.sleep (wait)
+                continue
+
+            lease = reply['lease']
+            heartbeat = asyncio.ensure_future (self._heartbeat (lease, reply['timeout']/3))
+            try:
+                reason = await self.fetch (reply['url'])
+            finally:
+                heartbeat.cancel ()
+            # the coordinator decides whether to retry
+            self.send ({'cmd': 'complete', 'lease': lease, 'failed': reason})
+
+    def addLinks (self, links):
+        # the coordinator applies the policy, since only it knows what we have
+        self.send ({'cmd': 'links', 'links': list (links)})
+
+    def addStats (self, stats):
+        super ().addStats (stats)
+        self.send ({'cmd': 'stats', 'stats': dict ((k, stats[k]) for k in self.stats.keys () if k in stats)})
+
+    async def run (self):
+        host, port = self.coordinator
+        self.reader, self.writer = await asyncio.open_connection (host, port)
+        self.logger.info ('connected', uuid='1d87ffac-3903-4d3c-bad1-182175350644',
+                host=host, port=port)
+        readReplies = asyncio.ensure_future (self._readReplies ())
+        try:
+            self.running = set (asyncio.ensure_future (self._slot ()) for i in range (self.concurrency))
+            await asyncio.gather (*self.running)
+        finally:
+            readReplies.cancel ()
+            self.writer.close ()
+
+import os, zlib, glob
+from urllib.parse import urlsplit
+
+def hostShard (url, shards):
+    """
+    Map url to shard 0…shards-1 by its canonical hostname. Uses a stable
+    hash, so all instances agree.
+    """
+    hostname = (urlsplit (url).hostname or '').rstrip ('.')
+    return zlib.crc32 (hostname.encode ('utf-8')) % shards
+
+class ShardedController (RecursiveController):
+    """
+    Recursive controller responsible for a single shard of hosts
+
+    Links pointing to other shards are written to the other shard’s spool
+    directory, where that instance picks them up. No extra service is
+    required, just a filesystem shared by all instances.
+
+    Termination uses per-shard status files counting spool files sent and
+    received. The crawl is done once all instances are idle and the sums
+    match in two consecutive checks.
+
+    All instances of a crawl must use the same, unique crawl id. Files are
+    kept in a subdirectory of spool named after it, so leftovers of earlier
+    crawls are never mistaken for this one’s.
+    """
+
+    __slots__ = ('shard', 'shards', 'spool', 'crawl', 'pollInterval', 'sent',
+            'received', 'written', 'lastStatus')
+
+    def __init__ (self, url, output, command, logger, shard, shards, spool,
+            crawl, pollInterval=1, **kwargs):
+        super ().__init__ (url, output, command, logger, **kwargs)
+        if not crawl or crawl.startswith ('.') or os.sep in crawl:
+            raise ValueError ('Invalid crawl id {}'.format (crawl))
+        self.logger = self.logger.bind (shard=shard, crawl=crawl)
+        self.shard = shard
+        self.shards = shards
+        self.crawl = crawl
+        self.spool = os.path.join (spool, crawl)
+        self.pollInterval = pollInterval
+        self.sent = 0
+        self.received = 0
+        # last status written and global status read
+        self.written = None
+        self.lastStatus = None
+        for i in range (shards):
+            os.makedirs (self._incoming (i), exist_ok=True)
+
+    def _incoming (self, shard):
+        return os.path.join (self.spool, str (shard))
+
+    def _statusPath (self, shard):
+        return os.path.join (self.spool, 'status-{}.json'.format (shard))
+
+    def _atomicWrite (self, path, data):
+        tmp = os.path.join (self.spool, '.{}-{}.tmp'.format (self.shard, uuid.uuid4 ()))
+        with open (tmp, 'w') as fd:
+            json.dump (data, fd)
+        os.rename (tmp, path)
+
+    def addLinks (self, links):
+        # the policy must see all links found on our pages, i.e. apply it
+        # before forwarding
+        outgoing = {}
+        for l in self.policy (links):
+            outgoing.setdefault (hostShard (l, self.shards), []).append (l)
+        own = set (outgoing.pop (self.shard, []))
+        own.difference_update (self.have)
+        self.pending.update (own)
+        for shard, l in outgoing.items ():
+            self._atomicWrite (os.path.join (self._incoming (shard),
+                    '{}.json'.format (uuid.uuid4 ())), l)
+            self.sent += 1
+
+    def collectSpool (self):
+        """ Pick up links forwarded to us """
+        for path in glob.glob (os.path.join (self._incoming (self.shard), '*.json')):
+            with open (path, 'r') as fd:
+                links = set (json.load (fd))
+            os.unlink (path)
+            self.received += 1
+            links.difference_update (self.have)
+            self.pending.update (links)
+
+    def writeStatus (self, idle):
+        status = {'crawl': self.crawl, 'idle': idle, 'sent': self.sent,
+                'received': self.received}
+        if status != self.written:
+            self._atomicWrite (self._statusPath (self.shard), status)
+            self.written = status
+
+    def readStatus (self):
+        """ Return global (sent, received) if all shards are idle, else None """
+        sent = received = 0
+        for i in range (self.shards):
+            try:
+                with open (self._statusPath (i), 'r') as fd:
+                    status = json.load (fd)
+            except (FileNotFoundError, ValueError):
+                # not started yet
+                return None
+            if status.get ('crawl') != self.crawl or not status['idle']:
+                return None
+            sent += status['sent']
+            received += status['received']
+        return sent, received
+
+    def finished (self):
+        status = self.readStatus ()
+        if status is None or status[0] != status[1]:
+            self.lastStatus = None
+            return False
+        # a message may have been in flight while reading, so ask twice
+        done = status == self.lastStatus
+        self.lastStatus = status
+        return done
+
+    async def run (self):
+        self.have = set ()
+        self.pending = set ()
+        if hostShard (self.url, self.shards) == self.shard:
+            self.pending.add (self.url)
+        # others must not consider us idle before we picked up our work
+        self.writeStatus (idle=False)
+
+        while True:
+            self.collectSpool ()
+            self.requeue ()
+            if self.pending and len (self.running) < self.concurrency:
+                self.writeStatus (idle=False)
+                self.logger.info ('recursing',
+                        uuid='5b8498e4-868d-413c-a67e-004516b8452c',
+                        pending=len (self.pending), have=len (self.have),
+                        running=len (self.running))
+                u = self.pending.pop ()
+                self.have.add (u)
+                self.running.add (asyncio.ensure_future (self.fetchRetry (u)))
+            elif self.running:
+                done, pending = await asyncio.wait (self.running,
+                        timeout=self.pollInterval,
+                        return_when=asyncio.FIRST_COMPLETED)
+                self.running.difference_update (done)
+                self.updateConcurrency ()
+            else:
+                # pending retries are work too
+                idle = not self.retry
+                self.writeStatus (idle=idle)
+                if idle and self.finished ():
+                    break
+                await asyncio.sleep (self.pollInterval)
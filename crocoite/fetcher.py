@@ -0,0 +1,133 @@
+# Copyright (c) 2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Fetch resources without the browser.
+
+Retrieving bodies through the DevTools protocol means loading them into memory
+(twice, base64-encoded). This is not feasible for large media files, which are
+downloaded again with a plain HTTP client instead.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class FetchResult:
+    """ A finished fetch, body is a file object """
+
+    __slots__ = ('url', 'requestHeaders', 'status', 'reason', 'headers',
+            'body', 'length', 'date')
+
+    def __init__ (self, url, requestHeaders, status, reason, headers, body,
+            length, date):
+        self.url = url
+        self.requestHeaders = requestHeaders
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.length = length
+        self.date = date
+
+class Fetcher:
+    """
+    Download resources using a pooled HTTP session and at most concurrency
+    threads. Bodies are stored as received (i.e. still compressed) and spooled
+    to disk, bodies larger than maxBodySize are rejected.
+    """
+
+    __slots__ = ('logger', 'session', 'executor', 'maxBodySize', 'timeout')
+
+    # headers describing the browser’s connection or request, which must not
+    # be copied. We want the whole resource, not a range of it.
+    skipHeaders = {'host', 'connection', 'keep-alive', 'content-length',
+            'transfer-encoding', 'upgrade', 'range', 'if-range',
+            'if-modified-since', 'if-none-match'}
+    # spool bodies larger than this to disk
+    maxMemory = 1024*1024
+    chunkSize = 64*1024
+
+    def __init__ (self, logger, concurrency=2, maxBodySize=1024**3, timeout=60):
+        self.logger = logger.bind (context=type (self).__name__)
+        self.maxBodySize = maxBodySize
+        self.timeout = timeout
+        self.session = requests.Session ()
+        adapter = HTTPAdapter (pool_connections=concurrency,
+                pool_maxsize=concurrency)
+        self.session.mount ('http://', adapter)
+        self.session.mount ('https://', adapter)
+        self.executor = ThreadPoolExecutor (max_workers=concurrency)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.executor.shutdown (wait=True)
+        self.session.close ()
+        return False
+
+    def submit (self, url, headers):
+        """
+        Fetch url with the browser’s request headers (list of tuples), which
+        include its cookies. Returns a future for a FetchResult.
+        """
+        headers = dict (filter (lambda x: x[0].lower () not in self.skipHeaders
+                and not x[0].startswith (':'), headers))
+        return self.executor.submit (self.fetch, url, headers)
+
+    def fetch (self, url, headers):
+        """ Blocking fetch, raises ValueError if the body is too large """
+        logger = self.logger.bind (url=url)
+        logger.info ('fetch', uuid='870211fc-c706-40d1-9353-82af2656fc50')
+        date = datetime.utcnow ()
+        # headers set by requests itself are overridden
+        with self.session.get (url, headers=headers, stream=True,
+                timeout=self.timeout, allow_redirects=False) as resp:
+            length = resp.headers.get ('content-length')
+            if length and int (length) > self.maxBodySize:
+                raise ValueError ('Body too large')
+
+            body = SpooledTemporaryFile (max_size=self.maxMemory)
+            try:
+                length = 0
+                while True:
+                    # keep the content encoding
+                    buf = resp.raw.read (self.chunkSize, decode_content=False)
+                    if not buf:
+                        break
+                    length += len (buf)
+                    if length > self.maxBodySize:
+                        raise ValueError ('Body too large')
+                    body.write (buf)
+            except:
+                body.close ()
+                raise
+            body.seek (0)
+
+            logger.info ('fetched', uuid='59694bfc-13c4-48a1-9da4-175d8698a5f3',
+                    status=resp.status_code, length=length)
+            return FetchResult (url, list (resp.request.headers.items ()),
+                    resp.status_code, resp.reason,
+                    list (resp.raw.headers.items ()), body, length, date)
+
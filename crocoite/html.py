@@ -105,63 +105,89 @@ eventAttributes = {'onabort',
 
 from html5lib.treewalkers.base import TreeWalker
 from html5lib.filters.base import Filter
+from html5lib.filters.optionaltags import Filter as OptionalTagFilter
+# also registers the htmlentityreplace codec error handler
+from html5lib.serializer import _quoteAttributeLegacy
 from html5lib import constants
 
 class ChromeTreeWalker (TreeWalker):
     """
-    Recursive html5lib TreeWalker for Google Chrome method DOM.getDocument
-    """
+    html5lib TreeWalker for Google Chrome method DOM.getDocument
 
-    def recurse (self, node):
-        name = node['nodeName']
-        if name.startswith ('#'):
-            if name == '#text':
-                yield from self.text (node['nodeValue'])
-            elif name == '#comment':
-                yield self.comment (node['nodeValue'])
-            elif name == '#document':
-                for child in node.get ('children', []):
-                    yield from self.recurse (child)
-            else:
-                assert False, name
-        else:
-            default_namespace = constants.namespaces["html"]
+    Uses an explicit stack instead of recursion, so documents of any depth can
+    be walked. Documents of frames (DOM.getDocument(pierce=True)) are not
+    walked, but collected in subdocuments, which is complete after iterating.
+    """
 
-            attributes = node.get ('attributes', [])
-            convertedAttr = {}
-            for i in range (0, len (attributes), 2):
-                convertedAttr[(default_namespace, attributes[i])] = attributes[i+1]
-
-            children = node.get ('children', [])
-            if name.lower() in voidTags and not children:
-                yield from self.emptyTag (default_namespace, name, convertedAttr)
-            else:
-                yield self.startTag (default_namespace, name, convertedAttr)
-                for child in node.get ('children', []):
-                    yield from self.recurse (child)
-                yield self.endTag ('', name)
+    def __init__ (self, tree):
+        super ().__init__ (tree)
+        self.subdocuments = []
 
     def __iter__ (self):
         assert self.tree['nodeName'] == '#document'
-        return self.recurse (self.tree)
+        self.subdocuments = subdocuments = []
+        default_namespace = constants.namespaces["html"]
+        text = self.text
+        # (iterator over remaining children, tag name or None for documents)
+        stack = [(iter (self.tree.get ('children', [])), None)]
+        while stack:
+            children, parent = stack[-1]
+            for node in children:
+                name = node['nodeName']
+                if name.startswith ('#'):
+                    if name == '#text':
+                        yield from text (node['nodeValue'])
+                    elif name == '#comment':
+                        yield self.comment (node['nodeValue'])
+                    elif name == '#document':
+                        stack.append ((iter (node.get ('children', [])), None))
+                        break
+                    else:
+                        assert False, name
+                else:
+                    contentDocument = node.get ('contentDocument')
+                    if contentDocument:
+                        assert contentDocument['nodeName'] == '#document'
+                        subdocuments.append (contentDocument)
+
+                    attributes = node.get ('attributes', [])
+                    convertedAttr = {}
+                    for i in range (0, len (attributes), 2):
+                        convertedAttr[(default_namespace, attributes[i])] = attributes[i+1]
+
+                    nodeChildren = node.get ('children', [])
+                    if name.lower() in voidTags and not nodeChildren:
+                        yield from self.emptyTag (default_namespace, name, convertedAttr)
+                    else:
+                        yield self.startTag (default_namespace, name, convertedAttr)
+                        stack.append ((iter (nodeChildren), name))
+                        break
+            else:
+                # all children done
+                stack.pop ()
+                if parent is not None:
+                    yield self.endTag ('', parent)
 
     def split (self):
         """
-        Split response returned by DOM.getDocument(pierce=True) into independent documents
+        Split response returned by DOM.getDocument(pierce=True) into
+        independent documents, in document order
         """
-        def recurse (node):
-            contentDocument = node.get ('contentDocument')
-            if contentDocument:
-                assert contentDocument['nodeName'] == '#document'
-                yield contentDocument
-                yield from recurse (contentDocument)
-
-            for child in node.get ('children', []):
-                yield from recurse (child)
-
         if self.tree['nodeName'] == '#document':
             yield self.tree
-        yield from recurse (self.tree)
+        stack = [iter ([self.tree])]
+        while stack:
+            for node in stack[-1]:
+                stack.append (iter (node.get ('children', [])))
+                contentDocument = node.get ('contentDocument')
+                if contentDocument:
+                    assert contentDocument['nodeName'] == '#document'
+                    yield contentDocument
+                    # walked before node’s children
+                    stack.append (iter (contentDocument.get ('children', [])))
+                break
+            else:
+                stack.pop ()
 
 class StripTagFilter (Filter):
     """
@@ -176,9 +202,13 @@ class StripTagFilter (Filter):
         delete = 0
         for token in Filter.__iter__(self):
             tokenType = token['type']
-            if tokenType in {'StartTag', 'EmptyTag'}:
+            if tokenType == 'StartTag':
                 if delete > 0 or token['name'].lower () in self.tags:
                     delete += 1
+            elif tokenType == 'EmptyTag':
+                # has no end tag, must not change delete
+                if token['name'].lower () in self.tags:
+                    continue
             if delete == 0:
                 yield token
             if tokenType == 'EndTag' and delete > 0:
@@ -204,3 +234,276 @@ class StripAttributeFilter (Filter):
                 token['data'] = newdata
             yield token
 
+
+# tags html5lib’s OptionalTagFilter may omit. It compares names
+# case-sensitively, so usually only the doctype node (named html) and XHTML
+# documents are affected. Start tags are checked with “tagname in 'html'”.
+optionalStartTags = {'head', 'body', 'colgroup', 'tbody'} \
+        | {'html'[i:j] for i in range (4) for j in range (i+1, 5)}
+optionalEndTags = {'html', 'head', 'body', 'li', 'optgroup', 'tr', 'dt', 'dd',
+        'p', 'option', 'rt', 'rp', 'colgroup', 'thead', 'tbody', 'tfoot', 'td',
+        'th'}
+_optionalTags = OptionalTagFilter (None)
+
+def _attribute (tag, k, v):
+    """ Serialize attribute like html5lib’s HTMLSerializer """
+    if k in constants.booleanAttributes.get (tag, ()) or \
+            k in constants.booleanAttributes['']:
+        return ' ' + k
+    quote = not v or _quoteAttributeLegacy.search (v) is not None
+    v = v.replace ('&', '&amp;')
+    if not quote:
+        return ' ' + k + '=' + v
+    if '"' in v and "'" not in v:
+        return " " + k + "='" + v + "'"
+    return ' ' + k + '="' + v.replace ('"', '&quot;') + '"'
+
+def _escape (data):
+    return data.replace ('&', '&amp;').replace ('<', '&lt;').replace ('>', '&gt;')
+
+class ChromeSerializer:
+    """
+    Fast serializer for Google Chrome methods DOM.getDocument and
+    DOMSnapshot.captureSnapshot
+
+    The output of render () is the same as
+
+        HTMLSerializer ().render (StripAttributeFilter (StripTagFilter (
+                ChromeTreeWalker (doc), stripTags), stripAttributes), encoding)
+
+    but created in a single pass without html5lib tokens. Documents of frames
+    are collected in subdocuments, like ChromeTreeWalker does.
+    """
+
+    __slots__ = ('stripTags', 'stripAttributes', 'encoding', 'subdocuments',
+            'out', 'inCdata', 'haveMeta', 'pending', 'lastToken')
+
+    def __init__ (self, stripTags=[], stripAttributes=[], encoding='utf-8'):
+        self.stripTags = set (map (str.lower, stripTags))
+        self.stripAttributes = set (map (str.lower, stripAttributes))
+        self.encoding = encoding
+        self.subdocuments = []
+
+    def _reset (self):
+        self.subdocuments = []
+        self.out = []
+        # see HTMLSerializer
+        self.inCdata = False
+        # html5lib’s InjectMetaCharsetFilter adds one to the first head
+        self.haveMeta = False
+        # tag that may be omitted, depending on the next token:
+        # (is start tag, name, index into out, previous token)
+        self.pending = None
+        # (type, name) of the previous token
+        self.lastToken = None
+
+    def _resolve (self, nextType, nextName):
+        isStart, name, index, previous = self.pending
+        nextToken = {'type': nextType, 'name': nextName} if nextType else None
+        if isStart:
+            previous = {'type': previous[0], 'name': previous[1]} if previous else None
+            omit = _optionalTags.is_optional_start (name, previous, nextToken)
+        else:
+            omit = _optionalTags.is_optional_end (name, nextToken)
+        if omit:
+            self.out[index] = ''
+        self.pending = None
+
+    def _text (self, data):
+        if not data:
+            return
+        spaceCharacters = constants.spaceCharacters
+        if self.pending:
+            self._resolve ('SpaceCharacters' if data[0] in spaceCharacters else 'Characters', None)
+        self.out.append (data if self.inCdata else _escape (data))
+        self.lastToken = ('SpaceCharacters' if data[-1] in spaceCharacters else 'Characters', None)
+
+    def _comment (self, data):
+        if self.pending:
+            self._resolve ('Comment', None)
+        self.out.append ('<!--' + data + '-->')
+        self.lastToken = ('Comment', None)
+
+    def _startTag (self, name, lowerName, attributes, empty):
+        """ attributes is a flat list of names and values """
+        tokenType = 'EmptyTag' if empty else 'StartTag'
+        if self.pending:
+            self._resolve (tokenType, name)
+        tag = '<' + name
+        if attributes:
+            stripAttributes = self.stripAttributes
+            for i in range (0, len (attributes), 2):
+                k = attributes[i]
+                if k.lower () not in stripAttributes:
+                    tag += _attribute (name, k, attributes[i+1])
+        out = self.out
+        if not empty and name in optionalStartTags and len (tag) == len (name) + 1:
+            self.pending = (True, name, len (out), self.lastToken)
+        out.append (tag + '>')
+        if name in constants.rcdataElements:
+            self.inCdata = True
+        self.lastToken = (tokenType, name)
+
+        if not self.haveMeta and lowerName == 'head' and not empty:
+            if self.pending:
+                self._resolve ('EmptyTag', 'meta')
+            out.append ('<meta' + _attribute ('meta', 'charset', self.encoding) + '>')
+            self.lastToken = ('EmptyTag', 'meta')
+            self.haveMeta = True
+
+    def _endTag (self, name):
+        if self.pending:
+            self._resolve ('EndTag', name)
+        if name in constants.rcdataElements:
+            self.inCdata = False
+        if name in optionalEndTags:
+            self.pending = (False, name, len (self.out), None)
+        self.out.append ('</' + name + '>')
+        self.lastToken = ('EndTag', name)
+
+    def _finish (self):
+        if self.pending:
+            self._resolve (None, None)
+        out = self.out
+        self.out = None
+        return ''.join (out).encode (self.encoding, 'htmlentityreplace')
+
+    def render (self, doc):
+        """ Serialize document node doc from DOM.getDocument """
+        assert doc['nodeName'] == '#document'
+        self._reset ()
+        subdocuments = self.subdocuments
+        stripTags = self.stripTags
+
+        # (iterator over remaining children, tag name or None for documents)
+        stack = [(iter (doc.get ('children', [])), None)]
+        while stack:
+            children, parent = stack[-1]
+            for node in children:
+                name = node['nodeName']
+                if name.startswith ('#'):
+                    if name == '#text':
+                        self._text (node['nodeValue'])
+                    elif name == '#comment':
+                        self._comment (node['nodeValue'])
+                    elif name == '#document':
+                        stack.append ((iter (node.get ('children', [])), None))
+                        break
+                    else:
+                        assert False, name
+                    continue
+
+                contentDocument = node.get ('contentDocument')
+                if contentDocument:
+                    assert contentDocument['nodeName'] == '#document'
+                    subdocuments.append (contentDocument)
+
+                lowerName = name.lower ()
+                nodeChildren = node.get ('children', [])
+                if lowerName in stripTags:
+                    # documents of frames within are still needed
+                    strip = list (reversed (nodeChildren))
+                    while strip:
+                        n = strip.pop ()
+                        contentDocument = n.get ('contentDocument')
+                        if contentDocument:
+                            subdocuments.append (contentDocument)
+                        strip.extend (reversed (n.get ('children', [])))
+                    continue
+
+                empty = lowerName in voidTags and not nodeChildren
+                self._startTag (name, lowerName, node.get ('attributes'), empty)
+                if not empty:
+                    stack.append ((iter (nodeChildren), name))
+                    break
+            else:
+                # all children done
+                stack.pop ()
+                if parent is not None:
+                    self._endTag (parent)
+
+        return self._finish ()
+
+    def renderSnapshot (self, snapshot, index):
+        """
+        Serialize document index of DOMSnapshot.captureSnapshot’s result.
+
+        Nodes are stored in flat arrays in document order, names and values
+        are indexes into a shared string table. subdocuments contains
+        document indexes.
+        """
+        self._reset ()
+        subdocuments = self.subdocuments
+        stripTags = self.stripTags
+        strings = snapshot['strings']
+        nodes = snapshot['documents'][index]['nodes']
+        parents = nodes['parentIndex']
+        names = nodes['nodeName']
+        values = nodes['nodeValue']
+        attributes = nodes['attributes']
+        contentDocuments = nodes.get ('contentDocumentIndex', {})
+        contentDocuments = dict (zip (contentDocuments.get ('index', []),
+                contentDocuments.get ('value', [])))
+        # pseudo elements and shadow roots (#document-fragment) are not part
+        # of DOM.getDocument’s children
+        hidden = set (nodes.get ('pseudoType', {}).get ('index', []))
+        try:
+            fragment = strings.index ('#document-fragment')
+            hidden.update (i for i, name in enumerate (names) if name == fragment)
+        except ValueError:
+            pass
+
+        # per string index: (name, lower case name, removed tag?)
+        nameCache = {}
+        def lookup (i):
+            name = strings[i]
+            lowerName = name.lower ()
+            ret = nameCache[i] = (name, lowerName, lowerName in stripTags)
+            return ret
+
+        count = len (parents)
+        hasChildren = [False]*count
+        for i in range (1, count):
+            if i not in hidden:
+                hasChildren[parents[i]] = True
+
+        # removed nodes, including their descendants
+        removed = [False]*count
+        # open elements
+        stack = [0]
+        for i in range (1, count):
+            parent = parents[i]
+            if removed[parent]:
+                removed[i] = True
+                if i in contentDocuments:
+                    subdocuments.append (contentDocuments[i])
+                continue
+
+            if i in hidden:
+                removed[i] = True
+                continue
+            name, lowerName, strip = nameCache.get (names[i]) or lookup (names[i])
+
+            while stack[-1] != parent:
+                self._endTag (strings[names[stack.pop ()]])
+
+            if i in contentDocuments:
+                subdocuments.append (contentDocuments[i])
+            if strip:
+                removed[i] = True
+            elif name == '#text':
+                self._text (strings[values[i]])
+            elif name == '#comment':
+                self._comment (strings[values[i]])
+            elif name.startswith ('#'):
+                assert False, name
+            else:
+                empty = lowerName in voidTags and not hasChildren[i]
+                self._startTag (name, lowerName,
+                        [strings[x] for x in attributes[i]], empty)
+                if not empty:
+                    stack.append (i)
+        while len (stack) > 1:
+            self._endTag (strings[names[stack.pop ()]])
+
+        return self._finish ()
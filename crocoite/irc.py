@@ -320,10 +320,11 @@ def jobExists (func):
     return inner
 
 class Chromebot (ArgparseBot):
-    __slots__ = ('jobs', 'tempdir', 'destdir', 'processLimit')
+    __slots__ = ('jobs', 'tempdir', 'destdir', 'processLimit', 'maxConcurrency')
 
     def __init__ (self, host, port, ssl, nick, logger, channels=[],
-            tempdir=tempfile.gettempdir(), destdir='.', processLimit=1):
+            tempdir=tempfile.gettempdir(), destdir='.', processLimit=1,
+            maxConcurrency=4):
         super().__init__ (host=host, port=port, ssl=ssl, nick=nick,
                 logger=logger, channels=channels)
 
@@ -331,6 +332,8 @@ class Chromebot (ArgparseBot):
         self.tempdir = tempdir
         self.destdir = destdir
         self.processLimit = asyncio.Semaphore (processLimit)
+        # upper bound for -j auto
+        self.maxConcurrency = maxConcurrency
 
     def getParser (self):
         parser = NonExitingArgumentParser (prog=self.nick + ': ', add_help=False)
@@ -340,7 +343,7 @@ class Chromebot (ArgparseBot):
         #archiveparser.add_argument('--timeout', default=1*60*60, type=int, help='Maximum time for archival', metavar='SEC', choices=[60, 1*60*60, 2*60*60])
         #archiveparser.add_argument('--idle-timeout', default=10, type=int, help='Maximum idle seconds (i.e. no requests)', dest='idleTimeout', metavar='SEC', choices=[1, 10, 20, 30, 60])
         #archiveparser.add_argument('--max-body-size', default=None, type=int, dest='maxBodySize', help='Max body size', metavar='BYTES', choices=[1*1024*1024, 10*1024*1024, 100*1024*1024])
-        archiveparser.add_argument('--concurrency', '-j', default=1, type=int, help='Parallel workers for this job', choices=range (1, 5))
+        archiveparser.add_argument('--concurrency', '-j', default='1', help='Parallel workers for this job, auto adjusts to machine load', choices=['1', '2', '3', '4', 'auto'])
         archiveparser.add_argument('--recursive', '-r', help='Enable recursion', choices=['0', '1', 'prefix'], default='0')
         archiveparser.add_argument('url', help='Website URL', type=isValidUrl, metavar='URL')
         archiveparser.set_defaults (func=self.handleArchive)
@@ -365,10 +368,13 @@ class Chromebot (ArgparseBot):
 
         logger = self.logger.bind (id=j.id, user=user.name, url=args.url)
 
+        if args.concurrency == 'auto':
+            concurrency = ['--concurrency', str (self.maxConcurrency), '--autoscale']
+        else:
+            concurrency = ['--concurrency', args.concurrency]
         cmdline = ['crocoite-recursive', args.url, '--tempdir', self.tempdir,
                 '--prefix', j.id + '-{host}-{date}-', '--policy',
-                args.recursive, '--concurrency', str (args.concurrency),
-                self.destdir]
+                args.recursive] + concurrency + [self.destdir]
 
         showargs = {
                 'recursive': args.recursive,
@@ -0,0 +1,289 @@
+# Copyright (c) 2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re, time, threading
+from base64 import b64encode
+
+from .behavior import Screenshot, Click, ExtractLinks, Behavior, Script, \
+        InjectScript, EvaluateScript, BehaviorRuntime, BehaviorProfile, \
+        EmulateScreenMetrics
+from .browser import SiteLoader
+from .logger import Logger, NullConsumer
+
+class FakeLoader:
+    def __init__ (self, tab):
+        self.tab = tab
+        self.bindings = {}
+        self.crashed = threading.Event ()
+
+    def addBinding (self, name, callback):
+        self.bindings[name] = callback
+
+class ScreenshotTab:
+    """ Fake tab for a page of size width×height, tiles below blank are white """
+    def __init__ (self, width, height, blank):
+        self.Page = self
+        self.width = width
+        self.height = height
+        self.blank = blank
+        self.calls = []
+
+    def getFrameTree (self):
+        return {'frameTree': {'frame': {'url': 'http://example.com/#a'}}}
+
+    def getLayoutMetrics (self):
+        return {'contentSize': {'width': self.width, 'height': self.height}}
+
+    def captureScreenshot (self, **kwargs):
+        self.calls.append (kwargs)
+        clip = kwargs['clip']
+        data = 'blank' if clip['y'] >= self.blank else 'tile{}'.format (clip['y'])
+        data += str (clip['height'])
+        return {'data': b64encode (data.encode ('ascii'))}
+
+def test_screenshot ():
+    logger = Logger (consumer=[NullConsumer ()])
+    tab = ScreenshotTab (1000, 100000, 16*1024)
+    events = list (Screenshot (FakeLoader (tab), logger).onfinish ())
+    # identical, consecutive tiles are stored once and counted
+    assert [e.yoff for e in events] == [0, 16384, 98304]
+    assert [e.repeat for e in events] == [1, 5, 1]
+    assert [e.height for e in events] == [16384, 16384, 100000-98304]
+    assert events[0].url == 'http://example.com/'
+    assert events[0].data == b'tile016384'
+    assert events[0].mimeType == 'image/png'
+    assert len (tab.calls) == 7
+    assert 'quality' not in tab.calls[0]
+
+    tab = ScreenshotTab (2000, 100000, 100000)
+    behavior = Screenshot.withOptions (format='jpeg', quality=50, maxWidth=1000,
+            maxHeight=40000)
+    events = list (behavior (FakeLoader (tab), logger).onfinish ())
+    # tiles are limited by the texture size in device pixels
+    assert [e.yoff for e in events] == [0, 32768]
+    assert all (map (lambda e: e.mimeType == 'image/jpeg' and e.scale == 0.5, events))
+    assert tab.calls[0]['format'] == 'jpeg' and tab.calls[0]['quality'] == 50
+    assert tab.calls[0]['clip']['width'] == 2000
+    assert tab.calls[1]['clip']['height'] == 40000-32768
+
+    # empty page
+    tab = ScreenshotTab (0, 0, 0)
+    behavior = Screenshot.withOptions (maxWidth=1000)
+    assert list (behavior (FakeLoader (tab), logger).onfinish ()) == []
+
+class ScriptTab:
+    """ Fake tab accepting scripts on new documents """
+    def __init__ (self):
+        self.Page = self
+
+    def addScriptToEvaluateOnNewDocument (self, source):
+        return {'identifier': '1'}
+
+class EmulationTab:
+    """ Fake tab recording device metrics overrides """
+    def __init__ (self):
+        self.Emulation = self
+        self.sizes = []
+
+    def setDeviceMetricsOverride (self, **kwargs):
+        self.sizes.append (kwargs)
+
+def test_emulatescreenmetrics ():
+    logger = Logger (consumer=[NullConsumer ()])
+    l = SiteLoader ('http://localhost:9222', 'http://example.com/', logger)
+    l.tab = EmulationTab ()
+    # long-lived request started before, must not delay resizing
+    l._requestWillBeSent (requestId='1', timestamp=0,
+            request={'url': 'http://example.com/', 'method': 'GET', 'headers': {}})
+    behavior = EmulateScreenMetrics.withOptions (settle=0.01, maxWait=1) (l, logger)
+    start = time.monotonic ()
+    list (behavior.onstop ())
+    assert time.monotonic () - start < 1
+    assert len (l.tab.sizes) == len (behavior.sizes) + 1
+
+def test_click ():
+    logger = Logger (consumer=[NullConsumer ()])
+    loader = FakeLoader (ScriptTab ())
+    click = Click (loader, logger)
+    assert click.doneBinding in click.script.data
+    assert '__crocoite_done__' not in click.script.data
+
+    list (click.onload ())
+    # frames without selectors never report
+    assert click.finished is None
+    report = loader.bindings[click.doneBinding]
+    report ('main:busy')
+    assert not click.finished
+    report ('main:done')
+    assert click.finished
+    # a busy child frame keeps the behavior running
+    report ('child:busy')
+    assert not click.finished
+    report ('child:done')
+    assert click.finished
+
+def test_extractlinks_expand ():
+    result = {'origins': ['http://example.com', ''],
+            'links': [[0, '/a'], [1, 'mailto:foo@example.com'], [0, '/b#c']]}
+    assert ExtractLinks.expand (result) == ['http://example.com/a',
+            'mailto:foo@example.com', 'http://example.com/b#c']
+    assert ExtractLinks.expand ({'origins': [], 'links': []}) == []
+    # srcset candidates are kept apart from crawl targets
+    result['resources'] = [[0, '/c.png']]
+    assert ExtractLinks.expand (result, 'resources') == ['http://example.com/c.png']
+    assert 'http://example.com/c.png' not in ExtractLinks.expand (result)
+
+class RuntimeTab:
+    """ Fake tab recording calls, evaluations return the called function’s name """
+    def __init__ (self):
+        self.Page = self
+        self.Runtime = self
+        self.calls = []
+
+    def addScriptToEvaluateOnNewDocument (self, source):
+        self.calls.append (('add', source))
+        return {'identifier': '1'}
+
+    def removeScriptToEvaluateOnNewDocument (self, identifier):
+        self.calls.append (('remove', identifier))
+
+    def evaluate (self, expression, returnByValue, _timeout=None):
+        self.calls.append (('evaluate', expression))
+        names = re.findall (r'^(\w+) \(\)$', expression, re.M)
+        return {'result': {'value': [{'value': x} for x in names]}}
+
+class RuntimeBehavior (Behavior):
+    __slots__ = ('results', )
+
+    name = 'runtime'
+
+    def __init__ (self, loader, logger):
+        super ().__init__ (loader, logger)
+        self.results = []
+
+    def onload (self):
+        yield InjectScript (Script.fromStr ('a ()'))
+        yield 1
+
+    def onfinish (self):
+        yield 2
+        self.results.append ((yield EvaluateScript (Script.fromStr ('b ();'))))
+        self.results.append ((yield EvaluateScript (Script.fromStr ('c ()'))))
+        yield 3
+
+def runItems (runtime, method):
+    """ Items yielded by runtime’s method, without profiles """
+    return [x for x in runtime.run (method) if not isinstance (x, BehaviorProfile)]
+
+def test_runtime ():
+    logger = Logger (consumer=[NullConsumer ()])
+    tab = RuntimeTab ()
+    loader = FakeLoader (tab)
+    behavior = [RuntimeBehavior (loader, logger), RuntimeBehavior (loader, logger)]
+    runtime = BehaviorRuntime (loader, logger, behavior)
+
+    assert runItems (runtime, 'onload') == [1, 1]
+    # a single bundle for all scripts
+    assert len (tab.calls) == 1 and tab.calls[0][0] == 'add'
+    assert tab.calls[0][1].count ('a ()') == 2
+
+    assert runItems (runtime, 'onstop') == []
+    assert tab.calls[1] == ('remove', '1')
+
+    # every behavior runs up to its next request, then they are evaluated
+    # together
+    items = list (runtime.run ('onfinish'))
+    assert items[:4] == [2, 2, 3, 3]
+    assert [c[0] for c in tab.calls[2:]] == ['evaluate', 'evaluate']
+    assert all (map (lambda b: b.results == ['b', 'c'], behavior))
+    # followed by one profile per behavior
+    profiles = items[4:]
+    assert [p.name for p in profiles] == ['runtime', 'runtime']
+    assert all (map (lambda p: p.method == 'onfinish' and p.calls == 2 \
+            and not p.cancelled, profiles))
+
+    loader.crashed.set ()
+    assert runItems (runtime, 'onfinish') == []
+    assert len (tab.calls) == 4
+
+class SlowBehavior (Behavior):
+    name = 'slow'
+    budget = 0.1
+
+    def onfinish (self):
+        for i in range (10):
+            time.sleep (0.03)
+            yield Script.fromStr (str (i))
+
+def test_runtime_budget ():
+    logger = Logger (consumer=[NullConsumer ()])
+    loader = FakeLoader (RuntimeTab ())
+    slow = SlowBehavior (loader, logger)
+    runtime = BehaviorRuntime (loader, logger, [slow])
+
+    items = list (runtime.run ('onfinish'))
+    profile = items.pop ()
+    # cancelled between items
+    assert 2 <= len (items) < 10
+    assert profile.cancelled and profile.time >= 0.1
+    assert profile.bytes == len (items)
+    # and not run again on this page
+    assert list (runtime.run ('onfinish')) == []
+    # until it is loaded again
+    list (runtime.run ('onload'))
+    assert len (runItems (runtime, 'onfinish')) > 0
+
+    runtime = BehaviorRuntime (loader, logger, [SlowBehavior.withOptions (budget=None) (loader, logger)])
+    assert len (runItems (runtime, 'onfinish')) == 10
+
+class CallTab:
+    """ Fake tab with pychrome’s generic method call """
+    def __init__ (self):
+        self.calls = []
+
+    def call_method (self, _method, **kwargs):
+        self.calls.append ((_method, kwargs))
+        return {}
+
+class CallingBehavior (Behavior):
+    name = 'calling'
+
+    def onfinish (self):
+        tab = self.loader.tab
+        tab.call_method ('Page.foo')
+        # calls from other threads (i.e. pychrome’s) are not counted
+        t = threading.Thread (target=tab.call_method, args=('Page.bar', ))
+        t.start ()
+        t.join ()
+        yield Script.fromStr ('')
+
+def test_runtime_calls ():
+    logger = Logger (consumer=[NullConsumer ()])
+    tab = CallTab ()
+    loader = FakeLoader (tab)
+    runtime = BehaviorRuntime (loader, logger, [CallingBehavior (loader, logger)])
+    profile = list (runtime.run ('onfinish'))[-1]
+    assert profile.calls == 1
+    assert [c[0] for c in tab.calls] == ['Page.foo', 'Page.bar']
+    # limited by the remaining budget
+    assert 0 < tab.calls[0][1]['_timeout'] <= CallingBehavior.budget
+    assert '_timeout' not in tab.calls[1][1]
+    # instrumentation is removed afterwards
+    assert 'call_method' not in tab.__dict__
@@ -18,12 +18,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import pytest
+import pytest, os, time, threading
 from operator import itemgetter
+from io import StringIO
 from http.server import BaseHTTPRequestHandler
 from pychrome.exceptions import TimeoutException
 
-from .browser import Item, SiteLoader, ChromeService, NullService, BrowserCrashed
+from .browser import Item, SiteLoader, ChromeService, NullService, \
+        BrowserCrashed, BrowserStartFailed, parseBlocklist
 from .logger import Logger, Consumer
 
 class TItem (Item):
@@ -34,7 +36,7 @@ class TItem (Item):
 
     def __init__ (self, path, status, headers, bodyReceive, bodySend=None, requestBody=None, failed=False):
         super ().__init__ (tab=None)
-        self.chromeResponse = {'response': {'headers': headers, 'status': status, 'url': self.base + path}}
+        self.setResponse ({'response': {'headers': headers, 'status': status, 'url': self.base + path}})
         self._body = bodyReceive, False
         self.bodySend = bodyReceive if not bodySend else bodySend
         self._requestBody = requestBody, False
@@ -135,10 +137,11 @@ def logger ():
 
 @pytest.fixture
 def loader (http, logger):
-    def f (path):
+    def f (path, isolate=False, blocklist=[], intercept=False):
         if path.startswith ('/'):
             path = 'http://localhost:8000{}'.format (path)
-        return SiteLoader (browser, path, logger)
+        return SiteLoader (browser, path, logger, isolate=isolate,
+                blocklist=blocklist, intercept=intercept)
     print ('loader setup')
     with ChromeService () as browser:
         yield f
@@ -154,7 +157,7 @@ def itemsLoaded (l, items):
             item = l.queue.popleft ()
             if isinstance (item, Exception):
                 raise item
-            assert item.chromeResponse is not None
+            assert item.response
             golden = items.pop (item.parsedUrl.path)
             if not golden:
                 assert False, 'url {} not supposed to be fetched'.format (item.url)
@@ -218,6 +221,64 @@ def test_post (loader):
             testItemMap['/html/fetchPost/form'],
             testItemMap['/html/fetchPost/form/large']])
 
+def test_isolate (loader):
+    """ Two isolated tabs loading concurrently """
+    with loader ('/html', isolate=True) as a, loader ('/image', isolate=True) as b:
+        assert a.context != b.context
+        a.start ()
+        b.start ()
+        itemsLoaded (a, [testItemMap['/html'], testItemMap['/image'],
+                testItemMap['/nonexistent']])
+        itemsLoaded (b, [testItemMap['/image']])
+    assert a.context is None and a.control is None
+
+def test_intercept (loader):
+    """ Intercepted bodies are not transcoded """
+    golden = testItemMap['/encoding/latin1']
+    with loader ('/encoding/latin1', intercept=True) as l:
+        l.start ()
+        if not l.notify.wait (10):
+            assert False, 'timeout'
+        item = l.queue.popleft ()
+        status, statusText, headers, body = item.rawResponse
+        assert status == 200
+        assert body == golden.bodySend
+        # transcoded
+        assert item.body[0] == golden.body[0]
+
+def test_blocklist (loader):
+    with loader ('/html', blocklist=['*/image']) as l:
+        l.start ()
+        items = {}
+        while len (items) < 3:
+            if not l.notify.wait (5):
+                assert False, 'timeout'
+            l.notify.clear ()
+            while l.queue:
+                item = l.queue.popleft ()
+                items[item.parsedUrl.path] = item
+        assert items['/image'].failed and items['/image'].blocked
+        assert not items['/nonexistent'].blocked
+
+def test_parseblocklist ():
+    rules = StringIO ("""[Adblock Plus 2.0]
+        ! comment
+        ||ads.example.com^
+        |http://example.com/banner|
+        /tracker.js
+        *://cdn.example.org/*
+        ##.ad
+        @@||example.com/ok
+        ||example.net^$third-party
+        *
+        """)
+    assert parseBlocklist (rules) == [
+            '*://ads.example.com*', '*.ads.example.com*',
+            'http://example.com/banner',
+            '*/tracker.js*',
+            '*://cdn.example.org/*',
+            ]
+
 def test_crash (loader):
     with loader ('/html') as l:
         l.start ()
@@ -225,8 +286,10 @@ def test_crash (loader):
             l.tab.Page.crash (_timeout=1)
         except TimeoutException:
             pass
+        assert l.crashed.is_set ()
+        # items received before the crash are kept
         q = l.queue
-        assert isinstance (q.popleft (), BrowserCrashed)
+        assert any (map (lambda x: isinstance (x, BrowserCrashed), q))
 
 def test_invalidurl (loader):
     url = 'http://nonexistent.example/'
@@ -247,3 +310,200 @@ def test_nullservice ():
     with NullService (url) as u:
         assert u == url
 
+
+# fake browser announcing its DevTools endpoint like Chrome does
+fakeChrome = """#!/bin/sh
+for arg in "$@"; do
+    case "$arg" in
+        --user-data-dir=*) dir="${arg#*=}";;
+    esac
+done
+test -e "$dir/Preferences" && echo cloned > "$dir/cloned"
+touch "$dir/Preferences" "$dir/SingletonLock"
+echo "some noise" >&2
+echo "DevTools listening on ws://127.0.0.1:1234/devtools/browser/foo" >&2
+exec sleep 60
+"""
+
+def test_chromeservice_profile (tmpdir):
+    binary = tmpdir.join ('chrome')
+    binary.write (fakeChrome)
+    binary.chmod (0o700)
+    profile = tmpdir.join ('profile')
+
+    # template is created before the first run, which uses it already
+    service = ChromeService (binary=str (binary), profile=str (profile))
+    with service as url:
+        assert url == 'http://localhost:1234'
+        assert os.path.exists (os.path.join (service.userDataDir, 'cloned'))
+        # state of the page captured must not end up in the template
+        with open (os.path.join (service.userDataDir, 'Cookies'), 'w') as fd:
+            fd.write ('session=1')
+        userDataDir = service.userDataDir
+    assert service.startupTime > 0
+    assert not os.path.exists (userDataDir)
+    assert profile.join ('Preferences').check ()
+    assert not profile.join ('SingletonLock').check ()
+    assert not profile.join ('Cookies').check ()
+    assert not profile.join ('cloned').check ()
+
+    # later runs use it as well
+    with service as url:
+        assert os.path.exists (os.path.join (service.userDataDir, 'cloned'))
+        assert not os.path.exists (os.path.join (service.userDataDir, 'Cookies'))
+    assert not profile.join ('cloned').check ()
+
+def test_chromeservice_died (tmpdir):
+    binary = tmpdir.join ('chrome')
+    binary.write ('#!/bin/sh\nexit 1\n')
+    binary.chmod (0o700)
+    with pytest.raises (BrowserStartFailed, match='died'):
+        with ChromeService (binary=str (binary)):
+            pass
+
+class RecordingTab:
+    """ Fake tab recording network condition changes """
+    def __init__ (self):
+        self.Network = self
+        self.conditions = []
+
+    def emulateNetworkConditions (self, **kwargs):
+        self.conditions.append (kwargs['downloadThroughput'])
+
+def test_throttle (logger):
+    l = SiteLoader ('http://localhost:9222', 'http://example.com/', logger,
+            maxQueue=4)
+    l.tab = RecordingTab ()
+    for i in range (4):
+        l._append (i)
+    assert not l.throttled
+    l._append (4)
+    assert l.throttled
+    assert l.tab.conditions == [SiteLoader.throttleThroughput]
+    # only once
+    l._append (5)
+    assert len (l.tab.conditions) == 1
+
+    # half empty again
+    assert [l.popleft () for i in range (3)] == [0, 1, 2]
+    assert l.throttled
+    l.popleft ()
+    assert not l.throttled
+    assert l.tab.conditions == [SiteLoader.throttleThroughput, -1]
+
+def test_item_compact ():
+    req = {'requestId': '1', 'wallTime': 10, 'timestamp': 1, 'type': 'Script',
+            'initiator': {'type': 'parser'},
+            'request': {'url': 'http://example.com/', 'method': 'GET',
+                'headers': {'Accept': '*/*'}, 'initialPriority': 'High',
+                'referrerPolicy': 'no-referrer'}}
+    resp = {'requestId': '1', 'timestamp': 2, 'type': 'Document',
+            'response': {'url': 'http://example.com/', 'status': 200,
+                'headers': {'Set-Cookie': 'a=1\nb=2'},
+                'timing': {'requestTime': 1}, 'securityDetails': {}}}
+
+    item = Item (tab=None)
+    item.setRequest (req)
+    item.setResponse (resp)
+    item.setFinished ({'requestId': '1', 'encodedDataLength': 123})
+    assert item.id == '1'
+    assert item.request == {'url': 'http://example.com/', 'method': 'GET',
+            'headers': {'Accept': '*/*'}}
+    assert 'timing' not in item.response
+    assert item.resourceType == 'Document'
+    assert item.encodedDataLength == 123
+    assert item.responseHeaders == [('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')]
+    # cached
+    assert item.responseHeaders is item.responseHeaders
+    assert item.chromeRequest is None
+
+    item = Item (tab=None, keepRaw=True)
+    item.setRequest (req)
+    item.setResponse (resp)
+    assert item.chromeRequest is req and item.chromeResponse is resp
+
+def test_expire (logger):
+    l = SiteLoader ('http://localhost:9222', 'http://example.com/', logger,
+            maxRequestAge=10)
+    l.tab = None
+    def request (reqId, timestamp):
+        l._requestWillBeSent (requestId=reqId, timestamp=timestamp,
+                request={'url': 'http://example.com/{}'.format (reqId),
+                'method': 'GET', 'headers': {}})
+    request ('1', 0)
+    request ('2', 5)
+    assert len (l) == 2
+    # expiry runs periodically
+    request ('3', 11)
+    assert len (l) == 2
+    item = l.popleft ()
+    assert item.id == '1' and item.failed and item.orphaned
+
+    # unknown ids are ignored
+    l._loadingFailed (requestId='1', errorText='foo')
+    assert not l.queue
+
+    # end of page
+    assert set (map (lambda x: x.id, l.expire ())) == {'2', '3'}
+    assert len (l) == 0
+
+def test_waitidle (logger):
+    l = SiteLoader ('http://localhost:9222', 'http://example.com/', logger)
+    l.tab = None
+    assert l.waitIdle (settle=0, timeout=0)
+    l._requestWillBeSent (requestId='1', timestamp=0,
+            request={'url': 'http://example.com/', 'method': 'GET', 'headers': {}})
+    # pending request
+    assert not l.waitIdle (settle=0, timeout=0.1)
+
+    start = time.monotonic ()
+    t = threading.Timer (0.2, l._loadingFailed, kwargs={'requestId': '1',
+            'errorText': 'foo'})
+    t.start ()
+    assert l.waitIdle (settle=0.1, timeout=5)
+    t.join ()
+    assert time.monotonic () - start >= 0.3
+
+def test_waitidle_ignore (logger):
+    l = SiteLoader ('http://localhost:9222', 'http://example.com/', logger)
+    l.tab = None
+    # request that never finishes
+    l._requestWillBeSent (requestId='1', timestamp=0,
+            request={'url': 'http://example.com/', 'method': 'GET', 'headers': {}})
+    before = set (l.requests.keys ())
+    start = time.monotonic ()
+    assert l.waitIdle (settle=0.1, timeout=5, ignore=before)
+    assert time.monotonic () - start < 1
+    # new requests are waited for
+    l._requestWillBeSent (requestId='2', timestamp=0,
+            request={'url': 'http://example.com/2', 'method': 'GET', 'headers': {}})
+    assert not l.waitIdle (settle=0, timeout=0.1, ignore=before)
+
+class BindingTab:
+    """ Fake tab recording added bindings """
+    def __init__ (self):
+        self.Runtime = self
+        self.enabled = 0
+        self.added = []
+
+    def enable (self):
+        self.enabled += 1
+
+    def addBinding (self, name):
+        self.added.append (name)
+
+def test_binding (logger):
+    l = SiteLoader ('http://localhost:9222', 'http://example.com/', logger)
+    l.tab = BindingTab ()
+    called = []
+    l.addBinding ('foo', called.append)
+    l.addBinding ('bar', called.append)
+    assert l.tab.added == ['foo', 'bar'] and l.tab.enabled == 1
+
+    l._bindingCalled (name='foo', payload='done', executionContextId=1)
+    assert called == ['done']
+    # wakes up the controller
+    assert l.notify.is_set ()
+    # unknown bindings are ignored
+    l._bindingCalled (name='baz', payload='', executionContextId=1)
+    assert called == ['done']
@@ -0,0 +1,194 @@
+# Copyright (c) 2017–2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio, sys
+import pytest
+from io import StringIO
+
+from .controller import ScopeLimit, DepthLimit, CombinedPolicy, \
+        AdaptiveConcurrency, RetryQueue, RecursiveController, StatsHandler
+from .behavior import BehaviorProfile
+from .logger import Logger, NullConsumer
+
+def test_scope ():
+    rules = StringIO ("""
+        # comment
+        +host example.com
+        +prefix http://other.example/foo
+        -prefix http://www.example.com/login
+        -host ads.example.com
+        -regex [?&]sessionid=
+        """)
+    p = ScopeLimit.fromFile (rules)
+    urls = {
+            'http://example.com/': True,
+            'https://www.EXAMPLE.com/bar': True,
+            'http://notexample.com/': False,
+            'http://www.example.com/login/form': False,
+            'http://ads.example.com/': False,
+            'http://a.ads.example.com/': False,
+            'http://example.com/?a=b&sessionid=1': False,
+            'http://other.example/foobar': True,
+            'http://other.example/bar': False,
+            }
+    assert p (urls.keys ()) == set (filter (lambda x: urls[x], urls.keys ()))
+
+def test_scope_denyonly ():
+    p = ScopeLimit ([(False, 'host', 'example.com')])
+    assert p (['http://example.com/', 'http://example.org/']) == {'http://example.org/'}
+
+def test_scope_invalid ():
+    with pytest.raises (ValueError):
+        ScopeLimit.fromFile (StringIO ('+foo bar'))
+    with pytest.raises (ValueError):
+        ScopeLimit.fromFile (StringIO ('host example.com'))
+    with pytest.raises (ValueError):
+        ScopeLimit.fromFile (StringIO ('+host'))
+    with pytest.raises (ValueError, match='Invalid regex'):
+        ScopeLimit.fromFile (StringIO ('+regex ('))
+
+def test_scope_regex ():
+    # backreferences, repeated group names and global flags cannot be joined
+    p = ScopeLimit ([
+            (True, 'regex', r'^http://(\w+)\.example/\1$'),
+            (True, 'regex', r'/(?P<x>foo)$'),
+            (True, 'regex', r'/(?P<x>bar)$'),
+            (True, 'regex', r'(?i)/BAZ$'),
+            (True, 'regex', r'/qux$'),
+            (False, 'regex', r'^https:'),
+            ])
+    urls = {
+            'http://a.example/a': True,
+            'http://a.example/b': False,
+            'http://example.com/foo': True,
+            'http://example.com/bar': True,
+            'http://example.com/baz': True,
+            'http://example.com/qux': True,
+            'https://example.com/qux': False,
+            'http://example.com/': False,
+            }
+    assert p (urls.keys ()) == set (filter (lambda x: urls[x], urls.keys ()))
+
+def test_combined ():
+    p = CombinedPolicy (DepthLimit (1), ScopeLimit ([(True, 'prefix', 'http://example.com/')]))
+    assert p (['http://example.com/a', 'http://example.org/']) == {'http://example.com/a'}
+    # depth limit reached
+    assert p (['http://example.com/b']) == set ()
+
+def test_adaptive_concurrency ():
+    gb = 1024**3
+    a = AdaptiveConcurrency (minimum=1, maximum=3)
+    assert a.current == 1
+    # idle machine, grow up to maximum
+    assert a.adjust (1, 8*gb, 16*gb, 0.1, 1*gb) == 2
+    # not using all slots
+    assert a.adjust (1, 8*gb, 16*gb, 0.1, 1*gb) == 2
+    assert a.adjust (2, 8*gb, 16*gb, 0.1, 2*gb) == 3
+    assert a.adjust (3, 8*gb, 16*gb, 0.1, 3*gb) == 3
+    # memory pressure
+    assert a.adjust (3, 1*gb, 16*gb, 0.1, 3*gb) == 2
+    # not enough room for another worker
+    assert a.adjust (2, 2.5*gb, 16*gb, 0.1, 2*gb) == 2
+    # cpu pressure
+    assert a.adjust (2, 8*gb, 16*gb, 2, 2*gb) == 1
+    assert a.adjust (1, 8*gb, 16*gb, 2, 1*gb) == 1
+    # measurements unavailable
+    assert a.adjust (1, None, None, None, None) == 2
+
+    with pytest.raises (ValueError):
+        AdaptiveConcurrency (minimum=2, maximum=1)
+
+def test_retryqueue ():
+    r = RetryQueue (maxAttempts=3, backoff=10)
+    assert r.nextDue () is None
+    assert r.failed ('a', now=0) == 10
+    assert r.failed ('a', now=0) == 20
+    # give up
+    assert r.failed ('a', now=0) is None
+    assert len (r) == 2
+    assert r.nextDue (now=5) == 5
+    assert r.ready (now=5) == []
+    assert r.ready (now=10) == ['a']
+    assert r.ready (now=100) == ['a']
+    assert not r
+
+# fails on first attempt only, marker file is the second argument
+failOnce = """
+import sys, os
+marker = sys.argv[2] + '.marker'
+if not os.path.exists (marker):
+    open (marker, 'w').close ()
+    sys.exit (1)
+"""
+
+def test_retry (tmpdir):
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+
+    logger = Logger (consumer=[NullConsumer ()])
+    command = [sys.executable, '-c', failOnce, '{url}', str (tmpdir.join ('fetch'))]
+    c = RecursiveController ('http://example.com/', str (tmpdir), command,
+            logger, tempdir=str (tmpdir), retry=RetryQueue (backoff=0.1))
+    loop.run_until_complete (c.run ())
+    assert c.stats['retried'] == 1
+    assert c.stats['abandoned'] == 0
+
+    # give up
+    command = [sys.executable, '-c', 'import sys; sys.exit (1)']
+    c = RecursiveController ('http://example.com/', str (tmpdir), command,
+            logger, tempdir=str (tmpdir), retry=RetryQueue (maxAttempts=2, backoff=0.1))
+    loop.run_until_complete (c.run ())
+    assert c.stats['retried'] == 1
+    assert c.stats['abandoned'] == 1
+
+    # timeout
+    command = [sys.executable, '-c', 'import time; time.sleep (10)']
+    c = RecursiveController ('http://example.com/', str (tmpdir), command,
+            logger, tempdir=str (tmpdir), retry=RetryQueue (maxAttempts=1),
+            fetchTimeout=0.1)
+    loop.run_until_complete (c.run ())
+    assert c.stats['timedOut'] == 1
+    assert c.stats['abandoned'] == 1
+    loop.close ()
+
+def test_behavior_stats (tmpdir):
+    stats = StatsHandler ()
+    for method, calls in (('onload', 1), ('onfinish', 2)):
+        p = BehaviorProfile ('screenshot', method)
+        p.time = 0.5
+        p.calls = calls
+        p.bytes = 100
+        stats.push (p)
+    p = BehaviorProfile ('domSnapshot', 'onfinish')
+    p.cancelled = True
+    stats.push (p)
+    assert stats.stats['behavior'] == {
+            'screenshot': {'time': 1, 'calls': 3, 'bytes': 200, 'cancelled': 0},
+            'domSnapshot': {'time': 0, 'calls': 0, 'bytes': 0, 'cancelled': 1},
+            }
+
+    # summed up across a crawl
+    logger = Logger (consumer=[NullConsumer ()])
+    c = RecursiveController ('http://example.com/', str (tmpdir), [], logger)
+    c.addStats (stats.stats)
+    c.addStats (stats.stats)
+    assert c.stats['behavior']['screenshot']['calls'] == 6
+    assert c.stats['behavior']['domSnapshot']['cancelled'] == 2
+    assert c.stats['requests'] == 0
@@ -0,0 +1,144 @@
+# Copyright (c) 2017–2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio, sys, os, json
+import pytest
+
+from .distributed import Coordinator, Worker, ShardedController, hostShard
+from .controller import PrefixLimit, ScopeLimit
+from .logger import Logger, NullConsumer
+
+# fake crocoite-grab: page n links to 2n+1 and 2n+2, up to page 6. Command
+# arguments are templates, so this must not contain curly braces.
+fakeGrab = """
+import sys, json
+url = sys.argv[1]
+n = int (url.rsplit ('/', 1)[1])
+links = ['http://example.com/%d' % i for i in (2*n+1, 2*n+2) if i < 7]
+links.append ('http://example.org/offsite')
+print (json.dumps (dict (uuid='8ee5e9c9-1130-4c5c-88ff-718508546e0c', links=links)))
+print (json.dumps (dict (uuid='24d92d16-770e-4088-b769-4020e127a7ff', requests=1)))
+"""
+
+@pytest.fixture
+def logger ():
+    return Logger (consumer=[NullConsumer ()])
+
+def test_crawl (tmpdir, logger):
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+
+    coordinator = Coordinator ('http://example.com/0', logger,
+            policy=PrefixLimit ('http://example.com/'))
+    address = loop.run_until_complete (coordinator.start ())
+    command = [sys.executable, '-c', fakeGrab, '{url}', '{dest}']
+    workers = [Worker (address, str (tmpdir), command, logger,
+            tempdir=str (tmpdir), concurrency=2) for i in range (2)]
+    loop.run_until_complete (asyncio.gather (coordinator.run (),
+            *[w.run () for w in workers]))
+    loop.close ()
+
+    assert coordinator.have == set (['http://example.com/{}'.format (i) for i in range (7)])
+    assert coordinator.stats['requests'] == 7
+    assert not coordinator.leases
+    assert len (os.listdir (str (tmpdir))) == 7
+
+def test_expire (logger):
+    c = Coordinator ('http://example.com/', logger, leaseTimeout=10)
+    owned = set ()
+    reply = c.lease (owned)
+    assert reply['url'] == 'http://example.com/'
+    # nothing left, but lease outstanding
+    assert 'wait' in c.lease (set ())
+
+    c.expire (now=0)
+    assert reply['lease'] in c.leases
+    c.expire (now=float ('inf'))
+    assert not c.leases
+    assert c.stats['expired'] == 1
+    assert c.pending == {'http://example.com/'}
+
+    reply = c.lease (owned)
+    c.complete (reply['lease'], owned)
+    assert c.finished
+    assert c.lease (owned) == {'done': True}
+
+# fake crocoite-grab for sharding, every page is on a different host
+fakeGrabHosts = """
+import sys, json
+url = sys.argv[1]
+n = int (url.rsplit ('/', 1)[1])
+links = ['http://h%d.example/%d' % (i, i) for i in (2*n+1, 2*n+2) if i < 15]
+print (json.dumps (dict (uuid='8ee5e9c9-1130-4c5c-88ff-718508546e0c', links=links)))
+"""
+
+def test_shard (tmpdir, logger):
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+
+    output = tmpdir.mkdir ('output')
+    spool = tmpdir.mkdir ('spool')
+    command = [sys.executable, '-c', fakeGrabHosts, '{url}', '{dest}']
+    shards = 3
+    controller = [ShardedController ('http://h0.example/0', str (output),
+            command, logger, shard=i, shards=shards, spool=str (spool),
+            crawl='test',
+            pollInterval=0.05, policy=ScopeLimit ([]), tempdir=str (tmpdir),
+            concurrency=2) for i in range (shards)]
+    loop.run_until_complete (asyncio.gather (*[c.run () for c in controller]))
+    loop.close ()
+
+    expected = set (['http://h{0}.example/{0}'.format (i) for i in range (15)])
+    have = set ()
+    for i, c in enumerate (controller):
+        assert not have.intersection (c.have)
+        assert all (map (lambda u: hostShard (u, shards) == i, c.have))
+        have.update (c.have)
+    assert have == expected
+    # every shard did some work
+    assert all (map (lambda c: c.have, controller))
+    assert len (output.listdir ()) == len (expected)
+
+def test_shard_stale (tmpdir, logger):
+    """ Status of earlier crawls and shards not started yet is ignored """
+    loop = asyncio.new_event_loop ()
+    asyncio.set_event_loop (loop)
+
+    output = tmpdir.mkdir ('output')
+    spool = tmpdir.mkdir ('spool')
+    command = [sys.executable, '-c', fakeGrabHosts, '{url}', '{dest}']
+    # seed belongs to another shard, which never starts
+    url = 'http://h0.example/0'
+    shard = (hostShard (url, 2) + 1) % 2
+    # idle leftovers of an earlier crawl
+    status = json.dumps ({'crawl': 'old', 'idle': True, 'sent': 0, 'received': 0})
+    for d in (spool, spool.mkdir ('old'), spool.mkdir ('new')):
+        for i in range (2):
+            d.join ('status-{}.json'.format (i)).write (status)
+    c = ShardedController (url, str (output), command, logger, shard=shard,
+            shards=2, spool=str (spool), crawl='new', pollInterval=0.01,
+            policy=ScopeLimit ([]), tempdir=str (tmpdir))
+    with pytest.raises (asyncio.TimeoutError):
+        loop.run_until_complete (asyncio.wait_for (c.run (), 0.5))
+    loop.close ()
+
+    with pytest.raises (ValueError):
+        ShardedController (url, str (output), command, logger, shard=0,
+                shards=2, spool=str (spool), crawl='../foo')
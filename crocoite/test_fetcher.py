@@ -0,0 +1,145 @@
+# Copyright (c) 2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import gzip, threading, os
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from warcio.archiveiterator import ArchiveIterator
+
+from .fetcher import Fetcher
+from .warc import WarcHandler
+from .browser import Item
+from .logger import Logger, NullConsumer
+
+video = bytes (range (256))*4096
+# incompressible, larger than the limit below
+text = gzip.compress (os.urandom (8192))
+
+class RequestHandler (BaseHTTPRequestHandler):
+    def do_GET (self):
+        # the fetcher must not forward these
+        assert 'Range' not in self.headers
+        assert self.headers['Cookie'] == 'session=1'
+        if self.path in ('/video', '/range'):
+            self.send_response (200)
+            self.send_header ('Content-Type', 'video/mp4')
+            self.send_header ('Content-Length', len (video))
+            self.end_headers ()
+            self.wfile.write (video)
+        elif self.path == '/text':
+            self.send_response (200)
+            self.send_header ('Content-Type', 'text/plain')
+            self.send_header ('Content-Encoding', 'gzip')
+            self.end_headers ()
+            self.wfile.write (text)
+        else:
+            self.send_response (404)
+            self.end_headers ()
+
+    def log_message (self, format, *args):
+        pass
+
+@pytest.fixture
+def http ():
+    httpd = HTTPServer (('localhost', 0), RequestHandler)
+    t = threading.Thread (target=httpd.serve_forever)
+    t.start ()
+    yield 'http://localhost:{}'.format (httpd.server_address[1])
+    httpd.shutdown ()
+    t.join ()
+    httpd.server_close ()
+
+@pytest.fixture
+def logger ():
+    return Logger (consumer=[NullConsumer ()])
+
+headers = [('Cookie', 'session=1'), ('Range', 'bytes=0-'), (':authority', 'localhost')]
+
+def test_fetch (http, logger):
+    with Fetcher (logger) as f:
+        r = f.submit (http + '/video', headers).result ()
+        assert r.status == 200
+        assert r.length == len (video)
+        assert r.body.read () == video
+
+        # stored as received
+        r = f.submit (http + '/text', headers).result ()
+        assert ('Content-Encoding', 'gzip') in r.headers
+        assert r.body.read () == text
+
+def test_fetch_limit (http, logger):
+    with Fetcher (logger, maxBodySize=1024) as f:
+        with pytest.raises (ValueError):
+            # by content-length
+            f.submit (http + '/video', headers).result ()
+        with pytest.raises (ValueError):
+            # no content-length
+            f.submit (http + '/text', headers).result ()
+
+def makeItem (url, length, status=200):
+    """ Browser’s request, with Range header if status is 206 """
+    item = Item (tab=None)
+    reqHeaders = dict (headers[:2] if status == 206 else headers[:1])
+    item.setRequest ({'requestId': '1', 'wallTime': 0, 'timestamp': 0,
+            'initiator': {'type': 'other'},
+            'request': {'url': url, 'method': 'GET',
+                'headers': reqHeaders}})
+    item.setResponse ({'requestId': '1', 'timestamp': 0, 'type': 'Media',
+            'response': {'url': url, 'status': status, 'headers': {}}})
+    item.setFinished ({'requestId': '1', 'encodedDataLength': length})
+    return item
+
+def test_warc (http, logger):
+    fd = BytesIO ()
+    with Fetcher (logger) as f, WarcHandler (fd, logger, maxBodySize=1024,
+            fetcher=f) as handler:
+        handler.push (makeItem (http + '/video', len (video)))
+        # partial response of the browser, complete one of the fetcher
+        handler.push (makeItem (http + '/range', len (video), status=206))
+        # falls back to truncated record
+        handler.push (makeItem ('http://localhost:1/unreachable', 10*1024))
+        # server answers differently than it did to the browser
+        handler.push (makeItem (http + '/missing', 10*1024))
+
+    fd.seek (0)
+    responses = {}
+    requests = {}
+    for record in ArchiveIterator (fd):
+        url = record.rec_headers['WARC-Target-URI']
+        if record.rec_type == 'response':
+            responses[url] = (record.rec_headers, record.content_stream ().read ())
+        elif record.rec_type == 'request':
+            assert url not in requests
+            requests[url] = record.rec_headers['WARC-Record-ID']
+    rec, body = responses[http + '/video']
+    assert body == video
+    assert 'WARC-Truncated' not in rec
+    # belongs to the browser’s request
+    assert rec['WARC-Concurrent-To'] == requests[http + '/video']
+    rec, body = responses[http + '/range']
+    assert body == video
+    assert 'WARC-Truncated' not in rec
+    assert rec['WARC-Concurrent-To'] == requests[http + '/range']
+    rec, body = responses['http://localhost:1/unreachable']
+    assert rec['WARC-Truncated'] == 'length'
+    rec, body = responses[http + '/missing']
+    assert rec['WARC-Truncated'] == 'length'
+    assert rec['WARC-Concurrent-To'] == requests[http + '/missing']
@@ -0,0 +1,278 @@
+# Copyright (c) 2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Tests for html, run this module for a benchmark:
+
+    python -m crocoite.test_html
+"""
+
+import random, time, json
+
+import pytest
+from html5lib.serializer import HTMLSerializer
+
+from .html import ChromeTreeWalker, ChromeSerializer, StripTagFilter, \
+        StripAttributeFilter, eventAttributes
+
+def text (value):
+    return {'nodeName': '#text', 'nodeValue': value}
+
+def document (url, children):
+    return {'nodeName': '#document', 'documentURL': url, 'baseURL': url,
+            'children': children}
+
+def deepDocument (depth):
+    """ Synthetic document with depth nested elements """
+    node = text ('leaf')
+    for i in range (depth):
+        node = {'nodeName': 'DIV', 'attributes': ['class', 'd{}'.format (i)],
+                'children': [node]}
+    return document ('http://example.com/', [node])
+
+def wideDocument (n, seed=0):
+    """ Synthetic document with n random, shallow subtrees """
+    r = random.Random (seed)
+    tags = ['DIV', 'SPAN', 'A', 'P', 'IMG', 'BR', 'LI']
+    def make (level):
+        name = r.choice (tags)
+        attributes = []
+        for k in r.sample (['class', 'id', 'href', 'onclick', 'style'], r.randint (0, 3)):
+            attributes.extend ([k, 'v{}'.format (r.randint (0, 100))])
+        node = {'nodeName': name, 'attributes': attributes}
+        if level < 4 and name not in {'IMG', 'BR'}:
+            node['children'] = [make (level+1) for _ in range (r.randint (0, 4))] \
+                    + [text ('x & y <z> '*r.randint (0, 3))]
+        return node
+    body = {'nodeName': 'BODY', 'children': [make (0) for _ in range (n)]}
+    return document ('http://example.com/',
+            [{'nodeName': 'HTML', 'children': [body]}])
+
+def randomDocument (seed):
+    """
+    Small random document, mixing HTML tags in upper and lower case
+    (XHTML), which are subject to html5lib’s optional tag omission
+    """
+    r = random.Random (seed)
+    names = ['html', 'HTML', 'head', 'HEAD', 'body', 'BODY', 'p', 'P', 'li',
+            'tr', 'td', 'th', 'tbody', 'thead', 'tfoot', 'colgroup', 'col', 'dt',
+            'dd', 'option', 'optgroup', 'rt', 'rp', 'h', 'DIV', 'script',
+            'SCRIPT', 'style', 'STYLE', 'noscript', 'IMG', 'br', 'meta', 'INPUT',
+            'input', 'IFRAME', 'xmp', 'svg', 'g', 'table', 'PRE']
+    texts = ['', ' ', '\n', 'a', ' a', 'a ', ' a & <b> ', '\t\n', 'x"y\'z', 'ä']
+    attributes = ['class', 'onclick', 'onLoad', 'disabled', 'checked',
+            'async', 'itemscope', 'href']
+    values = ['', 'a', 'a b', 'a"b', "a'b", 'a\'"b', 'a&b', '<', '`x', 'é']
+    def make (level):
+        k = r.random ()
+        if k < 0.25:
+            return text (r.choice (texts))
+        elif k < 0.3:
+            return {'nodeName': '#comment', 'nodeValue': r.choice (texts)}
+        node = {'nodeName': r.choice (names)}
+        if r.random () < 0.5:
+            node['attributes'] = []
+            for a in r.sample (attributes, r.randint (0, 3)):
+                node['attributes'].extend ([a, r.choice (values)])
+        if level < 5 and r.random () < 0.7:
+            node['children'] = [make (level+1) for _ in range (r.randint (0, 4))]
+        return node
+    return document ('http://example.com/', [make (0) for _ in range (r.randint (1, 4))])
+
+def render (doc):
+    return HTMLSerializer ().render (ChromeTreeWalker (doc), 'utf-8')
+
+def test_walker ():
+    doc = document ('http://example.com/', [
+            {'nodeName': 'HTML', 'attributes': ['lang', 'en'], 'children': [
+                {'nodeName': 'BODY', 'children': [
+                    {'nodeName': '#comment', 'nodeValue': ' c '},
+                    text ('a & b'),
+                    {'nodeName': 'BR'},
+                    {'nodeName': 'IMG', 'attributes': ['src', 'x.png', 'alt', '']},
+                    {'nodeName': 'DIV', 'attributes': ['class', 'a"b'], 'children': []},
+                    ]}]}])
+    assert render (doc) == b'<HTML lang=en><BODY><!-- c -->a &amp; b<BR>' \
+            b'<IMG src=x.png alt=""><DIV class=\'a"b\'></DIV></BODY></HTML>'
+
+def test_walker_deep ():
+    """ Must not hit the recursion limit """
+    depth = 100000
+    out = render (deepDocument (depth))
+    assert out.startswith (b'<DIV class=d99999><DIV class=d99998>')
+    assert out.count (b'</DIV>') == depth
+
+def test_walker_subdocuments ():
+    c = document ('http://c.example/', [text ('c')])
+    b = document ('about:blank', [{'nodeName': 'IFRAME', 'contentDocument': c}])
+    a = document ('http://a.example/', [{'nodeName': 'IFRAME', 'contentDocument': b}])
+    d = document ('http://d.example/', [])
+    root = document ('http://example.com/', [
+            {'nodeName': 'BODY', 'children': [
+                {'nodeName': 'IFRAME', 'contentDocument': a},
+                {'nodeName': 'DIV', 'children': [
+                    {'nodeName': 'IFRAME', 'contentDocument': d}]},
+                ]}])
+
+    walker = ChromeTreeWalker (root)
+    # frames are not part of the document
+    assert HTMLSerializer ().render (walker) == \
+            '<BODY><IFRAME></IFRAME><DIV><IFRAME></IFRAME></DIV></BODY>'
+    # only direct frames
+    assert walker.subdocuments == [a, d]
+    assert list (walker.split ()) == [root, a, b, c, d]
+
+def renderFiltered (doc):
+    """ What ChromeSerializer replaces """
+    stream = StripAttributeFilter (StripTagFilter (ChromeTreeWalker (doc),
+            ['script', 'noscript']), eventAttributes)
+    return HTMLSerializer ().render (stream, 'utf-8')
+
+def test_striptag ():
+    doc = document ('http://example.com/', [
+            {'nodeName': 'SCRIPT', 'children': [{'nodeName': 'IMG'}]},
+            {'nodeName': 'P', 'children': [text ('a')]},
+            ])
+    assert renderFiltered (doc) == b'<P>a</P>'
+
+@pytest.mark.parametrize ('doc', [deepDocument (100), wideDocument (100)]
+        + [randomDocument (i) for i in range (500)])
+def test_serializer (doc):
+    serializer = ChromeSerializer (['script', 'noscript'], eventAttributes)
+    assert serializer.render (doc) == renderFiltered (doc)
+
+def test_serializer_subdocuments ():
+    a = document ('http://a.example/', [])
+    b = document ('http://b.example/', [])
+    root = document ('http://example.com/', [
+            {'nodeName': 'IFRAME', 'contentDocument': a},
+            # frames inside removed tags are still found
+            {'nodeName': 'NOSCRIPT', 'children': [
+                {'nodeName': 'IFRAME', 'contentDocument': b}]},
+            ])
+    serializer = ChromeSerializer (['noscript'])
+    assert serializer.render (root) == b'<IFRAME></IFRAME>'
+    assert serializer.subdocuments == [a, b]
+
+def flatten (doc, hidden=True):
+    """
+    Convert DOM.getDocument’s document doc into DOMSnapshot.captureSnapshot’s
+    format. Adds a shadow root and a pseudo element to each element if
+    hidden, which must be ignored.
+    """
+    strings = []
+    stringIndex = {}
+    def intern (s):
+        if s not in stringIndex:
+            stringIndex[s] = len (strings)
+            strings.append (s)
+        return stringIndex[s]
+    docs = [doc]
+    documents = []
+    while len (documents) < len (docs):
+        nodes = {'parentIndex': [], 'nodeName': [], 'nodeValue': [],
+                'attributes': [], 'contentDocumentIndex': {'index': [], 'value': []},
+                'pseudoType': {'index': [], 'value': []}}
+        documents.append ({'documentURL': intern (docs[len (documents)]['documentURL']),
+                'nodes': nodes})
+        def add (parent, name, value='', attributes=[]):
+            nodes['parentIndex'].append (parent)
+            nodes['nodeName'].append (intern (name))
+            nodes['nodeValue'].append (intern (value))
+            nodes['attributes'].append (list (map (intern, attributes)))
+            return len (nodes['parentIndex'])-1
+        stack = [(docs[len (documents)-1], -1)]
+        while stack:
+            node, parent = stack.pop ()
+            i = add (parent, node['nodeName'], node.get ('nodeValue', ''),
+                    node.get ('attributes', []))
+            if hidden and not node['nodeName'].startswith ('#'):
+                pseudo = add (i, '::before')
+                nodes['pseudoType']['index'].append (pseudo)
+                nodes['pseudoType']['value'].append (intern ('before'))
+                add (add (i, '#document-fragment'), '#text', 'shadow')
+            if 'contentDocument' in node:
+                nodes['contentDocumentIndex']['index'].append (i)
+                nodes['contentDocumentIndex']['value'].append (len (docs))
+                docs.append (node['contentDocument'])
+            stack.extend ((c, i) for c in reversed (node.get ('children', [])))
+    return {'documents': documents, 'strings': strings}
+
+@pytest.mark.parametrize ('doc', [wideDocument (100)]
+        + [randomDocument (i) for i in range (100)])
+def test_serializer_snapshot (doc):
+    serializer = ChromeSerializer (['script', 'noscript'], eventAttributes)
+    assert serializer.renderSnapshot (flatten (doc), 0) == \
+            serializer.render (doc)
+
+def test_serializer_snapshot_subdocuments ():
+    a = document ('http://a.example/', [text ('a')])
+    b = document ('http://b.example/', [text ('b')])
+    root = document ('http://example.com/', [
+            {'nodeName': 'IFRAME', 'contentDocument': a},
+            {'nodeName': 'NOSCRIPT', 'children': [
+                {'nodeName': 'IFRAME', 'contentDocument': b}]},
+            ])
+    snapshot = flatten (root)
+    serializer = ChromeSerializer (['noscript'])
+    assert serializer.renderSnapshot (snapshot, 0) == b'<IFRAME></IFRAME>'
+    assert serializer.subdocuments == [1, 2]
+    assert serializer.renderSnapshot (snapshot, 2) == b'b'
+
+def benchmark ():
+    for name, doc in [('deep', deepDocument (10000)),
+            ('wide', wideDocument (5000))]:
+        start = time.perf_counter ()
+        tokens = sum (1 for _ in ChromeTreeWalker (doc))
+        walk = time.perf_counter () - start
+        start = time.perf_counter ()
+        size = len (renderFiltered (doc))
+        serialize = time.perf_counter () - start
+        start = time.perf_counter ()
+        serializer = ChromeSerializer (['script', 'noscript'], eventAttributes)
+        fastSize = len (serializer.render (doc))
+        fast = time.perf_counter () - start
+        print ('{}: {} tokens, walk {:.3f}s, html5lib {} bytes {:.3f}s, '
+                'ChromeSerializer {} bytes {:.3f}s'.format (name, tokens, walk,
+                size, serialize, fastSize, fast))
+
+        # what the browser sends for DOM.getDocument and
+        # DOMSnapshot.captureSnapshot
+        for method, data in [('getDocument', doc),
+                ('captureSnapshot', flatten (doc, hidden=False))]:
+            try:
+                encoded = json.dumps (data)
+            except RecursionError:
+                # so does pychrome’s json.loads
+                print ('    {}: too deep for json'.format (method))
+                continue
+            start = time.perf_counter ()
+            data = json.loads (encoded)
+            parse = time.perf_counter () - start
+            start = time.perf_counter ()
+            if method == 'getDocument':
+                serializer.render (data)
+            else:
+                serializer.renderSnapshot (data, 0)
+            print ('    {}: {} bytes JSON, parse {:.3f}s, render {:.3f}s'.format (
+                    method, len (encoded), parse, time.perf_counter () - start))
+
+if __name__ == '__main__':
+    benchmark ()
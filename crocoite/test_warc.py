@@ -0,0 +1,85 @@
+# Copyright (c) 2018 crocoite contributors
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from io import BytesIO
+from warcio.archiveiterator import ArchiveIterator
+
+from .warc import WarcHandler
+from .browser import Item
+from .behavior import CanvasSnapshotEvent, DomSnapshotEvent
+from .logger import Logger, NullConsumer
+
+def test_intercepted ():
+    """ Intercepted bodies and headers are written as-is """
+    url = 'http://example.com/latin1'
+    body = 'äöü'.encode ('latin1')
+    item = Item (tab=None)
+    item.setRequest ({'requestId': '1', 'wallTime': 0, 'timestamp': 0,
+            'initiator': {'type': 'other'},
+            'request': {'url': url, 'method': 'GET', 'headers': {}}})
+    item.setResponse ({'requestId': '1', 'timestamp': 0, 'type': 'Document',
+            'response': {'url': url, 'status': 200, 'mimeType': 'text/plain',
+            'headers': {'Content-Type': 'text/plain; charset=latin1'}}})
+    item.setFinished ({'requestId': '1', 'encodedDataLength': 10})
+    item.rawResponse = (200, 'OK', [('Content-Type', 'text/plain; charset=latin1'),
+            ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2'),
+            ('Content-Encoding', 'gzip')], body)
+
+    fd = BytesIO ()
+    logger = Logger (consumer=[NullConsumer ()])
+    with WarcHandler (fd, logger) as handler:
+        handler.push (item)
+
+    fd.seek (0)
+    for record in ArchiveIterator (fd):
+        if record.rec_type == 'response':
+            break
+    else:
+        assert False, 'no response record'
+    assert record.rec_headers['X-Chrome-Intercepted'] == 'True'
+    headers = record.http_headers
+    assert headers.get_header ('content-type') == 'text/plain; charset=latin1'
+    assert headers.get_header ('content-encoding') is None
+    assert len (list (filter (lambda x: x[0] == 'Set-Cookie', headers.headers))) == 2
+    assert record.content_stream ().read () == body
+
+def test_canvas ():
+    document = 'http://example.com/'
+    url = 'http://example.com/.crocoite/canvas/foo/0.png'
+    fd = BytesIO ()
+    logger = Logger (consumer=[NullConsumer ()])
+    with WarcHandler (fd, logger) as handler:
+        handler.push (DomSnapshotEvent (document, b'<html></html>', '{}'))
+        handler.push (CanvasSnapshotEvent (url, 'image/png', b'\x89PNG', document))
+
+    fd.seek (0)
+    snapshotId = None
+    for record in ArchiveIterator (fd):
+        if record.rec_headers['WARC-Target-URI'] == document:
+            snapshotId = record.rec_headers['WARC-Record-ID']
+        elif record.rec_headers['WARC-Target-URI'] == url:
+            break
+    else:
+        assert False, 'no canvas record'
+    assert record.rec_type == 'resource'
+    assert snapshotId is not None
+    assert record.rec_headers['WARC-Refers-To'] == snapshotId
+    assert record.rec_headers['Content-Type'] == 'image/png'
+    assert record.content_stream ().read () == b'\x89PNG'
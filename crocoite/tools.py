@@ -22,7 +22,7 @@
 Misc tools
 """
 
-import shutil, sys, re, os, logging, argparse
+import sys, re, os, logging, argparse
 from warcio.archiveiterator import ArchiveIterator
 from warcio.warcwriter import WARCWriter
 
@@ -84,17 +84,24 @@ def extractScreenshot ():
         for record in ArchiveIterator (args.input):
             headers = record.rec_headers
             if record.rec_type != 'conversion' or \
-                    headers['Content-Type'] != 'image/png' or \
+                    not headers['Content-Type'].startswith ('image/') or \
                     'X-Crocoite-Screenshot-Y-Offset' not in headers:
                 continue
 
             urlSanitized = headers.get_header('WARC-Target-URI').replace ('/', '_')
             xoff = 0
             yoff = int (headers.get_header ('X-Crocoite-Screenshot-Y-Offset'))
-            outpath = '{}-{}-{}-{}.png'.format (args.prefix, urlSanitized, xoff, yoff)
-            if args.force or not os.path.exists (outpath):
-                with open (outpath, 'wb') as out:
-                    shutil.copyfileobj (record.raw_stream, out)
-            else:
-                print ('not overwriting {}'.format (outpath))
+            ext = headers['Content-Type'].split ('/', 1)[1]
+            # identical tiles are stored once, write them to every offset
+            repeat = int (headers.get_header ('X-Crocoite-Screenshot-Repeat') or 1)
+            height = int (headers.get_header ('X-Crocoite-Screenshot-Height') or 0)
+            data = record.raw_stream.read ()
+            for i in range (repeat):
+                outpath = '{}-{}-{}-{}.{}'.format (args.prefix, urlSanitized,
+                        xoff, yoff+i*height, ext)
+                if args.force or not os.path.exists (outpath):
+                    with open (outpath, 'wb') as out:
+                        out.write (data)
+                else:
+                    print ('not overwriting {}'.format (outpath))
 
@@ -90,3 +90,57 @@ def getRequirements (dist):
         pending.difference_update (have)
     return packages
 
+
+def getMemoryInfo ():
+    """
+    Get available and total system memory in bytes, None if unknown (i.e. not
+    running on Linux)
+    """
+    info = {}
+    try:
+        with open ('/proc/meminfo', 'r') as fd:
+            for l in fd:
+                k, v = l.split (':', 1)
+                # all values are in kB
+                info[k] = int (v.split ()[0])*1024
+    except (OSError, ValueError):
+        return None
+    try:
+        return info['MemAvailable'], info['MemTotal']
+    except KeyError:
+        return None
+
+def getProcessTreeRss (pids):
+    """
+    Get resident set size in bytes of processes pids and all of their
+    descendants, None if unknown (i.e. not running on Linux)
+    """
+    try:
+        entries = os.listdir ('/proc')
+    except OSError:
+        return None
+    pagesize = os.sysconf ('SC_PAGE_SIZE')
+    children = {}
+    rss = {}
+    for e in entries:
+        if not e.isdigit ():
+            continue
+        try:
+            with open ('/proc/{}/stat'.format (e), 'r') as fd:
+                stat = fd.read ()
+        except OSError:
+            # process is gone already
+            continue
+        # the command name may contain spaces and parentheses, skip it
+        fields = stat[stat.rindex (')')+2:].split ()
+        pid = int (e)
+        children.setdefault (int (fields[1]), []).append (pid)
+        rss[pid] = int (fields[21])*pagesize
+
+    total = 0
+    pending = list (pids)
+    while pending:
+        pid = pending.pop ()
+        total += rss.get (pid, 0)
+        pending.extend (children.get (pid, []))
+    return total
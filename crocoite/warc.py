@@ -33,19 +33,30 @@ from warcio.warcwriter import WARCWriter
 
 from .util import packageUrl
 from .controller import defaultSettings, EventHandler, ControllerStart
-from .behavior import Script, DomSnapshotEvent, ScreenshotEvent
-from .browser import Item
+from .behavior import Script, DomSnapshotEvent, ScreenshotEvent, \
+        CanvasSnapshotEvent
+from .browser import Item, BrowserCrashed
 
 class WarcHandler (EventHandler):
-    __slots__ = ('logger', 'writer', 'maxBodySize', 'documentRecords', 'log',
-            'maxLogSize', 'logEncoding', 'warcinfoRecordId')
+    __slots__ = ('logger', 'writer', 'maxBodySize', 'documentRecords',
+            'snapshotRecords', 'log',
+            'maxLogSize', 'logEncoding', 'warcinfoRecordId', 'fetcher',
+            'pendingFetches')
+
+    # record browser crashes
+    acceptException = True
 
     def __init__ (self, fd,
             logger,
-            maxBodySize=defaultSettings.maxBodySize):
+            maxBodySize=defaultSettings.maxBodySize,
+            fetcher=None):
         self.logger = logger
         self.writer = WARCWriter (fd, gzip=True)
         self.maxBodySize = maxBodySize
+        # bodies larger than maxBodySize are downloaded by this .fetcher.Fetcher
+        self.fetcher = fetcher
+        # (future, item, concurrentTo)
+        self.pendingFetches = []
 
         self.logEncoding = 'utf-8'
         self.log = BytesIO ()
@@ -55,6 +66,9 @@ class WarcHandler (EventHandler):
         # maps document urls to WARC record ids, required for DomSnapshotEvent
         # and ScreenshotEvent
         self.documentRecords = {}
+        # maps document urls to DOM snapshot record ids, required for
+        # CanvasSnapshotEvent
+        self.snapshotRecords = {}
         # record id of warcinfo record
         self.warcinfoRecordId = None
 
@@ -62,9 +76,11 @@ class WarcHandler (EventHandler):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self._writeFetched (wait=True)
         self._flushLogEntries ()
 
-    def writeRecord (self, url, kind, payload, warc_headers_dict=None, http_headers=None):
+    def writeRecord (self, url, kind, payload, warc_headers_dict=None,
+            http_headers=None, length=None):
         """
         Thin wrapper around writer.create_warc_record and writer.write_record.
 
@@ -78,7 +94,8 @@ class WarcHandler (EventHandler):
         warc_headers_dict = d
 
         record = self.writer.create_warc_record (url, kind, payload=payload,
-                warc_headers_dict=warc_headers_dict, http_headers=http_headers)
+                warc_headers_dict=warc_headers_dict, http_headers=http_headers,
+                length=length)
         self.writer.write_record (record)
 
         return record
@@ -99,7 +116,7 @@ class WarcHandler (EventHandler):
         warcHeaders = {
                 'X-Chrome-Initiator': json.dumps (initiator),
                 'X-Chrome-Request-ID': item.id,
-                'WARC-Date': datetime_to_iso_date (datetime.utcfromtimestamp (item.chromeRequest['wallTime'])),
+                'WARC-Date': datetime_to_iso_date (datetime.utcfromtimestamp (item.wallTime)),
                 }
         try:
             bodyTruncated = None
@@ -121,7 +138,7 @@ class WarcHandler (EventHandler):
                 warc_headers_dict=warcHeaders)
         return record.rec_headers['WARC-Record-ID']
 
-    def _writeResponse (self, item, concurrentTo):
+    def _writeResponse (self, item, concurrentTo, fetch=True):
         # fetch the body
         reqId = item.id
         rawBody = None
@@ -133,10 +150,23 @@ class WarcHandler (EventHandler):
             # body).
             bodyTruncated = 'unspecified'
         elif item.encodedDataLength > self.maxBodySize:
+            if fetch and self.fetcher is not None and \
+                    item.request.get ('method') == 'GET':
+                # written by _writeFetched, or truncated if that fails
+                self.logger.info ('body too large, fetching off-browser',
+                        uuid='33fd02b6-deb1-4571-8d03-9e1cc81c0359',
+                        reqId=reqId, url=item.url,
+                        length=item.encodedDataLength)
+                future = self.fetcher.submit (item.url, item.requestHeaders)
+                self.pendingFetches.append ((future, item, concurrentTo))
+                return
             bodyTruncated = 'length'
             # check body size first, since we’re loading everything into memory
             self.logger.error ('body for {} too large {} vs {}'.format (reqId,
                     item.encodedDataLength, self.maxBodySize))
+        elif item.rawResponse is not None:
+            # intercepted before the browser transcoded it
+            rawBody = item.rawResponse[3]
         else:
             try:
                 rawBody, base64Encoded = item.body
@@ -154,17 +184,26 @@ class WarcHandler (EventHandler):
                 'X-Chrome-ConnectionReused': str (resp.get ('connectionReused')),
                 'X-Chrome-Request-ID': item.id,
                 'WARC-Date': datetime_to_iso_date (datetime.utcfromtimestamp (
-                        item.chromeRequest['wallTime']+
-                        (item.chromeResponse['timestamp']-item.chromeRequest['timestamp']))),
+                        item.wallTime+
+                        (item.responseTimestamp-item.requestTimestamp))),
                 }
         if bodyTruncated:
             warcHeaders['WARC-Truncated'] = bodyTruncated
+        elif rawBody is not None and item.rawResponse is not None:
+            warcHeaders['X-Chrome-Intercepted'] = str (True)
         else:
             warcHeaders['X-Chrome-Base64Body'] = str (base64Encoded)
 
-        httpHeaders = StatusAndHeaders('{} {}'.format (resp['status'],
-                item.statusText), item.responseHeaders,
-                protocol='HTTP/1.1')
+        if rawBody is not None and item.rawResponse is not None:
+            # headers as received, not folded by the browser
+            status, statusText, headers, _ = item.rawResponse
+            httpHeaders = StatusAndHeaders('{} {}'.format (status,
+                    statusText or item.statusText), headers,
+                    protocol='HTTP/1.1')
+        else:
+            httpHeaders = StatusAndHeaders('{} {}'.format (resp['status'],
+                    item.statusText), item.responseHeaders,
+                    protocol='HTTP/1.1')
 
         # Content is saved decompressed and decoded, remove these headers
         blacklistedHeaders = {'transfer-encoding', 'content-encoding'}
@@ -173,9 +212,9 @@ class WarcHandler (EventHandler):
 
         # chrome sends nothing but utf8 encoded text. Fortunately HTTP
         # headers take precedence over the document’s <meta>, thus we can
-        # easily override those.
+        # easily override those. Intercepted bodies keep their encoding.
         contentType = resp.get ('mimeType')
-        if contentType:
+        if contentType and item.rawResponse is None:
             if not base64Encoded:
                 contentType += '; charset=utf-8'
             httpHeaders.replace_header ('content-type', contentType)
@@ -193,6 +232,61 @@ class WarcHandler (EventHandler):
         if item.resourceType == 'Document':
             self.documentRecords[item.url] = record.rec_headers.get_header ('WARC-Record-ID')
 
+    def _writeFetched (self, wait=False):
+        """
+        Write bodies downloaded by the fetcher. Only the main thread writes
+        to the WARC, so this is called for every event.
+        """
+        pending = []
+        for future, item, concurrentTo in self.pendingFetches:
+            if not wait and not future.done ():
+                pending.append ((future, item, concurrentTo))
+                continue
+            try:
+                result = future.result ()
+            except Exception as e:
+                self.logger.error ('off-browser fetch failed',
+                        uuid='ac3fdc3f-802f-4bdd-a20e-9c41843a8d3c',
+                        url=item.url, exception=repr (e))
+                self._writeResponse (item, concurrentTo, fetch=False)
+                continue
+            with result.body:
+                self._writeFetchResult (item, result, concurrentTo)
+        self.pendingFetches = pending
+
+    def _writeFetchResult (self, item, result, concurrentTo):
+        """
+        Write response of an off-browser fetch, belonging to the browser’s
+        request record concurrentTo. Falls back to the truncated browser
+        response, if the server did not answer like it did to the browser.
+        """
+        expected = item.response['status']
+        # Range headers are not forwarded, so the server answers a partial
+        # request of the browser with the whole body
+        if expected == 206 and result.status == 200:
+            expected = 200
+        if result.status != expected:
+            # lost cookies or referer, for instance
+            self.logger.error ('off-browser fetch status differs',
+                    uuid='df4b00e0-8585-4138-91b5-94aa7940496b',
+                    url=item.url, status=result.status, expected=expected)
+            self._writeResponse (item, concurrentTo, fetch=False)
+            return
+
+        # the body is stored as received, including its content encoding.
+        # Chunked transfer encoding has been removed by the client though.
+        httpHeaders = StatusAndHeaders ('{} {}'.format (result.status,
+                result.reason), result.headers, protocol='HTTP/1.1')
+        if httpHeaders.remove_header ('transfer-encoding'):
+            httpHeaders.replace_header ('content-length', '{:d}'.format (result.length))
+        warcHeaders = {'WARC-Date': datetime_to_iso_date (result.date),
+                'WARC-Concurrent-To': concurrentTo,
+                'X-Chrome-Request-ID': item.id,
+                }
+        self.writeRecord (result.url, 'response', payload=result.body,
+                length=result.length, http_headers=httpHeaders,
+                warc_headers_dict=warcHeaders)
+
     def _writeScript (self, item):
         writer = self.writer
         encoding = 'utf-8'
@@ -226,14 +320,29 @@ class WarcHandler (EventHandler):
 
         self._addRefersTo (warcHeaders, item.url)
 
-        self.writeRecord (item.url, 'conversion',
+        record = self.writeRecord (item.url, 'conversion',
                 payload=BytesIO (item.document),
                 warc_headers_dict=warcHeaders)
+        self.snapshotRecords[item.url] = record.rec_headers.get_header ('WARC-Record-ID')
+
+    def _writeCanvasSnapshot (self, item):
+        warcHeaders = {'Content-Type': item.mimeType}
+        refersTo = self.snapshotRecords.get (item.document)
+        if refersTo:
+            warcHeaders['WARC-Refers-To'] = refersTo
+        else:
+            self.logger.error ('No DOM snapshot record found for {}'.format (item.document))
+        self.writeRecord (item.url, 'resource', payload=BytesIO (item.data),
+                warc_headers_dict=warcHeaders)
 
     def _writeScreenshot (self, item):
         writer = self.writer
-        warcHeaders = {'Content-Type': 'image/png',
-                'X-Crocoite-Screenshot-Y-Offset': str (item.yoff)}
+        warcHeaders = {'Content-Type': item.mimeType,
+                'X-Crocoite-Screenshot-Y-Offset': str (item.yoff),
+                'X-Crocoite-Screenshot-Scale': str (item.scale),
+                'X-Crocoite-Screenshot-Repeat': str (item.repeat)}
+        if item.height is not None:
+            warcHeaders['X-Crocoite-Screenshot-Height'] = str (item.height)
         self._addRefersTo (warcHeaders, item.url)
         self.writeRecord (item.url, 'conversion',
                 payload=BytesIO (item.data), warc_headers_dict=warcHeaders)
@@ -264,14 +373,28 @@ class WarcHandler (EventHandler):
                 threading.current_thread () is threading.main_thread ():
             self._flushLogEntries ()
 
+    def _writeCrash (self, item):
+        """ Mark the capture as incomplete """
+        url = item.args[0] if item.args else None
+        warcHeaders = {'Content-Type': 'application/json; charset=utf-8'}
+        if url:
+            self._addRefersTo (warcHeaders, url)
+        payload = BytesIO (json.dumps ({'url': url, 'error': 'browser crashed'},
+                indent=2).encode ('utf-8'))
+        self.writeRecord (packageUrl ('crash'), 'metadata', payload=payload,
+                warc_headers_dict=warcHeaders)
+
     route = {Script: _writeScript,
             Item: _writeItem,
             DomSnapshotEvent: _writeDomSnapshot,
+            CanvasSnapshotEvent: _writeCanvasSnapshot,
             ScreenshotEvent: _writeScreenshot,
             ControllerStart: _writeControllerStart,
+            BrowserCrashed: _writeCrash,
             }
 
     def push (self, item):
+        self._writeFetched ()
         processed = False
         for k, v in self.route.items ():
             if isinstance (item, k):
@@ -14,11 +14,15 @@ setup(
         'warcio',
         'html5lib>=0.999999999',
         'bottom',
+        'requests',
     ],
     entry_points={
     'console_scripts': [
             'crocoite-grab = crocoite.cli:single',
+            'crocoite-batch = crocoite.cli:batch',
             'crocoite-recursive = crocoite.cli:recursive',
+            'crocoite-coordinator = crocoite.cli:coordinator',
+            'crocoite-worker = crocoite.cli:worker',
             'crocoite-irc = crocoite.cli:irc',
             'crocoite-merge-warc = crocoite.tools:mergeWarc',
             'crocoite-extract-screenshot = crocoite.tools:extractScreenshot',